@@ -0,0 +1,186 @@
+"""
+Check a training corpus against several reference (test) sets at once.
+
+All reference sets (local JSONL files written by `flatten.py`) go into one
+LSH index, each sample tagged by its reference name, and the corpus is
+hashed and queried in a single streaming pass instead of once per reference.
+"""
+import os
+import csv
+import json
+import argparse
+import multiprocessing as mp
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+from tqdm import tqdm
+
+from src.postprocess.deduplication.lsh import LSHIndex
+from src.postprocess.deduplication.minhash_deduplication import CHUNK_SIZE, get_sample_id, hash_lines, \
+    imap_bounded, read_chunks
+
+
+def parse_references(references: List[str]) -> Dict[str, str]:
+    """
+    Parse `name=path` reference arguments (a bare path is named after its file)
+    """
+    result = {}
+    for reference in references:
+        if '=' in reference:
+            name, path = reference.split('=', 1)
+        else:
+            path = reference
+            name = os.path.splitext(os.path.basename(path))[0]
+        if name in result:
+            raise ValueError(f"Reference set {name} is given twice")
+        result[name] = path
+    return result
+
+
+def build_reference_index(references: Dict[str, str], threshold: float, num_perm: int, ngram: int,
+                          pool, chunk_size: int = CHUNK_SIZE, normalize: bool = False) -> LSHIndex:
+    """
+    One LSH index over all reference sets, keyed by (reference name, sample id).
+    Reference samples without an id are keyed by their line number instead.
+    """
+    index = LSHIndex(threshold=threshold, num_perm=num_perm)
+    for name, path in references.items():
+        n_samples, n_unnamed = len(index), 0
+        with open(path, 'r') as file:
+            chunks = chunk_args(file, chunk_size, ngram, num_perm, normalize)
+            for rows, ids, signatures in imap_bounded(pool, hash_corpus_chunk, chunks):
+                for row, idx, signature in zip(rows, ids, signatures):
+                    if idx is None:
+                        idx = row
+                        n_unnamed += 1
+                    index.insert((name, idx), signature)
+        print(f"Load reference {name} ({path}) | Length: {len(index) - n_samples}"
+              + (f" | Keyed by line number: {n_unnamed}" if n_unnamed else ""))
+    return index
+
+
+def chunk_args(file, chunk_size: int, ngram: int, num_perm: int, normalize: bool = False):
+    """
+    `hash_corpus_chunk` arguments of each chunk of `file`, with its first line number
+    """
+    start = 0
+    for chunk in read_chunks(file, chunk_size):
+        yield start, chunk, ngram, num_perm, normalize
+        start += len(chunk)
+
+
+def hash_corpus_chunk(start: int, lines: List[str], ngram: int, num_perm: int, normalize: bool = False):
+    """
+    Hash a chunk of corpus lines starting at line number `start` (run inside a worker)
+
+    Return:
+        Line numbers, ids and signature matrix of the hashable samples
+    """
+    rows, ids, signatures = [], [], []
+    for offset, item, signature in hash_lines(lines, ngram, num_perm, normalize):
+        rows.append(start + offset)
+        ids.append(get_sample_id(item))
+        signatures.append(signature)
+    return rows, ids, np.array(signatures, dtype=np.uint32).reshape(-1, num_perm)
+
+
+def check_contamination(
+    data_path: str,
+    references: Dict[str, str],
+    save_path: str,
+    filtered_path: str = None,
+    report_path: str = None,
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    ngram: int = 3,
+    chunk_size: int = CHUNK_SIZE,
+    normalize: bool = False,
+):
+    """
+    Stream `data_path` through the reference index once.
+
+    Every contaminated corpus sample is written to `save_path` with the
+    reference samples it matches. Per-reference hits are printed (and saved
+    to `report_path` as CSV). If `filtered_path` is given, the corpus without
+    the contaminated samples is written there.
+    """
+    contaminated_rows = []
+    contaminated_samples = defaultdict(int)
+    hit_references = defaultdict(set)
+
+    with mp.Pool() as pool:
+        index = build_reference_index(references, threshold, num_perm, ngram, pool, chunk_size, normalize)
+
+        with open(data_path, 'r') as file, open(save_path, 'w') as writer, \
+                tqdm(desc="Checking", unit=" samples") as pbar:
+            chunks = chunk_args(file, chunk_size, ngram, num_perm, normalize)
+            for rows, ids, signatures in imap_bounded(pool, hash_corpus_chunk, chunks):
+                for row, idx, signature in zip(rows, ids, signatures):
+                    matches = index.query(signature)
+                    if not matches:
+                        continue
+                    contaminated_rows.append(row)
+                    for name in {name for (name, _), _ in matches}:
+                        contaminated_samples[name] += 1
+                    for (name, ref_idx), _ in matches:
+                        hit_references[name].add(ref_idx)
+                    json.dump({
+                        'id': idx,
+                        'line': row,
+                        'matches': [{'reference': name, 'id': ref_idx, 'score': score}
+                                    for (name, ref_idx), score in matches],
+                    }, writer)
+                    writer.write('\n')
+                pbar.update(len(rows))
+
+    reference_sizes = defaultdict(int)
+    for name, _ in index.keys:
+        reference_sizes[name] += 1
+    report = [[name, reference_sizes[name], contaminated_samples[name], len(hit_references[name])]
+              for name in references]
+    fields = ['Reference', 'Reference Samples', 'Contaminated Samples', 'Reference Samples Hit']
+    print(" | ".join(fields))
+    for line in report:
+        print(" | ".join(str(value) for value in line))
+    if report_path:
+        with open(report_path, 'w', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(fields)
+            csv_writer.writerows(report)
+
+    if filtered_path:
+        contaminated_rows = set(contaminated_rows)
+        with open(data_path, 'r') as file, open(filtered_path, 'w') as writer:
+            for row, line in enumerate(tqdm(file, desc="Filtering")):
+                if row not in contaminated_rows:
+                    writer.write(line)
+    return report
+
+
+def args_parse():
+    parser = argparse.ArgumentParser(description='Check a corpus against multiple reference sets')
+    parser.add_argument('--data_path', type=str, help='Corpus JSONL file')
+    parser.add_argument('--reference', '-r', type=str, action='append', required=True,
+                        help='Reference set as name=path/to/reference.jsonl (repeatable)')
+    parser.add_argument('--save_path', type=str, default='contamination.jsonl',
+                        help='Contaminated corpus samples and their matches')
+    parser.add_argument('--filtered_path', type=str, default=None,
+                        help='Write the corpus without contaminated samples here')
+    parser.add_argument('--report_path', type=str, default=None, help='Per-reference hits as CSV')
+    parser.add_argument('--threshold', type=float, default=0.8, help='Jaccard threshold')
+    parser.add_argument('--num_perm', type=int, default=128, help='Number of permutation')
+    parser.add_argument('--n_gram', type=int, default=3, help='Number of Ngrams')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of samples hashed at once')
+    parser.add_argument('--normalize', action='store_true', help='Normalize identifiers and literals')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = args_parse()
+    mp.set_start_method("fork")
+
+    check_contamination(
+        opt.data_path, parse_references(opt.reference), opt.save_path, opt.filtered_path,
+        opt.report_path, opt.threshold, opt.num_perm, opt.n_gram, opt.chunk_size, opt.normalize
+    )
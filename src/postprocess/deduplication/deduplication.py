@@ -1,45 +1,37 @@
-import random
-import hashlib
 import json
 from tqdm import tqdm
 
 from argparse import ArgumentParser
 import multiprocessing as mp
 
+import numpy as np
 
-def jaccard_similarity(code1, code2, num_hash_functions=100) -> float:
+from src.postprocess.deduplication.minhash import get_minhasher, jaccard
+from src.postprocess.deduplication.shingling import ngram_hashes, token_ids
+from src.postprocess.deduplication.lsh import LSHIndex
+from src.postprocess.deduplication.store import SignatureStore
+
+
+NUM_HASH_FUNCTIONS = 100
+# Token 3-grams (plus the trailing 2-gram and token), see `minhash_signature`
+SHINGLING = 'token-ids-3gram+tail'
+STORE_CHUNK_SIZE = 100000
+
+
+def jaccard_similarity(code1, code2, num_hash_functions=NUM_HASH_FUNCTIONS) -> float:
     """Compute the Jaccard similarity of two code snippets."""
-    num_same = sum(
-        [1 for i in range(num_hash_functions) if code1[i] == code2[i]])
-    num_total = num_hash_functions
-    return float(num_same) / float(num_total)
-
-
-def minhash_signature(tokens, num_hash_functions=100):
-    # Create set of shingles
-    shingles = set()
-    for i in range(len(tokens)):
-        if i < len(tokens) - 2:
-            shingles.add((tokens[i], tokens[i+1], tokens[i+2]))
-        elif i < len(tokens) - 1:
-            shingles.add((tokens[i], tokens[i+1]))
-        else:
-            shingles.add(tokens[i])
-
-    # Create hash functions
-    hash_functions = []
-    for i in range(num_hash_functions):
-        hash_functions.append(hashlib.sha1(str(i).encode('utf-8')).hexdigest())
-
-    # Generate minhash signature
-    signature = [float('inf')] * num_hash_functions
-    for shingle in shingles:
-        shingle_str = str(shingle).encode('utf-8')
-        shingle_hash = hashlib.sha1(shingle_str).hexdigest()
-        for i, hf in enumerate(hash_functions):
-            hash_val = int(shingle_hash, 16) ^ int(hf, 16)
-            signature[i] = min(signature[i], hash_val)
-    return signature
+    return jaccard(code1[:num_hash_functions], code2[:num_hash_functions])
+
+
+def minhash_signature(tokens, num_hash_functions=NUM_HASH_FUNCTIONS):
+    # Token 3-grams, plus the trailing 2-gram and token, hashed over token ids
+    ids = token_ids(tokens)
+    shingles = np.concatenate([ngram_hashes(ids, 3), ngram_hashes(ids[-2:], 2), ngram_hashes(ids[-1:], 1)])
+
+    # Generate minhash signature (None if there is no token)
+    if len(shingles) == 0:
+        return None
+    return get_minhasher(num_hash_functions).signature(shingles)
 
 
 def _compute_min_hash(element):
@@ -47,6 +39,7 @@ def _compute_min_hash(element):
         value = json.loads(element)
     except Exception:
         print(element)
+        return None
     code = value['code_tokens']
     
     sample_id = None
@@ -59,7 +52,7 @@ def _compute_min_hash(element):
 
 
 def minhash_iter(dataset_iterator):
-    with mp.Pool(processor=mp.cpu_count()-2) as pool:
+    with mp.Pool(processes=max(1, mp.cpu_count()-2)) as pool:
         for data in pool.imap_unordered(
             _compute_min_hash,
             dataset_iterator
@@ -68,6 +61,25 @@ def minhash_iter(dataset_iterator):
                 yield data
 
 
+def open_signature_store(path):
+    return SignatureStore(path, num_perm=NUM_HASH_FUNCTIONS, shingling=SHINGLING)
+
+
+def build_signature_store(data_path, store):
+    """
+    Hash every sample of `data_path` into `store`, one chunk at a time
+    """
+    ids, signatures = [], []
+    with open(data_path, 'r') as file:
+        for sample_id, min_hash in tqdm(minhash_iter(file), desc="Hashing"):
+            ids.append(sample_id)
+            signatures.append(min_hash)
+            if len(ids) >= STORE_CHUNK_SIZE:
+                store.append(ids, signatures)
+                ids, signatures = [], []
+    store.append(ids, signatures)
+
+
 def parse_args():
     parser = ArgumentParser(description='merge dataset')
     parser.add_argument(
@@ -82,6 +94,12 @@ def parse_args():
         type=str,
         help="path to dataset #2",
     )
+    parser.add_argument(
+        "--data_store",
+        type=str,
+        default=None,
+        help="signature store of dataset #1, built on first use and reused afterwards",
+    )
     parser.add_argument(
         "--save_name",
         type=str,
@@ -95,36 +113,55 @@ def parse_args():
         default=0.85,
         help="Jaccard Threshold",
     )
+    parser.add_argument(
+        "--bands",
+        type=int,
+        default=None,
+        help="Number of LSH bands (derived from threshold by default)",
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=None,
+        help="Number of signature rows per LSH band (derived from threshold by default)",
+    )
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     opt = parse_args()
     
-    # First load all data in target path into 
-    target_hash = []
+    # First index all data in target path by LSH bands
+    index = LSHIndex(opt.threshold, num_perm=NUM_HASH_FUNCTIONS, bands=opt.bands, rows=opt.rows)
     print("Load target set", opt.target_path)
     with open(opt.target_path, 'r') as file:
-        dataset = list(file)
-        for _, min_hash in tqdm(minhash_iter(dataset), total=len(dataset)):
-            target_hash.append(min_hash)
-    print("Done load target set | Length:", len(dataset))
+        for target_idx, (_, min_hash) in enumerate(tqdm(minhash_iter(file), desc="Hashing")):
+            index.insert(target_idx, min_hash)
+    print("Done load target set | Length:", len(index), "| LSH bands x rows:", index.bands, "x", index.rows)
             
             
-    # Cal minhash and compare
-    print("Load dataset")
-    chunk_size = 100000
+    # Cal minhash and compare with the targets sharing a band bucket only
     writer = open(f'./{opt.save_name}_deduplicate.jsonl', "w")
-    with open(opt.data_path, 'r') as file:
-        dataset = list(file)
-        duplicate_list = []
-        for index, min_hash in tqdm(minhash_iter(dataset), total=len(dataset)):
-            for tgs in target_hash:
-                score = jaccard_similarity(min_hash, tgs)
-                if score > opt.threshold:
-                    duplicate_list.append(index)
+    duplicate_list = []
+    if opt.data_store:
+        store = open_signature_store(opt.data_store)
+        if not store.is_complete(opt.data_path):
+            print("Build signature store", opt.data_store)
+            store.clear()
+            build_signature_store(opt.data_path, store)
+            store.mark_complete(opt.data_path)
+        print("Load signature store", opt.data_store, "| Length:", len(store))
+        for sample_id, min_hash in tqdm(store, total=len(store)):
+            if index.query(min_hash):
+                duplicate_list.append(sample_id)
+    else:
+        # Lines are hashed as they are read, the dataset is never loaded whole
+        with open(opt.data_path, 'r') as file:
+            for sample_id, min_hash in tqdm(minhash_iter(file), desc="Querying"):
+                if index.query(min_hash):
+                    duplicate_list.append(sample_id)
 
     for item in duplicate_list:
         json.dump({'id': item}, writer)
         writer.write('\n')
-    
\ No newline at end of file
+    writer.close()
@@ -0,0 +1,293 @@
+"""
+Exact deduplication keyed by the SHA-256 sample id given by `merge.py`.
+
+Only a 16-byte truncated digest and the line number of each sample are kept:
+1. Samples are streamed and (digest, line) records are appended to shard
+   files on disk, the shard being given by the first two digest bytes.
+2. Each shard is loaded and sorted alone, all but the first line of each
+   digest are marked in a duplicate bitmap (1 bit per line), and the sorted
+   unique digests are kept as the on-disk index (see `DigestSet`).
+3. Samples are streamed again and the non-duplicates are written out.
+RAM is bounded by one shard and the bitmap, whatever the dataset size. Both
+passes read the file in binary mode and split lines on b"\n" only, so their
+line numbers always agree.
+"""
+import os
+import csv
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+from typing import Optional
+
+import numpy as np
+from tqdm import tqdm
+
+
+DIGEST_SIZE = 16
+RECORD = np.dtype([('digest', f'V{DIGEST_SIZE}'), ('line', '<u8')])
+# At most 2^16 shards
+NUM_SHARDS = 256
+# Lines read before records are flushed to the shard files
+FLUSH_SIZE = 1 << 20
+ID_KEY = '"id": "'
+SHA256_HEX_SIZE = 64
+SHARD_FILE = 'shard_{:03d}.bin'
+# Sorted unique digests of a shard, all their high keys then all their low keys
+DIGEST_FILE = 'digests_{:03d}.bin'
+KEY_DTYPE = np.dtype('<u8')
+DIGEST_GLOB = 'digests_*.bin'
+
+
+def extract_id(line: str) -> Optional[str]:
+    """
+    Read the SHA-256 `id` of a JSONL sample without parsing the whole line.
+    The key cannot occur inside a JSON string value (quotes are escaped),
+    the last one is the top-level `id` appended by `merge.py`.
+    """
+    position = line.rfind(ID_KEY)
+    if position != -1:
+        start = position + len(ID_KEY)
+        sample_id = line[start:start + SHA256_HEX_SIZE]
+        if line[start + SHA256_HEX_SIZE:start + SHA256_HEX_SIZE + 1] == '"':
+            return sample_id
+    try:
+        return json.loads(line).get('id')
+    except Exception:
+        return None
+
+
+def sample_digest(line: str) -> Optional[bytes]:
+    """
+    16-byte digest of a sample, its SHA-256 id truncated (or the SHA-256 of
+    its code if it has no id yet, as `merge.py` would give)
+    """
+    sample_id = extract_id(line)
+    if sample_id is not None:
+        try:
+            return bytes.fromhex(sample_id[:2 * DIGEST_SIZE])
+        except ValueError:
+            pass
+    try:
+        code = json.loads(line)['code']
+    except Exception:
+        return None
+    return hashlib.sha256(code.encode()).digest()[:DIGEST_SIZE]
+
+
+def digest_keys(digests: np.ndarray):
+    """
+    Split `V16` digests into big-endian (high, low) uint64 sort keys
+    """
+    words = np.ascontiguousarray(digests).view('>u8').reshape(-1, 2).astype(np.uint64)
+    return words[:, 0], words[:, 1]
+
+
+def repeated_digests(digests: np.ndarray) -> np.ndarray:
+    """
+    Whether each `V16` digest already occurs earlier in `digests` (all
+    occurrences but the first of every digest)
+    """
+    high, low = digest_keys(digests)
+    order = np.lexsort((np.arange(len(digests)), low, high))
+    high, low = high[order], low[order]
+    repeated = np.zeros(len(digests), dtype=bool)
+    repeated[order[1:]] = (high[1:] == high[:-1]) & (low[1:] == low[:-1])
+    return repeated
+
+
+def write_shards(data_path: str, index_dir: str, num_shards: int = NUM_SHARDS, append: bool = False) -> int:
+    """
+    Append the (digest, line number) record of every sample to its shard file
+    (after the records already there if `append`)
+
+    Return:
+        Number of lines read
+    """
+    mode = 'ab' if append else 'wb'
+    shard_files = [open(os.path.join(index_dir, SHARD_FILE.format(shard)), mode) for shard in range(num_shards)]
+
+    def flush(digests, lines):
+        records = np.empty(len(lines), dtype=RECORD)
+        records['digest'] = np.frombuffer(b''.join(digests), dtype=RECORD['digest'])
+        records['line'] = lines
+        prefixes = np.frombuffer(b''.join(digests), dtype='>u2')[::DIGEST_SIZE // 2]
+        shards = prefixes.astype(np.int64) % num_shards
+        order = np.argsort(shards, kind='stable')
+        bounds = np.searchsorted(shards[order], np.arange(num_shards + 1))
+        for shard in range(num_shards):
+            if bounds[shard] < bounds[shard + 1]:
+                records[order[bounds[shard]:bounds[shard + 1]]].tofile(shard_files[shard])
+
+    n_lines = 0
+    digests, lines = [], []
+    with open(data_path, 'rb') as file:
+        for line_number, line in enumerate(tqdm(file, desc="Hashing")):
+            n_lines = line_number + 1
+            digest = sample_digest(line.decode('utf-8', 'replace'))
+            if digest is None:
+                continue
+            digests.append(digest)
+            lines.append(line_number)
+            if len(lines) >= FLUSH_SIZE:
+                flush(digests, lines)
+                digests, lines = [], []
+    if lines:
+        flush(digests, lines)
+
+    for shard_file in shard_files:
+        shard_file.close()
+    return n_lines
+
+
+def dedup_shard(index_dir: str, shard: int, duplicate_bitmap: np.ndarray, report_writer=None):
+    """
+    Sort one shard, mark its duplicate lines and keep its sorted unique digests
+
+    Return:
+        (number of unique digests, number of duplicate lines)
+    """
+    shard_path = os.path.join(index_dir, SHARD_FILE.format(shard))
+    records = np.fromfile(shard_path, dtype=RECORD)
+    high, low = digest_keys(records['digest'])
+    order = np.lexsort((records['line'], low, high))
+    high, low, records = high[order], low[order], records[order]
+
+    is_first = np.ones(len(records), dtype=bool)
+    is_first[1:] = (high[1:] != high[:-1]) | (low[1:] != low[:-1])
+    duplicate_lines = records['line'][~is_first]
+    np.bitwise_or.at(duplicate_bitmap, duplicate_lines >> 3,
+                     np.left_shift(1, duplicate_lines & 7).astype(np.uint8))
+
+    first_positions = np.flatnonzero(is_first)
+    np.concatenate([high[first_positions], low[first_positions]]).astype(KEY_DTYPE).tofile(
+        os.path.join(index_dir, DIGEST_FILE.format(shard)))
+    os.remove(shard_path)
+
+    if report_writer is not None:
+        counts = np.diff(np.append(first_positions, len(records)))
+        for position, count in zip(first_positions[counts > 1], counts[counts > 1]):
+            report_writer.writerow([records['digest'][position].tobytes().hex(), count])
+    return len(first_positions), len(duplicate_lines)
+
+
+def is_duplicate(duplicate_bitmap: np.ndarray, line: int) -> bool:
+    return bool(duplicate_bitmap[line >> 3] & (1 << (line & 7)))
+
+
+class DigestSet:
+    """
+    Read-only set of the unique sample digests kept in an index directory,
+    as sorted (high, low) uint64 keys per shard, memory-mapped: a lookup is a
+    binary search which only reads the pages it touches, RAM does not grow
+    with the number of samples
+    """
+    def __init__(self, index_dir: str):
+        self.shards = {}
+        self.num_shards = len(glob.glob(os.path.join(index_dir, DIGEST_GLOB)))
+        for shard in range(self.num_shards):
+            path = os.path.join(index_dir, DIGEST_FILE.format(shard))
+            n_digests = os.path.getsize(path) // (2 * KEY_DTYPE.itemsize)
+            if n_digests == 0:
+                keys = np.zeros((2, 0), dtype=KEY_DTYPE)
+            else:
+                keys = np.memmap(path, dtype=KEY_DTYPE, mode='r', shape=(2, n_digests))
+            self.shards[shard] = (keys[0], keys[1])
+
+    def __len__(self):
+        return sum(len(high) for high, _ in self.shards.values())
+
+    def contains(self, digests: np.ndarray) -> np.ndarray:
+        """
+        Whether each of the `V16` digests is in the set
+        """
+        high, low = digest_keys(digests)
+        shards = (high >> np.uint64(48)).astype(np.int64) % max(self.num_shards, 1)
+        found = np.zeros(len(digests), dtype=bool)
+        for shard, (shard_high, shard_low) in self.shards.items():
+            positions = np.flatnonzero(shards == shard)
+            if len(positions) == 0 or len(shard_high) == 0:
+                continue
+            start = np.searchsorted(shard_high, high[positions], side='left')
+            end = np.searchsorted(shard_high, high[positions], side='right')
+            single = end - start == 1
+            found[positions[single]] = shard_low[start[single]] == low[positions[single]]
+            # Several digests sharing a high key are adjacent, check each of them
+            for position, first, last in zip(positions[end - start > 1].tolist(), start[end - start > 1].tolist(),
+                                             end[end - start > 1].tolist()):
+                found[position] = bool(np.any(shard_low[first:last] == low[position]))
+        return found
+
+    def __contains__(self, sample_id: str) -> bool:
+        digest = bytes.fromhex(sample_id[:2 * DIGEST_SIZE])
+        high, low = self.shards[int.from_bytes(digest[:2], 'big') % self.num_shards]
+        key_high = int.from_bytes(digest[:8], 'big')
+        key_low = int.from_bytes(digest[8:], 'big')
+        start = np.searchsorted(high, key_high, side='left')
+        end = np.searchsorted(high, key_high, side='right')
+        return bool(np.any(low[start:end] == key_low))
+
+
+def build_digest_set(data_paths: list, index_dir: str, num_shards: int = NUM_SHARDS) -> DigestSet:
+    """
+    Sorted on-disk index of the unique sample digests of several JSONL files
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    n_lines = 0
+    for file_idx, data_path in enumerate(data_paths):
+        n_lines = max(n_lines, write_shards(data_path, index_dir, num_shards, append=file_idx > 0))
+    if not data_paths:
+        write_shards(os.devnull, index_dir, num_shards)
+    duplicate_bitmap = np.zeros((n_lines + 7) // 8, dtype=np.uint8)
+    for shard in range(num_shards):
+        dedup_shard(index_dir, shard, duplicate_bitmap)
+    return DigestSet(index_dir)
+
+
+def exact_deduplicate(data_path: str, save_path: str, index_dir: str,
+                      report_path: str = None, num_shards: int = NUM_SHARDS):
+    os.makedirs(index_dir, exist_ok=True)
+    n_lines = write_shards(data_path, index_dir, num_shards)
+
+    duplicate_bitmap = np.zeros((n_lines + 7) // 8, dtype=np.uint8)
+    n_unique, n_duplicate = 0, 0
+    report_file = open(report_path, 'w', newline='') if report_path else None
+    report_writer = csv.writer(report_file) if report_file else None
+    if report_writer:
+        report_writer.writerow(['ID Prefix', 'Count'])
+    for shard in tqdm(range(num_shards), desc="Sorting shards"):
+        shard_unique, shard_duplicate = dedup_shard(index_dir, shard, duplicate_bitmap, report_writer)
+        n_unique += shard_unique
+        n_duplicate += shard_duplicate
+    if report_file:
+        report_file.close()
+
+    with open(data_path, 'rb') as file, open(save_path, 'wb') as writer:
+        for line_number, line in enumerate(tqdm(file, desc="Writing")):
+            if not is_duplicate(duplicate_bitmap, line_number):
+                writer.write(line)
+
+    print(f"Samples: {n_lines} | Unique: {n_unique} | Duplicates removed: {n_duplicate}")
+    return n_unique, n_duplicate
+
+
+def args_parse():
+    parser = argparse.ArgumentParser(description='Exact deduplication by sample id')
+    parser.add_argument('--data_path', type=str, help='Input JSONL file')
+    parser.add_argument('--save_path', type=str, help='Deduplicated JSONL file')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='Directory of the sorted digest index (default: <save_path>.index)')
+    parser.add_argument('--report_path', type=str, default=None,
+                        help='CSV of the duplicated ids and their number of occurrences')
+    parser.add_argument('--num_shards', type=int, default=NUM_SHARDS, help='Number of on-disk shards')
+    parser.add_argument('--keep_index', action='store_true', help='Keep the digest index after deduplication')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = args_parse()
+    index_dir = opt.index_dir or f"{opt.save_path}.index"
+    exact_deduplicate(opt.data_path, opt.save_path, index_dir, opt.report_path, opt.num_shards)
+    if not opt.keep_index:
+        shutil.rmtree(index_dir)
@@ -1,60 +1,213 @@
-from datasets import load_dataset
-from codetext.parser import *
-from codetext.parser.language_parser import tokenize_code
-from codetext.utils import parse_code
+"""
+Flatten local benchmark files (HumanEval-X, APPS, CodeSearchNet test sets, ...)
+into `id/docstring/code/code_tokens` reference JSONL used by deduplication.
+
+Benchmark files are read from disk (`.jsonl` or `.jsonl.gz`), the language of
+a file is taken from its path (e.g. `humaneval-x/data/cpp/data/humaneval.jsonl.gz`).
+All languages are flattened in one run, in a process pool, each worker keeps
+one tree-sitter parser per language.
+"""
+import os
+import gzip
+import glob
 import json
+import argparse
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Optional, Tuple
+
 from tqdm import tqdm
+from tree_sitter import Parser, Language
+from codetext.utils import build_language
+from codetext.parser import CppParser, CsharpParser, GoParser, JavaParser, JavascriptParser, \
+    PhpParser, PythonParser, RubyParser, RustParser
+from codetext.parser.language_parser import get_node_text, tokenize_code
 
 
-# HumanEval
-language = 'javascript'
-fail = 0
-humaneval = load_dataset("THUDM/humaneval-x", 'js')
-humaneval_test = humaneval['test']
-
-dataset = []
-
-if language == 'python':
-    parser = PythonParser
-elif language == 'go':
-    parser = GoParser
-elif language == 'js' or language == 'javascript':
-    parser = JavascriptParser
-elif language == 'java':
-    parser = JavaParser
-elif language == 'cpp':
-    parser = CppParser
-
-for data in tqdm(humaneval_test, total=len(humaneval_test)):
-    idx = data['task_id']
-    code = data['declaration'] + data['canonical_solution'] # only for java
-    # docstring = data['prompt']
-    
-    node = parse_code(code, language).root_node
-    fn = parser.get_function_list(node)
-    
-    if len(fn) > 0:
-        node = fn[0]
-    docstring_node = parser.get_docstring_node(node)
-    # docstring = '\n'.join([get_node_text(_node) for _node in docstring_node])
-    if docstring_node:
-        docstring = get_node_text(docstring_node[0])
-    else:
-        docstring = data['prompt']
-    code_token = tokenize_code(node, code, docstring_node)
-    
-    dataset.append({
-        'id': idx, 
-        'docstring': docstring, 
+LANGUAGE_PARSERS = {
+    'python': PythonParser,
+    'java': JavaParser,
+    'javascript': JavascriptParser,
+    'go': GoParser,
+    'c': CppParser,
+    'cpp': CppParser,
+    'c_sharp': CsharpParser,
+    'ruby': RubyParser,
+    'rust': RustParser,
+    'php': PhpParser,
+}
+LANGUAGE_ALIASES = {'js': 'javascript', 'py': 'python', 'c++': 'cpp', 'c#': 'c_sharp', 'csharp': 'c_sharp'}
+TREE_SITTER_PATH = os.path.dirname(os.path.abspath(__file__))
+ID_FIELDS = ('task_id', 'problem_id', 'id')
+
+
+def normalize_language(name: str) -> Optional[str]:
+    name = name.lower()
+    name = LANGUAGE_ALIASES.get(name, name)
+    return name if name in LANGUAGE_PARSERS else None
+
+
+def infer_language(path: str) -> Optional[str]:
+    """
+    Language of a benchmark file, the deepest path component naming a language
+    """
+    for part in reversed(os.path.normpath(path).split(os.sep)):
+        for name in (part, part.split('.')[0], part.split('.')[0].split('_')[-1]):
+            language = normalize_language(name)
+            if language:
+                return language
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_parser(language: str, tree_sitter_path: str = TREE_SITTER_PATH) -> Parser:
+    """
+    Tree-sitter parser of `language`, built once per process
+    """
+    grammar = 'cpp' if language == 'c' else language
+    lang_path = os.path.join(tree_sitter_path, 'tree-sitter', f'{grammar}.so')
+    if not os.path.exists(lang_path):
+        build_language(grammar, tree_sitter_path)
+    parser = Parser()
+    parser.set_language(Language(lang_path, grammar))
+    return parser
+
+
+def get_codes(item: Dict) -> List[Tuple[Optional[int], str]]:
+    """
+    Reference codes of a benchmark sample, as (solution number, code): the
+    code of the sample (solution number None), or every solution of an APPS
+    problem. Empty if the sample has no code.
+    """
+    if 'code' in item:
+        return [(None, item['code'])]
+    if 'canonical_solution' in item:
+        # HumanEval-X style problems
+        return [(None, item.get('declaration', '') + item['canonical_solution'])]
+    if 'solutions' in item:
+        # APPS style problems, a JSON encoded list of solutions
+        solutions = item['solutions']
+        if isinstance(solutions, str):
+            try:
+                solutions = json.loads(solutions) if solutions.strip() else []
+            except ValueError:
+                return []
+        return [(number, code) for number, code in enumerate(solutions) if code]
+    return []
+
+
+def flatten_code(language: str, code: str, item: Dict, tree_sitter_path: str) -> Optional[Dict]:
+    """
+    Extract the first function of a code with its docstring and code tokens,
+    None if it cannot be parsed
+    """
+    language_parser = LANGUAGE_PARSERS[language]
+    try:
+        node = get_parser(language, tree_sitter_path).parse(bytes(code, 'utf8')).root_node
+        functions = language_parser.get_function_list(node)
+        if len(functions) > 0:
+            node = functions[0]
+        docstring_node = language_parser.get_docstring_node(node)
+        code_tokens = tokenize_code(node, code, docstring_node)
+        if docstring_node:
+            docstring = get_node_text(docstring_node[0])
+        else:
+            docstring = item.get('prompt', item.get('docstring', item.get('question', '')))
+    except Exception:
+        return None
+
+    return {
+        'docstring': docstring,
         'code': get_node_text(node),
-        'code_tokens': code_token
-    })
-    
-with open(f'./eval/{language}.jsonl', 'w') as writer:
-    for item in dataset:
-        json.dump(item, writer)
-        writer.write('\n')
-    
-# data_path = ""
-# for set_name in ['test', 'train']:
-    
\ No newline at end of file
+        'code_tokens': code_tokens,
+    }
+
+
+def flatten_sample(args: Tuple[str, Dict, str]) -> List[Dict]:
+    """
+    Flatten a benchmark sample into reference rows, one per solution of an
+    APPS problem (with ids `{problem_id}/{solution number}`)
+
+    Return:
+        The flattened rows, without the codes which cannot be parsed (they
+        are skipped, not the whole run), empty if the sample has no code
+    """
+    language, item, tree_sitter_path = args
+    idx = next((item[field] for field in ID_FIELDS if field in item), None)
+    samples = []
+    for number, code in get_codes(item):
+        sample = flatten_code(language, code, item, tree_sitter_path)
+        if sample is not None:
+            samples.append({'id': idx if number is None else f'{idx}/{number}', **sample})
+    return samples
+
+
+def read_benchmark(path: str) -> Iterator[Dict]:
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def list_benchmark_files(data_path: str) -> Iterator[Tuple[str, str]]:
+    """
+    (language, path) of every benchmark file under `data_path` (or `data_path` itself)
+    """
+    if os.path.isfile(data_path):
+        paths = [data_path]
+    else:
+        paths = sorted(glob.glob(os.path.join(data_path, '**', '*.jsonl'), recursive=True) +
+                       glob.glob(os.path.join(data_path, '**', '*.jsonl.gz'), recursive=True))
+    for path in paths:
+        language = infer_language(path)
+        if language is None:
+            print("Skip", path, "(unknown language)")
+            continue
+        yield language, path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Flatten benchmark files into reference sets')
+    parser.add_argument('--data_path', type=str, help='Benchmark file or dir of benchmark files')
+    parser.add_argument('--save_path', type=str, default='./eval', help='Dir to save <language>.jsonl')
+    parser.add_argument('--language', type=str, nargs='*', default=None, help='Only flatten these languages')
+    parser.add_argument('--tree_sitter_path', type=str, default=TREE_SITTER_PATH,
+                        help='Dir containing (or to build) `tree-sitter/<language>.so`')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+    languages = {normalize_language(language) for language in opt.language} if opt.language else None
+    os.makedirs(opt.save_path, exist_ok=True)
+
+    args = []
+    for language, path in list_benchmark_files(opt.data_path):
+        if languages is None or language in languages:
+            args.extend((language, item, opt.tree_sitter_path) for item in read_benchmark(path))
+
+    # Build missing grammars once, before workers race to build them
+    for language in {language for language, _, _ in args}:
+        get_parser(language, opt.tree_sitter_path)
+
+    writers, fail, n_rows = {}, 0, 0
+    with Pool(processes=opt.processes) as pool:
+        results = pool.imap(flatten_sample, args, chunksize=16)
+        for (language, _, _), samples in tqdm(zip(args, results), total=len(args)):
+            if not samples:
+                fail += 1
+                continue
+            if language not in writers:
+                writers[language] = open(os.path.join(opt.save_path, f'{language}.jsonl'), 'w')
+            for sample in samples:
+                json.dump(sample, writers[language])
+                writers[language].write('\n')
+            n_rows += len(samples)
+
+    for writer in writers.values():
+        writer.close()
+    print(f"Flattened {len(args) - fail} samples into {n_rows} reference rows "
+          f"({fail} skipped: no code or parse error) into", ", ".join(
+        os.path.join(opt.save_path, f'{language}.jsonl') for language in sorted(writers)))
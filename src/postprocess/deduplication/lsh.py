@@ -0,0 +1,102 @@
+"""
+Banded LSH index over MinHash signatures.
+
+A signature of `num_perm` values is cut into `bands` bands of `rows` values.
+Two samples become candidates when all values of at least one band are
+equal, which happens with probability 1 - (1 - s^rows)^bands for a Jaccard
+similarity s. Candidates are then verified on the full signatures, so only
+samples sharing a bucket are ever compared.
+"""
+from collections import defaultdict
+from typing import Hashable, List, Tuple
+
+import numpy as np
+
+from src.postprocess.deduplication.minhash import jaccard
+
+
+def _integrate(func, a: float, b: float, n_points: int = 101) -> float:
+    x = np.linspace(a, b, n_points)
+    y = func(x)
+    return float(np.sum((y[1:] + y[:-1]) * np.diff(x)) / 2)
+
+
+def optimal_param(threshold: float, num_perm: int,
+                  false_positive_weight: float = 0.5,
+                  false_negative_weight: float = 0.5) -> Tuple[int, int]:
+    """
+    Number of bands and rows per band minimizing the weighted probability of
+    false positives (similarity below `threshold` but sharing a bucket) and
+    false negatives (similarity above `threshold` but no shared bucket),
+    as chosen by `datasketch.MinHashLSH`
+
+    Return:
+        (bands, rows)
+    """
+    min_error = float('inf')
+    opt = (1, num_perm)
+    for bands in range(1, num_perm + 1):
+        max_rows = num_perm // bands
+        for rows in range(1, max_rows + 1):
+            false_positive = _integrate(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+            false_negative = _integrate(lambda s: 1 - (1 - (1 - s ** rows) ** bands), threshold, 1.0)
+            error = false_positive * false_positive_weight + false_negative * false_negative_weight
+            if error < min_error:
+                min_error = error
+                opt = (bands, rows)
+    return opt
+
+
+class LSHIndex:
+    """
+    Band buckets (band bytes -> row ids) plus the indexed signatures for verification
+    """
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, bands: int = None, rows: int = None):
+        if bands is None or rows is None:
+            bands, rows = optimal_param(threshold, num_perm)
+        if bands * rows > num_perm:
+            raise ValueError(f"bands * rows ({bands} * {rows}) exceeds num_perm ({num_perm})")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = rows
+        self.keys = []
+        self.signatures = []
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        bands = np.ascontiguousarray(signature[:self.bands * self.rows]).reshape(self.bands, self.rows)
+        return [band.tobytes() for band in bands]
+
+    def insert(self, key: Hashable, signature: np.ndarray):
+        if len(signature) != self.num_perm:
+            raise ValueError(f"Expecting signature with length {self.num_perm}, got {len(signature)}")
+        row_id = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        for bucket, band_key in zip(self.buckets, self._band_keys(signature)):
+            bucket[band_key].append(row_id)
+
+    def candidates(self, signature: np.ndarray) -> List[int]:
+        """
+        Row ids of indexed samples sharing at least one band bucket with `signature`
+        """
+        row_ids = set()
+        for bucket, band_key in zip(self.buckets, self._band_keys(signature)):
+            row_ids.update(bucket.get(band_key, ()))
+        return sorted(row_ids)
+
+    def query(self, signature: np.ndarray) -> List[Tuple[Hashable, float]]:
+        """
+        Return (key, estimated Jaccard similarity) of the indexed samples whose
+        similarity with `signature` is at least `threshold`
+        """
+        result = []
+        for row_id in self.candidates(signature):
+            score = jaccard(signature, self.signatures[row_id])
+            if score >= self.threshold:
+                result.append((self.keys[row_id], score))
+        return result
@@ -0,0 +1,68 @@
+"""
+Vectorized MinHash over NumPy arrays.
+
+Shingles come as 32-bit integer hashes (see `shingling.py`), all
+permutations (a * h + b) mod p are applied to the whole shingle array in one
+NumPy operation and reduced with a column-wise min. Permutation parameters are
+drawn exactly like `datasketch.MinHash` (seed 1, legacy universal hashing),
+so signatures are bit-identical to the ones it gives for the same hashes.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+
+# http://en.wikipedia.org/wiki/Mersenne_prime
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+SEED = 1
+
+
+class MinHasher:
+    """
+    `num_perm` universal hash functions h -> (a * h + b) mod p, truncated to 32 bits
+    """
+    def __init__(self, num_perm: int = 128, seed: int = SEED):
+        gen = np.random.RandomState(seed)
+        # Same draw order as `datasketch`, (a, b) pairs one permutation at a time
+        permutations = np.array([
+            (gen.randint(1, MERSENNE_PRIME, dtype=np.uint64),
+             gen.randint(0, MERSENNE_PRIME, dtype=np.uint64))
+            for _ in range(num_perm)
+        ], dtype=np.uint64).T
+        self.num_perm = num_perm
+        self.seed = seed
+        self.a, self.b = permutations
+
+    def _permute(self, hashes: np.ndarray) -> np.ndarray:
+        # uint64 products wrap around, exactly like `datasketch` does
+        values = np.outer(hashes, self.a)
+        values += self.b
+        # x mod (2^61 - 1) == (low 61 bits + high 3 bits), minus p at most once;
+        # much cheaper than NumPy's generic uint64 `%`
+        reduced = values & MERSENNE_PRIME
+        reduced += values >> np.uint64(61)
+        reduced[reduced >= MERSENNE_PRIME] -= MERSENNE_PRIME
+        return reduced & MAX_HASH
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        MinHash signature of one set of shingle hashes
+
+        Return:
+            uint32 array of shape (num_perm,), all `MAX_HASH` for an empty set
+        """
+        if len(hashes) == 0:
+            return np.full(self.num_perm, MAX_HASH, dtype=np.uint32)
+        return self._permute(hashes).min(axis=0).astype(np.uint32)
+
+@lru_cache(maxsize=None)
+def get_minhasher(num_perm: int = 128, seed: int = SEED) -> MinHasher:
+    return MinHasher(num_perm, seed)
+
+
+def jaccard(signature1: np.ndarray, signature2: np.ndarray) -> float:
+    """
+    Estimate the Jaccard similarity of two sets from their signatures
+    """
+    return float(np.count_nonzero(signature1 == signature2)) / len(signature1)
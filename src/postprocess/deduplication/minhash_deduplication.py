@@ -1,143 +1,239 @@
 import json
+import time
 import argparse
-from itertools import tee
+from collections import deque
 from tqdm import tqdm
-from typing import List, Iterable, Dict
-from datasketch import MinHash, MinHashLSH
+from typing import List, Iterable, Iterator, Dict
+import numpy as np
 import multiprocessing as mp
 
-def ngrams(sequence: List[str], n: int, min_ngram_size: int = 5) -> Iterable:
+from src.postprocess.deduplication.minhash import get_minhasher
+from src.postprocess.deduplication.shingling import shingle_hashes, shingling_name
+from src.postprocess.deduplication.lsh import LSHIndex
+from src.postprocess.deduplication.store import SignatureStore
+
+
+# Number of JSONL lines hashed by a worker at once
+CHUNK_SIZE = 10000
+# Chunks read ahead per worker
+MAX_PENDING_CHUNKS = 2
+
+# Read-only LSH index of the query workers (inherited, not copied, when forked)
+_query_index = None
+
+def get_sample_id(item: Dict):
+    for idx_name in ("id", "task_id", "problem_id"):
+        if idx_name in item:
+            return item[idx_name]
+    return None
+
+
+def hash_lines(lines: List[str], ngram: int, num_perm: int = 128, normalize: bool = False) -> Iterator:
     """
-    Code taken from NLTK, without padding.
+    MinHash every JSONL line of a chunk, over the hashed token n-grams of
+    `shingle_hashes` (identifiers and literals normalized if `normalize`)
+
+    Yields
+    ------
+    Tuple[int, dict, np.ndarray]
+        Offset of the line in the chunk, parsed sample and signature, for
+        the samples which have at least one n-gram (samples without any
+        n-gram would all share the same empty signature)
+    """
+    hasher = get_minhasher(num_perm)
+    for offset, line in enumerate(lines):
+        try:
+            item = json.loads(line)
+        except Exception:
+            continue
+        hashes = shingle_hashes(item['code_tokens'], ngram, normalize)
+        if len(hashes) > 0:
+            yield offset, item, hasher.signature(hashes)
 
-    Parameters
-    ----------
-    sequence : list
-        The sequence of items to be converted into n-grams.
-    n : int
-        The order of the n-grams to be extracted.
-    min_ngram_size : int
-        The minimum number of items in the sequence to generate n-grams.
+
+def calculate_minhash_chunk(lines: List[str], ngram: int, num_perm: int = 128, normalize: bool = False):
+    """
+    Hash a chunk of JSONL lines (run inside a worker)
 
     Returns
     -------
-    Iterable
-        The n-grams generated from the sequence.
-
-    Examples
-    --------
-    >>> list(ngrams(['a', 'b', 'c', 'd'], 2))
-    [('a', 'b'), ('b', 'c'), ('c', 'd')]
-    >>> list(ngrams(['a', 'b', 'c', 'd'], 3))
-    [('a', 'b', 'c'), ('b', 'c', 'd')]
+    Tuple[list, np.ndarray]
+        Ids and (n, num_perm) signature matrix of the samples which have
+        an id and at least one n-gram
     """
-    if len(sequence) < min_ngram_size:
-        return []
-    
-    iterables = tee(sequence, n)
-    for i, sub_iterable in enumerate(iterables):
-        for _ in range(i):
-            next(sub_iterable, None)
-    return zip(*iterables)
-
-
-def calculate_minhash(idx, tokens, num_perm=128):
-    set_token = set(tokens)
-    minhash = MinHash(num_perm=num_perm)
-    for t in set_token:
-        minhash.update(t.encode("utf8"))
-    
-    return (idx, minhash)
+    ids, signatures = [], []
+    for _, item, signature in hash_lines(lines, ngram, num_perm, normalize):
+        idx = get_sample_id(item)
+        if idx is not None:
+            ids.append(idx)
+            signatures.append(signature)
+    return ids, np.array(signatures, dtype=np.uint32).reshape(-1, num_perm)
 
 
-def calculate_minhash_iter(dataset, ngram):
-    args = []
-    for item in dataset:
-        try:
-            item = json.loads(item)
-        except Exception:
-            continue
-        
-        if 'id' in item:
-            idx_name = "id"
-        elif 'task_id' in item:
-            idx_name = "task_id"
-        elif 'problem_id' in item:
-            idx_name = "problem_id"
-            
-        idx = item[idx_name]
-        content = item['code_tokens']
-        args.append((idx, [" ".join(t) for t in ngrams(content, ngram)]))
-
-    hash_result = []
-    with mp.Pool() as p:
-        # with tqdm(total=len(args)) as pbar:
-        hash_result = p.starmap(calculate_minhash, tqdm(args, total=len(args)))
-                # hash_result.append(res)
-                # pbar.update()
-            # hash_result = p.starmap(calculate_minhash, args)
-    
-    return hash_result
+def read_chunks(dataset: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    chunk = []
+    for line in dataset:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
+def imap_bounded(pool, func, args_iter: Iterable, max_pending: int = None) -> Iterator:
+    """
+    Like `pool.starmap` but lazy: yield results in order while keeping at
+    most `max_pending` tasks read ahead (`MAX_PENDING_CHUNKS` per CPU by
+    default). `Pool.imap` would read and queue the whole input at once.
+    """
+    if max_pending is None:
+        max_pending = MAX_PENDING_CHUNKS * mp.cpu_count()
+    pending = deque()
+    for args in args_iter:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-def insert_minhash_lsh(hash_dict: Dict, threshold: float = 0.7, num_perm: int = 128):
-    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
 
-    for idx, val in hash_dict.items():
-        lsh.insert(idx, val)
-    
-    return lsh
+def calculate_minhash_iter(dataset: Iterable[str], ngram: int, num_perm: int = 128,
+                           pool=None, chunk_size: int = CHUNK_SIZE, normalize: bool = False):
+    """
+    Stream MinHash signatures of a JSONL dataset, chunk by chunk in order.
+    Chunks are hashed in `pool` (a new pool if None) with a bounded read
+    ahead, so memory is bounded by a few chunks of raw lines whatever the
+    dataset size.
+
+    Yields
+    ------
+    Tuple[list, np.ndarray]
+        Ids and signature matrix of one chunk
+    """
+    if pool is None:
+        with mp.Pool() as pool:
+            yield from calculate_minhash_iter(dataset, ngram, num_perm, pool, chunk_size, normalize)
+        return
+
+    args_iter = ((chunk, ngram, num_perm, normalize) for chunk in read_chunks(dataset, chunk_size))
+    yield from imap_bounded(pool, calculate_minhash_chunk, args_iter)
+
+
+def open_signature_store(path: str, num_perm: int = 128, ngram: int = 3, normalize: bool = False):
+    return SignatureStore(path, num_perm=num_perm, shingling=shingling_name(ngram, normalize))
+
+
+def _init_query_worker(index: LSHIndex):
+    global _query_index
+    _query_index = index
+
+
+def query_chunk(lines: List[str], ngram: int, num_perm: int = 128, normalize: bool = False):
+    """
+    Hash a chunk of target lines and query them against the shared index
+    (run inside a worker of the query pool)
+
+    Returns
+    -------
+    Tuple[int, list]
+        Number of hashed samples and (id, matched source ids) of the
+        duplicated ones
+    """
+    ids, signatures = calculate_minhash_chunk(lines, ngram, num_perm, normalize)
+    matches = []
+    for idx, val in zip(ids, signatures):
+        res = [key for key, _ in _query_index.query(val)]
+        if res:
+            matches.append((idx, res))
+    return len(ids), matches
 
 
 def deduplicate(
-    set1: List, 
-    set2: List, 
+    set1: Iterable[str], 
+    set2: Iterable[str], 
     threshold: float, 
     num_perm: int = 128, 
     ngram: int = 3,
-    save_name: str = "deduplicate_info.jsonl"):
+    save_name: str = "deduplicate_info.jsonl",
+    source_store: str = None,
+    chunk_size: int = CHUNK_SIZE,
+    normalize: bool = False):
     """
     Compare duplicate sample in set1 and set2.
     We consider set1 as source set and compare each sample in set1 (which should
     large than the other) and set2 as target set.
     The output is list of duplicated sample of set1 correspond with
     the duplicated sample of set2.
+
+    Both sets are streamed: set1 is hashed chunk by chunk into the LSH index,
+    then set2 is hashed and queried chunk by chunk by forked workers sharing
+    the read-only index, and each match is written as soon as it is found. Memory is bounded by the index, not by the raw JSON lines.
     
     Parameters
     ----------
-    set1 : list
-        The sequence of items to be converted into n-grams.
-    set2 : int
-        The order of the n-grams to be extracted.
+    set1 : Iterable[str]
+        JSONL lines of the source set (e.g. an open file)
+    set2 : Iterable[str]
+        JSONL lines of the target set
     num_perm : int
         The number of permutation for minhash function
     ngram: int
-        The order of the n-grams to be extracted (for `ngrams` function)
+        The order of the token n-gram shingles (see `shingle_hashes`)
+    source_store: str
+        Signature store of set1, built on first use and reused by later runs
+        (set1 is not read again once the store is complete, unless set1 is a
+        file which changed since)
+    chunk_size: int
+        Number of lines hashed by a worker at once
+    normalize: bool
+        Normalize identifiers and literals to also catch renamed clones
     """
-        
-    print("Calculate MinHash for Source set")
-    set1_hash = calculate_minhash_iter(set1, ngram)
-    
-    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
-    for idx, val in set1_hash:
-        lsh.insert(idx, val)
-    
-    set2_hash = calculate_minhash_iter(set2, ngram)
-    duplicate_info = []
-    for idx, val in set2_hash:
-        res = lsh.query(val)
-        if res:
-            duplicate_info.append({'tgt': idx, 'src': res})
-            # duplicate_info[idx] = res
-    
-    if len(res) < 1:
-        print("Not find any duplicated sample")
+    lsh = LSHIndex(threshold=threshold, num_perm=num_perm)
+    store = open_signature_store(source_store, num_perm, ngram, normalize) if source_store else None
+    source = getattr(set1, 'name', None)
+    n_duplicate, n_queried = 0, 0
+
+    if store is not None and store.is_complete(source):
+        print("Load MinHash of Source set from", source_store)
+        for idx, val in tqdm(store, total=len(store)):
+            lsh.insert(idx, val)
     else:
-        # TODO: save duplicate_info as 
-        with open(f"./{save_name}", 'w') as writer:
-            for item in duplicate_info:
-                json.dump(item, writer)
+        print("Calculate MinHash for Source set")
+        if store is not None:
+            store.clear()
+        with mp.Pool() as pool, tqdm(unit=" samples") as pbar:
+            for ids, signatures in calculate_minhash_iter(set1, ngram, num_perm, pool, chunk_size, normalize):
+                if store is not None:
+                    store.append(ids, signatures)
+                for idx, val in zip(ids, signatures):
+                    lsh.insert(idx, val)
+                pbar.update(len(ids))
+        if store is not None:
+            store.mark_complete(source)
+
+    # The query pool is forked once the index is complete, every worker
+    # hashes and queries its own chunks against the shared read-only index
+    print("Query Target set")
+    start_time = time.time()
+    args_iter = ((chunk, ngram, num_perm, normalize) for chunk in read_chunks(set2, chunk_size))
+    with mp.Pool(initializer=_init_query_worker, initargs=(lsh,)) as pool, \
+            open(f"./{save_name}", 'w') as writer, tqdm(unit=" samples") as pbar:
+        for n_samples, matches in imap_bounded(pool, query_chunk, args_iter):
+            for idx, res in matches:
+                json.dump({'tgt': idx, 'src': res}, writer)
                 writer.write('\n')
+            n_duplicate += len(matches)
+            n_queried += n_samples
+            pbar.update(n_samples)
+            pbar.set_postfix(duplicates=n_duplicate)
+    elapsed = time.time() - start_time
+    print(f"Queried {n_queried} samples in {elapsed:.1f}s ({n_queried / max(elapsed, 1e-9):.0f} samples/s)")
+
+    if n_duplicate < 1:
+        print("Not find any duplicated sample")
+    else:
+        print("Found", n_duplicate, "duplicated samples, saved to", save_name)
 
 
 def args_parse():
@@ -148,6 +244,10 @@ def args_parse():
     parser.add_argument('--threshold', type=float, default=0.8, help='Threshold')
     parser.add_argument('--n_gram', type=int, default=3, help='Number of Ngrams')
     parser.add_argument('--save_name', type=str, default="deduplicate_info.jsonl")
+    parser.add_argument('--source_store', type=str, default=None,
+                        help='Signature store of the source set, reused once built from the same set1')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of samples hashed at once')
+    parser.add_argument('--normalize', action='store_true', help='Normalize identifiers and literals')
     opt = parser.parse_args()
     return opt
 
@@ -157,9 +257,6 @@ if __name__ == '__main__':
     mp.set_start_method("fork")
     
     print("Deduplication for", opt.set1)
-    with open(opt.set1, 'r') as file1:
-        src = list(file1)
-    with open(opt.set2, 'r') as file2:
-        tgt = list(file2)
-        
-    deduplicate(src, tgt, opt.threshold, opt.num_perm, opt.n_gram, opt.save_name)
+    with open(opt.set1, 'r') as src, open(opt.set2, 'r') as tgt:
+        deduplicate(src, tgt, opt.threshold, opt.num_perm, opt.n_gram, opt.save_name,
+                    opt.source_store, opt.chunk_size, opt.normalize)
@@ -0,0 +1,288 @@
+"""
+Corpus-wide near-deduplication.
+
+1. Every sample is hashed (token n-grams, MinHash) into a signature store,
+   together with its line number and stars count.
+2. Each LSH band is bucketed in its own process: rows are sorted by a 64-bit
+   key of their band values, rows sharing a key (a bucket) are candidate
+   pairs (see `bucket_candidates`), kept if their estimated Jaccard
+   similarity reaches the threshold.
+3. Pairs are merged with union-find and only the sample with the most stars
+   of each cluster is written out.
+"""
+import argparse
+import multiprocessing as mp
+from typing import List
+
+import numpy as np
+from tqdm import tqdm
+
+from src.postprocess.deduplication.lsh import optimal_param
+from src.postprocess.deduplication.minhash_deduplication import CHUNK_SIZE, hash_lines, imap_bounded, \
+    read_chunks
+from src.postprocess.deduplication.shingling import shingling_name
+from src.postprocess.deduplication.store import SignatureStore
+
+
+STARS_FIELD = 'stars_count'
+# Store id of a sample: its line number and stars count
+ROW_DTYPE = np.dtype([('line', '<i8'), ('stars', '<i8')])
+# Signature rows compared at once when verifying candidate pairs
+VERIFY_BATCH = 1 << 16
+# Buckets up to this size have all their pairs verified
+MAX_ALL_PAIRS_BUCKET = 16
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+class UnionFind:
+    """
+    Disjoint sets over 0..n-1, the root of a set is its smallest element
+    """
+    def __init__(self, n: int):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def find(self, x: int) -> int:
+        parent = self.parent
+        while parent[x] != x:
+            # Path halving
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x: int, y: int):
+        root_x, root_y = self.find(x), self.find(y)
+        if root_x < root_y:
+            self.parent[root_y] = root_x
+        elif root_y < root_x:
+            self.parent[root_x] = root_y
+
+    def roots(self) -> np.ndarray:
+        """
+        Root of every element, fully compressing the forest
+        """
+        parent = self.parent
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                return parent
+            parent[:] = grand_parent
+
+
+def open_near_dedup_store(path: str, num_perm: int = 128, ngram: int = 3, normalize: bool = False):
+    return SignatureStore(path, num_perm=num_perm, shingling=shingling_name(ngram, normalize), id_dtype=ROW_DTYPE)
+
+
+def stars_count(value) -> int:
+    """
+    Stars count of a sample as an int (given as a number or a string), 0 if missing or invalid
+    """
+    try:
+        return int(float(str(value).replace(',', '')))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def hash_chunk(start: int, lines: List[str], ngram: int, num_perm: int,
+               stars_field: str = STARS_FIELD, normalize: bool = False):
+    """
+    Hash a chunk of JSONL lines starting at line number `start` (run inside a worker)
+
+    Return:
+        `ROW_DTYPE` ids and signature matrix of the samples which have at
+        least one n-gram (the others are never deduplicated)
+    """
+    ids, signatures = [], []
+    for offset, item, signature in hash_lines(lines, ngram, num_perm, normalize):
+        ids.append((start + offset, stars_count(item.get(stars_field))))
+        signatures.append(signature)
+    return np.array(ids, dtype=ROW_DTYPE), np.array(signatures, dtype=np.uint32).reshape(-1, num_perm)
+
+
+def build_store(data_path: str, store: SignatureStore, ngram: int, pool, chunk_size: int = CHUNK_SIZE,
+                stars_field: str = STARS_FIELD, normalize: bool = False):
+    def args_iter(file):
+        start = 0
+        for chunk in read_chunks(file, chunk_size):
+            yield start, chunk, ngram, store.num_perm, stars_field, normalize
+            start += len(chunk)
+
+    with open(data_path, 'r') as file, tqdm(desc="Hashing", unit=" samples") as pbar:
+        for ids, signatures in imap_bounded(pool, hash_chunk, args_iter(file)):
+            store.append(ids, signatures)
+            pbar.update(len(ids))
+
+
+def band_keys(band_values: np.ndarray) -> np.ndarray:
+    """
+    FNV-1a style 64-bit key of each row of a (n, rows) uint32 band
+    """
+    keys = np.full(len(band_values), FNV_OFFSET, dtype=np.uint64)
+    for column in band_values.T:
+        keys ^= column.astype(np.uint64)
+        keys *= FNV_PRIME
+    return keys
+
+
+def bucket_candidates(order: np.ndarray, sorted_keys: np.ndarray, max_all_pairs: int = MAX_ALL_PAIRS_BUCKET):
+    """
+    Candidate pairs of the buckets of sorted keys: all pairs of a bucket of
+    at most `max_all_pairs` members, else every member with the first one
+    (the bucket representative) and with its neighbour, so that one
+    dissimilar member cannot split a bucket
+
+    Return:
+        (left, right) arrays of positions
+    """
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    sizes = np.diff(np.append(starts, len(sorted_keys)))
+    left, right = [], []
+    for size in np.unique(sizes[(sizes > 1) & (sizes <= max_all_pairs)]).tolist():
+        bucket_starts = starts[sizes == size]
+        first, second = np.triu_indices(size, 1)
+        left.append(order[(bucket_starts[:, None] + first).ravel()])
+        right.append(order[(bucket_starts[:, None] + second).ravel()])
+
+    large = sizes > max_all_pairs
+    if large.any():
+        # Positions of the members after the first one in the large buckets
+        members = np.concatenate([np.arange(start + 1, start + size)
+                                  for start, size in zip(starts[large].tolist(), sizes[large].tolist())])
+        left.append(order[np.repeat(starts[large], sizes[large] - 1)])
+        right.append(order[members])
+        neighbours = members[members - 1 != np.repeat(starts[large], sizes[large] - 1)]
+        left.append(order[neighbours - 1])
+        right.append(order[neighbours])
+
+    if not left:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(left), np.concatenate(right)
+
+
+def band_pairs(store: SignatureStore, band: int, rows: int, threshold: float) -> np.ndarray:
+    """
+    Verified candidate pairs of one LSH band (run inside a worker)
+
+    Return:
+        (n_pairs, 2) array of store positions
+    """
+    signatures = store.signatures()
+    keys = band_keys(np.asarray(signatures[:, band * rows:(band + 1) * rows]))
+    order = np.argsort(keys, kind='stable')
+    left, right = bucket_candidates(order, keys[order])
+
+    min_equal = threshold * store.num_perm
+    verified = np.zeros(len(left), dtype=bool)
+    for start in range(0, len(left), VERIFY_BATCH):
+        end = start + VERIFY_BATCH
+        n_equal = np.count_nonzero(signatures[left[start:end]] == signatures[right[start:end]], axis=1)
+        verified[start:end] = n_equal >= min_equal
+    return np.stack([left[verified], right[verified]], axis=1)
+
+
+def _band_pairs(args):
+    store_path, store_params, band, rows, threshold = args
+    return band_pairs(SignatureStore(store_path, **store_params), band, rows, threshold)
+
+
+def cluster(store: SignatureStore, threshold: float, pool, bands: int = None, rows: int = None):
+    """
+    Union-find clustering of the verified candidate pairs of every band
+
+    Return:
+        Root (cluster id) of each store position
+    """
+    if bands is None or rows is None:
+        bands, rows = optimal_param(threshold, store.num_perm)
+    print("LSH bands x rows:", bands, "x", rows)
+
+    # One band per task, workers read the memory-mapped signatures themselves
+    args = [(store.path, store.params, band, rows, threshold) for band in range(bands)]
+    pairs = list(tqdm(pool.imap_unordered(_band_pairs, args), total=bands, desc="Bucketing"))
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+    # The same pair is usually found by several bands
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+    print("Candidate pairs:", len(pairs))
+
+    union_find = UnionFind(len(store))
+    for x, y in tqdm(pairs.tolist(), desc="Clustering"):
+        union_find.union(x, y)
+    return union_find.roots()
+
+
+def select_duplicates(roots: np.ndarray, stars: np.ndarray) -> np.ndarray:
+    """
+    Positions to remove: all but the most starred (then first) sample of each cluster
+    """
+    positions = np.arange(len(roots))
+    order = np.lexsort((positions, -stars, roots))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = roots[order][1:] != roots[order][:-1]
+    return np.sort(order[~is_first])
+
+
+def near_deduplicate(
+    data_path: str,
+    save_path: str,
+    store_path: str,
+    threshold: float = 0.85,
+    num_perm: int = 128,
+    ngram: int = 3,
+    chunk_size: int = CHUNK_SIZE,
+    stars_field: str = STARS_FIELD,
+    bands: int = None,
+    rows: int = None,
+    normalize: bool = False,
+):
+    store = open_near_dedup_store(store_path, num_perm, ngram, normalize)
+    with mp.Pool() as pool:
+        # A store left half-built or built from another file is rebuilt
+        if not store.is_complete(data_path):
+            store.clear()
+            build_store(data_path, store, ngram, pool, chunk_size, stars_field, normalize)
+            store.mark_complete(data_path)
+        print("Signatures:", len(store))
+        roots = cluster(store, threshold, pool, bands, rows)
+
+    ids = store.ids()
+    duplicate_lines = ids['line'][select_duplicates(roots, ids['stars'])]
+    is_duplicate = np.zeros(int(ids['line'].max(initial=-1)) + 1, dtype=bool)
+    is_duplicate[duplicate_lines] = True
+
+    n_kept = 0
+    with open(data_path, 'r') as file, open(save_path, 'w') as writer:
+        for row, line in enumerate(tqdm(file, desc="Writing")):
+            if row < len(is_duplicate) and is_duplicate[row]:
+                continue
+            writer.write(line)
+            n_kept += 1
+    print(f"Removed {len(duplicate_lines)} near-duplicates, kept {n_kept} samples in {save_path}")
+
+
+def args_parse():
+    parser = argparse.ArgumentParser(description='Near-deduplicate a dataset against itself')
+    parser.add_argument('--data_path', type=str, help='Input JSONL file')
+    parser.add_argument('--save_path', type=str, help='Deduplicated JSONL file')
+    parser.add_argument('--signature_store', type=str, default=None,
+                        help='Signature store directory, reused once built from the same data_path '
+                             '(default: <save_path>.signatures)')
+    parser.add_argument('--threshold', type=float, default=0.85, help='Jaccard threshold')
+    parser.add_argument('--num_perm', type=int, default=128, help='Number of permutation')
+    parser.add_argument('--n_gram', type=int, default=3, help='Number of Ngrams')
+    parser.add_argument('--bands', type=int, default=None, help='Number of LSH bands (derived from threshold by default)')
+    parser.add_argument('--rows', type=int, default=None, help='Rows per LSH band (derived from threshold by default)')
+    parser.add_argument('--stars_field', type=str, default=STARS_FIELD, help='Field used to pick the sample to keep')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of samples hashed at once')
+    parser.add_argument('--normalize', action='store_true', help='Normalize identifiers and literals')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = args_parse()
+    mp.set_start_method("fork")
+
+    near_deduplicate(
+        opt.data_path, opt.save_path, opt.signature_store or f"{opt.save_path}.signatures",
+        opt.threshold, opt.num_perm, opt.n_gram, opt.chunk_size, opt.stars_field, opt.bands, opt.rows,
+        opt.normalize
+    )
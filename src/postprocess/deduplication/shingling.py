@@ -0,0 +1,110 @@
+"""
+Token n-gram shingling over integer arrays.
+
+Each `code_tokens` token is mapped once (cached) to a 64-bit id, n-gram
+hashes are then computed with NumPy over the id array and fed to the MinHash
+engine as is, no n-gram string is ever built. Identifiers and literals can
+be normalized to catch clones which only rename variables or change
+constants.
+"""
+import re
+import hashlib
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+
+
+TOKEN_CACHE_SIZE = 1 << 20
+# Odd 64-bit multipliers (golden ratio and MurmurHash3 fmix64 constants)
+BASE = np.uint64(0x9e3779b97f4a7c15)
+MIX_1 = np.uint64(0xff51afd7ed558ccd)
+MIX_2 = np.uint64(0xc4ceb9fe1a85ec53)
+
+IDENTIFIER_TOKEN = 'ID'
+STRING_TOKEN = 'STR'
+NUMBER_TOKEN = 'NUM'
+IDENTIFIER_REGEX = re.compile(r'^[A-Za-z_$][A-Za-z0-9_$]*$')
+NUMBER_REGEX = re.compile(r'^[+-]?(0[xXbBoO][0-9a-fA-F_]+|(\d[\d_]*\.?[\d_]*|\.\d[\d_]*)([eE][+-]?\d+)?)[a-zA-Z]*$')
+STRING_QUOTES = ('"', "'", '`')
+# Keywords and common built-in names of the supported languages, kept as is
+# since they carry the structure of the code
+KEYWORDS = frozenset("""
+    abstract and as assert async await auto base bool boolean break byte case catch char checked class const
+    continue crate debug def default defer del delegate delete do double dyn elif else enum except explicit
+    export extends extern false final finally fixed float fn for foreach from func function global go goto if
+    impl implements import in instanceof int interface internal is lambda let long loop map match mod module
+    move mut namespace native new nil none None nonlocal not null object operator or out override package pass
+    private protected pub public raise range readonly ref register return select self Self short signed sizeof
+    static str string struct super switch synchronized template this throw throws trait transient true True
+    False try type typedef typeof uint union unsafe unsigned use using var virtual void volatile where while
+    with yield chan fallthrough unless until begin end elsif rescue ensure require echo print println len
+    include define ifdef ifndef endif
+""".split())
+
+
+def shingling_name(ngram: int, normalize: bool = False) -> str:
+    """
+    Name of the shingling scheme, recorded in signature stores
+    """
+    return f"token-ids-{ngram}gram" + ("-normalized" if normalize else "")
+
+
+def normalize_token(token: str) -> str:
+    if token in KEYWORDS:
+        return token
+    if token.startswith(STRING_QUOTES):
+        return STRING_TOKEN
+    if IDENTIFIER_REGEX.match(token):
+        return IDENTIFIER_TOKEN
+    if NUMBER_REGEX.match(token):
+        return NUMBER_TOKEN
+    return token
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def token_id(token: str, normalize: bool = False) -> int:
+    """
+    Stable 64-bit id of a token (Python's `hash` is salted per process)
+    """
+    if normalize:
+        token = normalize_token(token)
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+
+def token_ids(tokens: List[str], normalize: bool = False) -> np.ndarray:
+    return np.fromiter((token_id(token, normalize) for token in tokens), dtype=np.uint64, count=len(tokens))
+
+
+def ngram_hashes(ids: np.ndarray, n: int) -> np.ndarray:
+    """
+    32-bit hashes (as uint64) of all n-grams of a token id array, with
+    repeated n-grams removed
+
+    The n ids of each window are combined with a polynomial hash in one
+    vectorized pass per position, then mixed (MurmurHash3 finalizer) and
+    truncated to the 32 bits expected by the MinHash permutations.
+    """
+    n_windows = len(ids) - n + 1
+    if n_windows <= 0:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.full(n_windows, np.uint64(n), dtype=np.uint64)
+    for offset in range(n):
+        hashes *= BASE
+        hashes += ids[offset:offset + n_windows]
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= MIX_1
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= MIX_2
+    hashes ^= hashes >> np.uint64(33)
+    return np.unique(hashes >> np.uint64(32))
+
+
+def shingle_hashes(tokens: List[str], ngram: int, normalize: bool = False, min_ngram_size: int = 5) -> np.ndarray:
+    """
+    Hashed n-gram shingles of `code_tokens`, one per window of `ngram` tokens
+    (no shingle if there are fewer than `min_ngram_size` tokens)
+    """
+    if len(tokens) < min_ngram_size:
+        return np.empty(0, dtype=np.uint64)
+    return ngram_hashes(token_ids(tokens, normalize), ngram)
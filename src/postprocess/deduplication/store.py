@@ -0,0 +1,184 @@
+"""
+On-disk MinHash signature store, reusable across runs and reference sets.
+
+A store is a directory with
+    signatures.bin  raw uint32 matrix, one row of `num_perm` values per sample
+    ids.txt         one JSON encoded sample id per line, same order as the rows
+    ids.bin         or, for numeric ids (`id_dtype`), one raw record per row,
+                    memory-mapped like the signatures
+    meta.json       hashing parameters (num_perm, seed, shingling, ...), the
+                    number of committed rows and, once the build is finished,
+                    `complete` and the path, size and mtime of its source file
+
+Rows are appended in chunks and read back through `np.memmap`, so a corpus of
+tens of millions of signatures is hashed once and never loaded in RAM. A
+store is only reused when `is_complete` (for the same, unchanged source): a
+build killed halfway or a store of another file is rebuilt, see `clear`.
+"""
+import os
+import json
+from typing import Hashable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from src.postprocess.deduplication.minhash import SEED
+
+
+SIGNATURE_FILE = 'signatures.bin'
+ID_FILE = 'ids.txt'
+NUMERIC_ID_FILE = 'ids.bin'
+META_FILE = 'meta.json'
+
+
+def source_info(path: str) -> dict:
+    """
+    Path, size and mtime of a source file, which identify the data a store was built from
+    """
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def as_dtype(dtype) -> np.dtype:
+    """
+    Numpy dtype of a dtype or of its JSON form (`dtype_descr`)
+    """
+    if isinstance(dtype, list):
+        dtype = [tuple(field) for field in dtype]
+    return np.dtype(dtype)
+
+
+def dtype_descr(dtype):
+    """
+    JSON form of a (structured) numpy dtype, as read back from meta.json
+    """
+    return json.loads(json.dumps(np.lib.format.dtype_to_descr(as_dtype(dtype))))
+
+
+class SignatureStore:
+    """
+    Append-only signature matrix with a parallel id index
+
+    Args:
+        path: store directory, created if it does not exist
+        num_perm, seed, **params: hashing parameters, an existing store
+            must have been built with the same ones
+        id_dtype: numpy dtype of numeric ids (e.g. a structured record),
+            stored raw and read back memory-mapped instead of as JSON
+    """
+    def __init__(self, path: str, num_perm: int = 128, seed: int = SEED, id_dtype=None, **params):
+        self.path = path
+        self.params = {'num_perm': num_perm, 'seed': seed, **params}
+        self.num_perm = num_perm
+        self.id_dtype = as_dtype(id_dtype) if id_dtype is not None else None
+        self.params['id_dtype'] = dtype_descr(id_dtype) if id_dtype is not None else None
+        self.id_file = NUMERIC_ID_FILE if self.id_dtype is not None else ID_FILE
+
+        if os.path.exists(self._file(META_FILE)):
+            with open(self._file(META_FILE), 'r') as file:
+                self.meta = json.load(file)
+            stored_params = {key: self.meta.get(key) for key in self.params}
+            if stored_params != self.params:
+                raise ValueError(f"Signature store {path} was built with {stored_params}, "
+                                 f"expecting {self.params}")
+            self._recover()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.clear()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _write_meta(self):
+        # Write-then-rename, the meta file only ever describes fully written rows
+        tmp_path = self._file(META_FILE + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(tmp_path, self._file(META_FILE))
+
+    def _recover(self):
+        # Drop rows appended by an interrupted run after the last meta update
+        signature_size = self.meta['count'] * self.num_perm * 4
+        for name, size in ((SIGNATURE_FILE, signature_size), (self.id_file, self.meta['ids_size'])):
+            if os.path.getsize(self._file(name)) > size:
+                os.truncate(self._file(name), size)
+
+    def __len__(self):
+        return self.meta['count']
+
+    def clear(self):
+        """
+        Drop all rows, before the store is (re)built
+        """
+        self.meta = {**self.params, 'count': 0, 'ids_size': 0, 'complete': False, 'source': None}
+        open(self._file(SIGNATURE_FILE), 'wb').close()
+        open(self._file(self.id_file), 'wb').close()
+        self._write_meta()
+
+    def is_complete(self, source: str = None) -> bool:
+        """
+        Whether the build of the store finished (from `source` as it is now,
+        if given and the store recorded its source)
+        """
+        if not self.meta.get('complete'):
+            return False
+        if source is None or self.meta.get('source') is None:
+            return True
+        return os.path.exists(source) and self.meta['source'] == source_info(source)
+
+    def mark_complete(self, source: str = None):
+        """
+        Record that all samples (of the file `source`) were appended
+        """
+        self.meta['complete'] = True
+        self.meta['source'] = source_info(source) if source is not None else None
+        self._write_meta()
+
+    def append(self, ids: Union[List[Hashable], np.ndarray], signatures: np.ndarray):
+        """
+        Append a chunk of samples, `signatures` has one row per id (ids are
+        an array or a list of tuples of `id_dtype` for numeric ids)
+        """
+        signatures = np.ascontiguousarray(signatures, dtype=np.uint32).reshape(-1, self.num_perm)
+        if len(ids) != len(signatures):
+            raise ValueError(f"Got {len(ids)} ids for {len(signatures)} signatures")
+        if len(ids) == 0:
+            return
+
+        if self.id_dtype is not None:
+            id_lines = np.array(ids if isinstance(ids, np.ndarray) else [tuple(idx) for idx in ids],
+                                dtype=self.id_dtype).tobytes()
+        else:
+            id_lines = ''.join(json.dumps(sample_id) + '\n' for sample_id in ids).encode('utf-8')
+        with open(self._file(SIGNATURE_FILE), 'ab') as file:
+            file.write(signatures.tobytes())
+        with open(self._file(self.id_file), 'ab') as file:
+            file.write(id_lines)
+
+        self.meta['count'] += len(ids)
+        self.meta['ids_size'] += len(id_lines)
+        self.meta['complete'] = False
+        self._write_meta()
+
+    def signatures(self) -> np.ndarray:
+        """
+        Read-only memory-mapped (count, num_perm) uint32 matrix
+        """
+        if len(self) == 0:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+        return np.memmap(self._file(SIGNATURE_FILE), dtype=np.uint32, mode='r',
+                         shape=(len(self), self.num_perm))
+
+    def ids(self) -> Union[List[Hashable], np.ndarray]:
+        """
+        Sample ids, a read-only memory-mapped `id_dtype` array for numeric ids
+        """
+        if self.id_dtype is not None:
+            if len(self) == 0:
+                return np.empty(0, dtype=self.id_dtype)
+            return np.memmap(self._file(NUMERIC_ID_FILE), dtype=self.id_dtype, mode='r', shape=(len(self),))
+        with open(self._file(ID_FILE), 'rb') as file:
+            data = file.read(self.meta['ids_size'])
+        return [json.loads(line) for line in data.splitlines()]
+
+    def __iter__(self) -> Iterator[Tuple[Hashable, np.ndarray]]:
+        return zip(self.ids(), self.signatures())
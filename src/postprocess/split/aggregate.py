@@ -0,0 +1,229 @@
+"""
+Streaming per-repo aggregation of the split metadata.
+
+Metadata batches are buffered in memory and aggregated at once while they
+fit (`max_rows`). Past that, rows are spilled to disk in hash partitions of
+the repo name, so that every repo lands in a single partition, and each
+partition is then aggregated on its own. Memory is bounded by `max_rows`
+rows whatever the size of the metadata.
+
+Rows repeating the id of an earlier row are dropped first, through the same
+kind of spill: rows are buffered, or spilled in partitions of their id, and
+only the first row of each id is passed on to the repo aggregation.
+
+Given the stats sidecar of the merged file (aligned with the metadata rows),
+per-repo character and comment totals are aggregated along, read from the
+sidecar without decoding any sample.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+from typing import Iterator
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.postprocess.split.metadata import iter_metadata
+
+
+REPO_FIELDS = ['Repo Name', 'Count', 'Code Length Mean', 'Code Length Median', 'Docs Length Mean',
+               'Docs Length Median', 'Code Tokens', 'Docs Tokens']
+AGGREGATE_COLUMNS = ['Repo Name', 'Code Length', 'Docs Length']
+# Columns of the duplicate removal: the sample id and the row number
+DEDUP_COLUMNS = ['ID', 'Row']
+# Per-repo totals of the stats sidecar fields
+STATS_FIELDS = {'Code Chars': 'code_chars', 'Docs Chars': 'docstring_chars', 'Comments': 'comments'}
+# Rows aggregated in memory at once
+MAX_ROWS = 1 << 24
+NUM_PARTITIONS = 64
+
+
+def repo_partition(repo: str, num_partitions: int = NUM_PARTITIONS) -> int:
+    return int.from_bytes(hashlib.blake2b(repo.encode(), digest_size=4).digest(), 'little') % num_partitions
+
+
+def repo_partitions(batch: pa.RecordBatch, num_partitions: int) -> np.ndarray:
+    repos = batch['Repo Name']
+    if not pa.types.is_dictionary(repos.type):
+        repos = repos.dictionary_encode()
+    # One hash per distinct repo of the batch, then mapped to its rows
+    dictionary_partitions = np.array([repo_partition(repo, num_partitions)
+                                      for repo in repos.dictionary.to_pylist()], dtype=np.int64)
+    return dictionary_partitions[repos.indices.to_numpy(zero_copy_only=False)]
+
+
+def id_partitions(batch: pa.RecordBatch, num_partitions: int) -> np.ndarray:
+    ids = batch['ID']
+    if pa.types.is_fixed_size_binary(ids.type):
+        # SHA-256 ids, their first byte is uniform
+        width = ids.type.byte_width
+        data = np.frombuffer(ids.buffers()[1], dtype=np.uint8, offset=ids.offset * width, count=len(ids) * width)
+        return data[::width].astype(np.int64) % num_partitions
+    # Hex ids of the CSV metadata of older merges
+    return np.array([repo_partition(str(idx), num_partitions) for idx in ids.to_pylist()], dtype=np.int64)
+
+
+def first_occurrences(table: pa.Table) -> pa.Table:
+    """
+    Rows of a table holding every row of their id, but those repeating the
+    id of an earlier row (lower `Row`)
+    """
+    first_rows = table.group_by('ID', use_threads=False).aggregate([('Row', 'min')])['Row_min']
+    if len(first_rows) == table.num_rows:
+        return table
+    return table.filter(pc.is_in(table['Row'], value_set=first_rows))
+
+
+def group_median(codes: np.ndarray, values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Median of `values` inside each group of `codes` (groups 0..n-1, starting at `starts` once sorted)
+    """
+    sorted_values = values[np.lexsort((values, codes))].astype(np.float64)
+    return (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+
+
+def aggregate_table(table: pa.Table) -> pa.Table:
+    """
+    Per-repo count, mean and median code/docs length and token totals of an
+    in-memory table (and the `STATS_FIELDS` totals if it has them)
+    """
+    repos = table['Repo Name']
+    if pa.types.is_dictionary(repos.type):
+        repos = repos.cast(pa.string())
+    names = pc.unique(repos)
+    codes = pc.index_in(repos, value_set=names).to_numpy()
+    counts = np.bincount(codes, minlength=len(names))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+    columns = {'Repo Name': names, 'Count': pa.array(counts)}
+    for field in ('Code Length', 'Docs Length'):
+        values = table[field].to_numpy().astype(np.int64)
+        totals = np.bincount(codes, weights=values, minlength=len(names)).astype(np.int64)
+        columns[f'{field} Mean'] = pa.array(totals / np.maximum(counts, 1))
+        columns[f'{field} Median'] = pa.array(group_median(codes, values, starts, counts))
+        columns[field.replace('Length', 'Tokens')] = pa.array(totals)
+    fields = REPO_FIELDS + [field for field in STATS_FIELDS if field in table.column_names]
+    for field in fields[len(REPO_FIELDS):]:
+        values = table[field].to_numpy().astype(np.int64)
+        columns[field] = pa.array(np.bincount(codes, weights=values, minlength=len(names)).astype(np.int64))
+    return pa.table({field: columns[field] for field in fields})
+
+
+class PartitionSpill:
+    """
+    Record batches buffered in memory while they hold at most `max_rows`
+    rows, else spilled to `spill_dir` (a temporary dir by default) in the
+    hash partitions given by `partitions(batch, num_partitions)`
+    """
+    def __init__(self, partitions, max_rows: int = MAX_ROWS, num_partitions: int = NUM_PARTITIONS,
+                 spill_dir: str = None):
+        self.partitions = partitions
+        self.max_rows = max_rows
+        self.num_partitions = num_partitions
+        self.spill_dir = spill_dir
+        self.batches = []
+        self.n_buffered = 0
+        self.writers = None
+
+    def add(self, batch: pa.RecordBatch):
+        if self.writers is not None:
+            self._spill(batch)
+            return
+        self.batches.append(batch)
+        self.n_buffered += batch.num_rows
+        if self.n_buffered > self.max_rows:
+            self._open_partitions()
+            for buffered in self.batches:
+                self._spill(buffered)
+            self.batches, self.n_buffered = [], 0
+
+    def _open_partitions(self):
+        self.spill_dir = tempfile.mkdtemp(dir=self.spill_dir)
+        self.writers = [None] * self.num_partitions
+
+    def _spill(self, batch: pa.RecordBatch):
+        partitions = self.partitions(batch, self.num_partitions)
+        # Dictionaries differ from batch to batch, partitions are written decoded
+        batch = pa.RecordBatch.from_arrays(
+            [column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+             for column in batch.columns], batch.schema.names)
+        order = np.argsort(partitions, kind='stable')
+        bounds = np.searchsorted(partitions[order], np.arange(self.num_partitions + 1))
+        for partition in range(self.num_partitions):
+            if bounds[partition] == bounds[partition + 1]:
+                continue
+            if self.writers[partition] is None:
+                self.writers[partition] = pq.ParquetWriter(
+                    os.path.join(self.spill_dir, f'{partition:03d}.parquet'), batch.schema)
+            self.writers[partition].write_batch(batch.take(order[bounds[partition]:bounds[partition + 1]]))
+
+    def tables(self) -> Iterator[pa.Table]:
+        """
+        The buffered rows as one table, or the spilled rows as one table per partition
+        """
+        if self.writers is None:
+            if self.batches:
+                yield pa.Table.from_batches(self.batches)
+            return
+        try:
+            for partition, writer in enumerate(self.writers):
+                if writer is None:
+                    continue
+                writer.close()
+                yield pq.read_table(os.path.join(self.spill_dir, f'{partition:03d}.parquet'))
+        finally:
+            shutil.rmtree(self.spill_dir)
+
+
+class RepoAggregator:
+    """
+    Hash aggregate of metadata batches by repo, spilling to `spill_dir` (a
+    temporary dir by default) once more than `max_rows` rows are buffered
+    """
+    def __init__(self, max_rows: int = MAX_ROWS, num_partitions: int = NUM_PARTITIONS, spill_dir: str = None):
+        self.spill = PartitionSpill(repo_partitions, max_rows, num_partitions, spill_dir)
+
+    def add(self, batch: pa.RecordBatch):
+        columns = AGGREGATE_COLUMNS + [field for field in STATS_FIELDS if field in batch.schema.names]
+        self.spill.add(pa.RecordBatch.from_arrays([batch[column] for column in columns], columns))
+
+    def results(self) -> Iterator[pa.Table]:
+        """
+        Per-repo statistics (`REPO_FIELDS`), one table per partition
+        """
+        for table in self.spill.tables():
+            yield aggregate_table(table)
+
+
+def aggregate_metadata(path: str, max_rows: int = MAX_ROWS, spill_dir: str = None,
+                       stats: np.ndarray = None) -> Iterator[pa.Table]:
+    """
+    Stream the per-repo statistics of a metadata file (Parquet or CSV), with
+    the `STATS_FIELDS` totals if `stats` (its rows' `STATS_DTYPE` records) is
+    given. Rows repeating the id of an earlier row are left out, as `mapping.py`
+    only writes the first occurrence of an id.
+    """
+    rows = PartitionSpill(id_partitions, max_rows, spill_dir=spill_dir)
+    n_rows = 0
+    for batch in iter_metadata(path, columns=DEDUP_COLUMNS[:1] + AGGREGATE_COLUMNS):
+        columns = batch.columns + [pa.array(np.arange(n_rows, n_rows + batch.num_rows, dtype=np.int64))]
+        names = batch.schema.names + DEDUP_COLUMNS[1:]
+        if stats is not None:
+            records = stats[n_rows:n_rows + batch.num_rows]
+            if len(records) != batch.num_rows:
+                raise ValueError(f"{len(stats)} stats records for more metadata rows in {path}")
+            columns += [pa.array(np.asarray(records[name], dtype=np.int64)) for name in STATS_FIELDS.values()]
+            names += list(STATS_FIELDS)
+        rows.add(pa.RecordBatch.from_arrays(columns, names))
+        n_rows += batch.num_rows
+    if stats is not None and n_rows != len(stats):
+        raise ValueError(f"{len(stats)} stats records for {n_rows} metadata rows in {path}")
+
+    aggregator = RepoAggregator(max_rows, spill_dir=spill_dir)
+    for table in rows.tables():
+        for batch in first_occurrences(table).to_batches():
+            aggregator.add(batch)
+    yield from aggregator.results()
@@ -1,54 +1,333 @@
 import os
-import json
 import csv
 import glob
+import json
+import shutil
 from tqdm import tqdm
 import multiprocessing as mp
-import pandas as pd
+import numpy as np
 from argparse import ArgumentParser
 
+from src.postprocess.deduplication.exact_dedup import build_digest_set, repeated_digests
+from src.postprocess.split.metadata import meta_path, read_digests
+from src.postprocess.split.subset import FULL_TRAIN, INDEX_DTYPE, subset_index_path, write_index
+from src.sidecar.jsonl_index import JsonlIndex
 
-def processing(data_path, _idx):
+SPLIT_NAMES = ["medium_train", "small_train", "large_train", "test", "eval"]
+# Samples of these sets are written to `full_train.jsonl` and indexed by `{subset}.idx`
+TRAIN_SUBSETS = ["medium_train", "small_train", "large_train"]
+# Lines routed at once
+CHUNK_SIZE = 1 << 16
+# Bytes of a merged file routed by one task
+CHUNK_BYTES = 1 << 26
+# Buffer size of the split writers
+WRITE_BUFFER = 1 << 22
+REPO_KEY = '"repo": "'
+
+# Split tables and output dirs of the languages being mapped (inherited, not copied, by forked workers)
+_split_tables = {}
+_output_dirs = {}
+
+
+def extract_repo(line: str):
+    """
+    Read the `repo` of a JSONL sample without parsing the whole line (the key
+    cannot occur inside a JSON string value, its quotes would be escaped)
+    """
+    position = line.find(REPO_KEY)
+    if position != -1:
+        start = position + len(REPO_KEY)
+        end = line.find('"', start)
+        repo = line[start:end]
+        if end != -1 and '\\' not in repo:
+            return repo
+    try:
+        return json.loads(line).get('repo')
+    except Exception:
+        return None
+
+
+class SplitTable:
+    """
+    Read-only repo -> split name map of one language (`{language}_repo_split.csv`
+    written by `split.py`), repos it does not list go to `train`
+    """
+    def __init__(self, repo_split: dict):
+        self.repo_split = repo_split
+
+    @classmethod
+    def from_csv(cls, path: str):
+        with open(path, 'r', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            repo_column, set_column = header.index('Repo Name'), header.index('Set Name')
+            return cls({row[repo_column]: row[set_column] for row in reader})
+
+    def __len__(self):
+        return len(self.repo_split)
+
+    def split_names(self, repos: list) -> list:
+        names = []
+        for repo in repos:
+            set_name = self.repo_split.get(repo, 'train')
+            names.append(set_name if set_name in SPLIT_NAMES else 'train')
+        return names
+
+
+def load_split_table(data_path: str) -> SplitTable:
+    return SplitTable.from_csv(split_table_path(data_path))
+
+
+def split_table_path(data_path: str) -> str:
     language = os.path.basename(os.path.normpath(data_path))
-    csv_files = ["medium_train.csv", "small_train.csv", "large_train.csv", "test.csv", "eval.csv"]
-    sets = {"id": [], "set_name": []}
-    # sets = []
-    writer_list = {}
-    for _csv in csv_files:
-        path = os.path.join(data_path, f"{language}_{_csv}")
-        set_name = _csv.replace('.csv', '')
-        writer_list[set_name] = open(os.path.join(data_path, f"{set_name}.jsonl"), 'w')
-        
-        id_map = pd.read_csv(path)
-        ids = id_map['ID']
-        sets['id'].extend(ids)
-        sets['set_name'].extend([set_name]*len(ids))
-    
-    writer_list['train'] = open(os.path.join(data_path, f"full_train.jsonl"), 'w')  # Must be write
-    set_name_df = pd.DataFrame(sets, columns=['id', 'set_name'])
-    
-    # dataframe = {"id": [], "str_sample": []}
-    dataframe = []
-    with open(os.path.join(data_path, f'{language}_merged.jsonl'), 'r') as file:
-        dataset = list(file)
-        for data_point in tqdm(dataset, desc=f"Load {language} jsonl", total=len(dataset)):
-            data_loaded = json.loads(data_point)
-            dataframe.append([data_loaded['id'], data_point])
-    content_df = pd.DataFrame(dataframe, columns=['id', 'str_sample'])
-    content_df = content_df.drop_duplicates(subset='id', keep="first")
-
-    result = pd.merge(set_name_df, content_df, on='id', how='outer')
-    result['set_name'].fillna('train', inplace=True)
-    # result.to_csv(os.path.join(data_path, 'split_meta.csv'))
-
-
-    for index, row in tqdm(result.iterrows(), total=len(result), position=_idx, desc=language, leave=False):
-        data_point = row['str_sample']
-        set_name = row['set_name']
-        writer_list[set_name].write(data_point)
-
-        if set_name not in ['eval', 'test', 'train']:
-            writer_list['train'].write(data_point)
+    return os.path.join(data_path, f"{language}_repo_split.csv")
+
+
+def output_dir(data_path: str, existing_split: str = None) -> str:
+    """
+    Language dir the split files of `data_path` are written to: the same dir,
+    or the one of the language under `existing_split` (root of a previous split)
+    """
+    if existing_split is None:
+        return data_path
+    return os.path.join(existing_split, os.path.basename(os.path.normpath(data_path)))
+
+
+def merged_path(data_path: str) -> str:
+    language = os.path.basename(os.path.normpath(data_path))
+    return os.path.join(data_path, f'{language}_merged.jsonl')
+
+
+def metadata_path(data_path: str) -> str:
+    language = os.path.basename(os.path.normpath(data_path))
+    path = meta_path(data_path, language)
+    # Metadata written by older versions of merge.py
+    csv_path = os.path.join(data_path, f'{language}_meta.csv')
+    return path if os.path.exists(path) or not os.path.exists(csv_path) else csv_path
+
+
+def line_ranges(path: str, chunk_bytes: int = CHUNK_BYTES) -> list:
+    """
+    Split a JSONL file into (first line, end line, start byte, end byte)
+    ranges of about `chunk_bytes`, from its line index (`<file>.idx` written
+    by `merge.py`, built by a newline scan for older merges)
+    """
+    with JsonlIndex(path) as index:
+        n_parts = max(1, -(-index.size // chunk_bytes))
+        return [(start, end) + index.byte_range(start, end) for start, end in index.partitions(n_parts)]
+
+
+def read_chunks(file, end: int, chunk_size: int = CHUNK_SIZE):
+    """
+    Chunks of lines of a binary file from its current position to byte `end`
+    """
+    chunk = []
+    while file.tell() < end:
+        line = file.readline()
+        if not line:
+            break
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker(split_tables: dict, output_dirs: dict):
+    global _split_tables, _output_dirs
+    _split_tables = split_tables
+    _output_dirs = output_dirs
+
+
+def part_dir(data_path: str) -> str:
+    return os.path.join(data_path, '.mapping_parts')
+
+
+def existing_digests(data_path: str) -> str:
+    return os.path.join(data_path, '.mapping_digests')
+
+
+def duplicate_lines(data_path: str, existing=None) -> np.ndarray:
+    """
+    Whether each line of the merged file of a language repeats the id of an
+    earlier line or, when appending, an id of `existing` (`DigestSet` of the
+    existing split files). Ids are read from the metadata, aligned line for
+    line with the merged file, which is not read.
+    """
+    digests = read_digests(metadata_path(data_path))
+    duplicates = repeated_digests(digests)
+    if existing is not None:
+        duplicates |= existing.contains(digests)
+    return duplicates
+
+
+def route_range(args):
+    """
+    Route the lines of one byte range of a merged file to part files of
+    each split, skipping the lines marked in `duplicates` (run inside a
+    worker). Train subset lines are only written to the `train` part, with
+    their (offset, length) in it appended to the part index of their subset.
+
+    Return:
+        Language dir, part number and bytes read
+    """
+    data_path, part, start, end, duplicates = args
+    table = _split_tables[data_path]
+    set_names = [set_name for set_name in SPLIT_NAMES if set_name not in TRAIN_SUBSETS] + ['train']
+    directory = part_dir(_output_dirs[data_path])
+    writers = {set_name: open(os.path.join(directory, f'{set_name}.{part:05d}'), 'wb',
+                              buffering=WRITE_BUFFER) for set_name in set_names}
+    subset_offsets = {subset: ([], []) for subset in TRAIN_SUBSETS}
+
+    train_offset = 0
+    n_lines = 0
+    with open(merged_path(data_path), 'rb') as file:
+        file.seek(start)
+        for chunk in read_chunks(file, end):
+            chunk_duplicates = duplicates[n_lines:n_lines + len(chunk)].tolist()
+            n_lines += len(chunk)
+            chunk_set_names = table.split_names([extract_repo(line.decode('utf-8', 'replace')) for line in chunk])
+            for data_point, set_name, duplicate in zip(chunk, chunk_set_names, chunk_duplicates):
+                if duplicate:
+                    continue
+                if set_name in TRAIN_SUBSETS:
+                    offsets, lengths = subset_offsets[set_name]
+                    offsets.append(train_offset)
+                    lengths.append(len(data_point))
+                    set_name = 'train'
+                writers[set_name].write(data_point)
+                if set_name == 'train':
+                    train_offset += len(data_point)
+
+    for writer in writers.values():
+        writer.close()
+    for subset, (offsets, lengths) in subset_offsets.items():
+        with open(os.path.join(directory, f'{subset}.{part:05d}'), 'wb') as index_file:
+            write_index(index_file, offsets, lengths)
+    return data_path, part, end - start
+
+
+def concat_parts(data_path: str, n_parts: int, append: bool = False):
+    """
+    Concatenate the part files of every split of the language dir
+    `data_path` in order (after the existing split files if `append`),
+    shifting the part indexes of the train subsets by the position of their
+    part in `full_train.jsonl` (after its existing size if `append`)
+    """
+    directory = part_dir(data_path)
+    mode = 'ab' if append else 'wb'
+    for set_name in SPLIT_NAMES:
+        if set_name in TRAIN_SUBSETS:
+            continue
+        with open(os.path.join(data_path, f"{set_name}.jsonl"), mode) as writer:
+            for part in range(n_parts):
+                path = os.path.join(directory, f'{set_name}.{part:05d}')
+                with open(path, 'rb') as file:
+                    shutil.copyfileobj(file, writer, WRITE_BUFFER)
+                os.remove(path)
+
+    index_files = {subset: open(subset_index_path(data_path, subset), mode) for subset in TRAIN_SUBSETS}
+    train_path = os.path.join(data_path, FULL_TRAIN)
+    base = os.path.getsize(train_path) if append and os.path.exists(train_path) else 0
+    with open(train_path, mode) as writer:
+        for part in range(n_parts):
+            for subset, index_file in index_files.items():
+                path = os.path.join(directory, f'{subset}.{part:05d}')
+                records = np.fromfile(path, dtype=INDEX_DTYPE)
+                records['offset'] += base
+                records.tofile(index_file)
+                os.remove(path)
+            path = os.path.join(directory, f'train.{part:05d}')
+            base += os.path.getsize(path)
+            with open(path, 'rb') as file:
+                shutil.copyfileobj(file, writer, WRITE_BUFFER)
+            os.remove(path)
+    for index_file in index_files.values():
+        index_file.close()
+    os.rmdir(directory)
+
+
+def mapping(data_paths: list, processes: int = None, chunk_bytes: int = CHUNK_BYTES, multiprocess: bool = True,
+            existing_split: str = None):
+    """
+    Route every line of `{language}_merged.jsonl` to the JSONL file of its
+    split, for all languages at once.
+
+    Only the repo -> split tables are held in memory. Each merged file is cut
+    in byte ranges and all ranges of all languages share one pool of
+    `processes` workers, so a large language is spread over several workers
+    while small ones run alongside it. Train samples (of the train subsets
+    and of unlisted repos) are written once, to `full_train.jsonl`, the
+    subsets are `{subset}.idx` indexes into it (see `SubsetReader`).
+
+    Sample ids are read from `{language}_meta.parquet`: a sample id is only
+    written once, at its first occurrence in the merged file, so duplicates
+    cannot land in two splits.
+
+    With `existing_split` (root of a previous split), the merged files only
+    hold new records (split with `split.py --existing_split`). They are
+    appended to the split files of the same language under `existing_split`,
+    new records whose id is already in those files are dropped, and the
+    updated repo -> split table is copied there.
+    """
+    tables, output_dirs, tasks, parts, pbars, n_duplicates = {}, {}, [], {}, {}, {}
+    for _idx, data_path in enumerate(data_paths):
+        language = os.path.basename(os.path.normpath(data_path))
+        tables[data_path] = load_split_table(data_path)
+        output_dirs[data_path] = output_dir(data_path, existing_split)
+        os.makedirs(part_dir(output_dirs[data_path]), exist_ok=True)
+        existing = None
+        if existing_split is not None:
+            split_files = [os.path.join(output_dirs[data_path], name)
+                           for name in ('test.jsonl', 'eval.jsonl', FULL_TRAIN)]
+            existing = build_digest_set([path for path in split_files if os.path.exists(path)],
+                                        existing_digests(output_dirs[data_path]))
+        ranges = line_ranges(merged_path(data_path), chunk_bytes)
+        duplicates = duplicate_lines(data_path, existing)
+        n_lines = ranges[-1][1] if ranges else 0
+        if len(duplicates) != n_lines:
+            raise ValueError(f"{metadata_path(data_path)} has {len(duplicates)} rows for {n_lines} lines "
+                             f"in {merged_path(data_path)}")
+        n_duplicates[data_path] = int(duplicates.sum())
+        tasks.extend((data_path, part, start_byte, end_byte, duplicates[first:last])
+                     for part, (first, last, start_byte, end_byte) in enumerate(ranges))
+        parts[data_path] = [False] * len(ranges)
+        pbars[data_path] = tqdm(total=os.path.getsize(merged_path(data_path)), position=_idx, desc=language,
+                                leave=False, unit='B', unit_scale=True)
+
+    def collect(results):
+        for data_path, part, n_bytes in results:
+            parts[data_path][part] = True
+            pbars[data_path].update(n_bytes)
+            if all(parts[data_path]):
+                concat_parts(output_dirs[data_path], len(parts[data_path]), existing_split is not None)
+                pbars[data_path].close()
+
+    # Ranges of the largest languages first
+    sizes = {data_path: os.path.getsize(merged_path(data_path)) for data_path in data_paths}
+    tasks.sort(key=lambda task: (-sizes[task[0]], task[1]))
+    if multiprocess:
+        with mp.Pool(processes=processes, initializer=_init_worker, initargs=(tables, output_dirs)) as pool:
+            collect(pool.imap_unordered(route_range, tasks))
+    else:
+        _init_worker(tables, output_dirs)
+        collect(map(route_range, tasks))
+    for data_path in data_paths:
+        if existing_split is not None:
+            shutil.rmtree(existing_digests(output_dirs[data_path]))
+            if os.path.abspath(output_dirs[data_path]) != os.path.abspath(data_path):
+                shutil.copyfile(split_table_path(data_path), split_table_path(output_dirs[data_path]))
+        if n_duplicates[data_path]:
+            language = os.path.basename(os.path.normpath(data_path))
+            print(f"{language}: {n_duplicates[data_path]} duplicate samples dropped")
+
+
+def processing(data_path, _idx):
+    """
+    Route every line of one language dir to the JSONL file of its split
+    """
+    mapping([data_path], multiprocess=False)
 
 
 def parse_args():
@@ -58,24 +337,37 @@ def parse_args():
         type=str,
         help="path to raw dataset",
     )
-    
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="number of worker processes shared by all languages (default: all CPUs)",
+    )
+    parser.add_argument(
+        "--chunk_bytes",
+        type=int,
+        default=CHUNK_BYTES,
+        help="bytes of a merged file routed by one task",
+    )
+    parser.add_argument(
+        "--existing_split",
+        type=str,
+        default=None,
+        help="root dir of a previous split, the new records of the merged files are appended to its split files",
+    )
+
     return parser.parse_args()
 
 
 def main():
     opt = parse_args()
-    languages = glob.glob(os.path.join(opt.data_path, '*'))
+    languages = [path for path in sorted(glob.glob(os.path.join(opt.data_path, '*')))
+                 if os.path.isfile(merged_path(path))]
     print(languages)
 
-    args = []
-    for idx, _lang in enumerate(languages):
-        # args.append((_lang, idx))
-        processing(_lang, idx)
-    
-    # with mp.Pool(processes=10) as p:
-    #     result = p.starmap(processing, args)
-        
+    mapping(languages, opt.processes, opt.chunk_bytes, existing_split=opt.existing_split)
 
 
 if __name__ == "__main__":
+    mp.set_start_method("fork")
     main()
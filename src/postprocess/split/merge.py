@@ -1,5 +1,7 @@
 import os
 import glob
+import shutil
+import numpy as np
 from tqdm import tqdm
 from multiprocessing import Pool
 from argparse import ArgumentParser
@@ -9,7 +11,13 @@ from codetext.clean import remove_comment_delimiters
 import nltk
 import hashlib
 import json
-import csv
+
+from src.postprocess.split.metadata import MetadataWriter, concat_metadata, meta_path
+from src.sidecar.jsonl_index import OFFSET_DTYPE, index_path
+from src.sidecar.sample_stats import STATS_DTYPE, read_stats, sample_stats, stats_path
+
+# Buffer size of the shard writers and of the final concatenation
+WRITE_BUFFER = 1 << 22
 
 def get_first_sentence(paragraph):
     """
@@ -55,6 +63,12 @@ def parse_args():
         action='store_true',
         help="multiprocessing",
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="number of worker processes (default: all CPUs)",
+    )
     parser.add_argument(
         "--gen_id",
         action='store_true',
@@ -63,61 +77,135 @@ def parse_args():
     return parser.parse_args()
 
 
-def merge_files(args):
-    idx, data_path, save_path = args
-    filename = os.path.basename(os.path.normpath(data_path))
-    
-    # Add path here
-    data_path = os.path.join(data_path) #, 'function', 'extracted_2')
-    file_list = glob.glob(os.path.join(data_path, '*.jsonl'))
-    output_filename = os.path.join(save_path, f'{filename}_merged.jsonl')
-    csv_output_filename = os.path.join(save_path, f'{filename}_meta.csv')
-    
-    metadata = []
-    
-    with open(output_filename, 'w') as outfile:
-        for filename in tqdm(file_list, position=idx, desc=f'Merging files in {data_path}', leave=False):
-            with open(filename, 'r') as infile:
-                dataset = list(infile)
-                for line in dataset:
-                    data = json.loads(line)
-                    
-                    code = data['code']
-                    repo = data['repo']
-                    docs_len = len(data['docstring_tokens'])
-                    code_len = len(data['code_tokens'])
-                    idx = get_sample_id(code)
-                    data['id'] = idx
-                    
-                    if 'short_docstring' not in data.keys():
-                        short_docstring = get_first_sentence(data['docstring'])
-                        data['short_docstring'] = short_docstring
-                        data['short_docstring_tokens'] = tokenize_docstring(short_docstring)
-                    
-                    # for metadata.csv
-                    metadata.append([idx, repo, code_len, docs_len])
-                    
-                    json.dump(data, outfile)
-                    outfile.write('\n')
-    
-    fields = ['ID', 'Repo Name', 'Code Length', 'Docs Length']
-    # Open the CSV file and write the data to it
-    with open(csv_output_filename, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(fields)
-        writer.writerows(metadata)
+def process_sample(data: dict, stats: tuple = None) -> list:
+    """
+    Add the SHA-256 id (and short docstring) of a sample in place, `stats`
+    being its `sample_stats` (computed if not given)
+
+    Return:
+        Its metadata row
+    """
+    idx = get_sample_id(data['code'])
+    data['id'] = idx
+
+    if 'short_docstring' not in data.keys():
+        short_docstring = get_first_sentence(data['docstring'])
+        data['short_docstring'] = short_docstring
+        data['short_docstring_tokens'] = tokenize_docstring(short_docstring)
+
+    if stats is None:
+        stats = sample_stats(data)
+    return [idx, data['repo'], stats[0], stats[1]]
+
+
+def merge_shard(args):
+    """
+    Stream one raw file into a merged shard, its metadata rows, its stats
+    sidecar and its line lengths (run inside a worker). The stats come from
+    the sidecar of the raw file when `processing.py` wrote one.
+
+    Return:
+        Language and number of samples of the shard
+    """
+    language, file_path, shard_path = args
+    raw_stats = read_stats(file_path)
+    raw_stats = raw_stats.tolist() if raw_stats is not None else None
+    stats, lengths = [], []
+    with open(file_path, 'r') as infile, \
+            open(f'{shard_path}.jsonl', 'w', buffering=WRITE_BUFFER) as outfile, \
+            MetadataWriter(f'{shard_path}.parquet') as writer:
+        for line in infile:
+            data = json.loads(line)
+            sample = raw_stats[len(stats)] if raw_stats is not None and len(stats) < len(raw_stats) \
+                else sample_stats(data)
+            writer.write(process_sample(data, sample))
+            stats.append(sample)
+            # JSON is written ASCII-only, one character per byte
+            line = json.dumps(data) + '\n'
+            outfile.write(line)
+            lengths.append(len(line))
+    if raw_stats is not None and len(raw_stats) != len(stats):
+        raise ValueError(f"{stats_path(file_path)} has {len(raw_stats)} records for {len(stats)} samples")
+    np.array(stats, dtype=STATS_DTYPE).tofile(f'{shard_path}.stats')
+    np.array(lengths, dtype=OFFSET_DTYPE).tofile(f'{shard_path}.lengths')
+    return language, len(stats)
+
+
+def concat_files(paths: list, output_path: str):
+    """
+    Concatenate shard files into `output_path` and remove them
+    """
+    with open(output_path, 'wb') as outfile:
+        for path in paths:
+            with open(path, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, WRITE_BUFFER)
+            os.remove(path)
+
+
+def concat_line_index(paths: list, output_path: str):
+    """
+    Write the line index of the concatenated shards (see
+    `jsonl_index.build_index`) from their line lengths and remove them
+    """
+    base = 0
+    with open(output_path, 'wb') as outfile:
+        for path in paths:
+            lengths = np.fromfile(path, dtype=OFFSET_DTYPE)
+            (base + np.cumsum(lengths) - lengths).astype(OFFSET_DTYPE).tofile(outfile)
+            base += int(lengths.sum())
+            os.remove(path)
+        np.array([base], dtype=OFFSET_DTYPE).tofile(outfile)
+
+
+def merge_files(subdirs: list, save_path: str, processes: int = None, multiprocess: bool = True):
+    """
+    Merge the raw `*.jsonl` files of each language dir into `{language}_merged.jsonl`,
+    its stats sidecar, its line index and `{language}_meta.parquet` in `save_path`.
+
+    Every raw file is streamed by a worker into its own shard, shards are then
+    concatenated in file order, so no file is ever loaded in memory and the
+    output does not depend on the number of workers.
+    """
+    tasks, shards = [], {}
+    for subdir in subdirs:
+        language = os.path.basename(os.path.normpath(subdir))
+        shard_dir = os.path.join(save_path, f'.{language}_shards')
+        os.makedirs(shard_dir, exist_ok=True)
+        shards[language] = (shard_dir, [])
+        for idx, file_path in enumerate(sorted(glob.glob(os.path.join(subdir, '*.jsonl')))):
+            shard_path = os.path.join(shard_dir, f'{idx:05d}')
+            shards[language][1].append(shard_path)
+            tasks.append((language, file_path, shard_path))
+
+    n_samples = {language: 0 for language in shards}
+    pbar = tqdm(total=len(tasks), desc='Merging files', unit=' files')
+    if multiprocess:
+        with Pool(processes=processes) as pool:
+            for language, count in pool.imap_unordered(merge_shard, tasks):
+                n_samples[language] += count
+                pbar.update(1)
+    else:
+        for language, count in map(merge_shard, tasks):
+            n_samples[language] += count
+            pbar.update(1)
+    pbar.close()
+
+    for language, (shard_dir, shard_paths) in shards.items():
+        merged_path = os.path.join(save_path, f'{language}_merged.jsonl')
+        concat_files([f'{path}.jsonl' for path in shard_paths], merged_path)
+        concat_files([f'{path}.stats' for path in shard_paths], stats_path(merged_path))
+        concat_line_index([f'{path}.lengths' for path in shard_paths], index_path(merged_path))
+        concat_metadata([f'{path}.parquet' for path in shard_paths], meta_path(save_path, language))
+        os.rmdir(shard_dir)
+        print(f"Merged {language}: {n_samples[language]} samples")
+    return n_samples
 
 
 if __name__ == '__main__':
     opt = parse_args()
     data_path = opt.data_path
     save_path = opt.save_path or opt.data_path
-    subdirs = [os.path.join(data_path, d) for d in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, d))]
-    
-    if opt.multiprocess:
-        with Pool(processes=len(subdirs)) as pool:
-            args = [(idx, subdir, save_path) for idx, subdir in enumerate(subdirs)]
-            pool.map(merge_files, args)
-    else:
-        for subdir in subdirs:
-            merge_files(subdir)
+    subdirs = [os.path.join(data_path, d) for d in sorted(os.listdir(data_path))
+               if os.path.isdir(os.path.join(data_path, d)) and not d.startswith('.')]
+
+    merge_files(subdirs, save_path, opt.processes, opt.multiprocess)
@@ -0,0 +1,125 @@
+"""
+Columnar metadata of the split pipeline.
+
+`merge.py` writes one `{language}_meta.parquet` per language with the SHA-256
+id as 32-byte binary, the repo name dictionary-encoded and the lengths as
+int32. Readers only load the columns they need, batch by batch.
+"""
+import os
+from typing import Iterator, List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+
+
+META_FIELDS = ['ID', 'Repo Name', 'Code Length', 'Docs Length']
+META_SCHEMA = pa.schema([
+    ('ID', pa.binary(32)),
+    ('Repo Name', pa.dictionary(pa.int32(), pa.string())),
+    ('Code Length', pa.int32()),
+    ('Docs Length', pa.int32()),
+])
+META_SUFFIX = '_meta.parquet'
+# Rows buffered before a row group is written
+ROW_GROUP_SIZE = 1 << 17
+BATCH_SIZE = 1 << 17
+# Bytes of the truncated id digests (`exact_dedup.DIGEST_SIZE`)
+DIGEST_SIZE = 16
+
+
+def meta_path(data_path: str, language: str) -> str:
+    return os.path.join(data_path, f'{language}{META_SUFFIX}')
+
+
+class MetadataWriter:
+    """
+    Write metadata rows (`[hex id, repo, code length, docs length]`) to a
+    Parquet file, one row group every `ROW_GROUP_SIZE` rows
+    """
+    def __init__(self, path: str, row_group_size: int = ROW_GROUP_SIZE):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(path, META_SCHEMA)
+        self.rows = []
+
+    def write(self, row: list):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        ids, repos, code_lengths, docs_lengths = zip(*self.rows)
+        self.writer.write_table(pa.Table.from_arrays([
+            pa.array([bytes.fromhex(idx) for idx in ids], type=pa.binary(32)),
+            pa.array(repos, type=pa.string()).dictionary_encode(),
+            pa.array(code_lengths, type=pa.int32()),
+            pa.array(docs_lengths, type=pa.int32()),
+        ], schema=META_SCHEMA))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def concat_metadata(paths: List[str], output_path: str):
+    """
+    Concatenate metadata shards row group by row group and remove them
+    """
+    with pq.ParquetWriter(output_path, META_SCHEMA) as writer:
+        for path in paths:
+            shard = pq.ParquetFile(path, read_dictionary=['Repo Name'])
+            for row_group in range(shard.num_row_groups):
+                writer.write_table(shard.read_row_group(row_group).cast(META_SCHEMA))
+            os.remove(path)
+
+
+def iter_metadata(path: str, columns: List[str] = None, batch_size: int = BATCH_SIZE) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the `columns` of a metadata file (Parquet, or CSV as written by
+    older versions of `merge.py`) as record batches
+    """
+    if path.endswith('.csv'):
+        reader = pa_csv.open_csv(path, read_options=pa_csv.ReadOptions(block_size=batch_size * 128),
+                                 convert_options=pa_csv.ConvertOptions(include_columns=columns))
+        yield from reader
+    else:
+        yield from pq.ParquetFile(path, read_dictionary=['Repo Name']).iter_batches(batch_size, columns=columns)
+
+
+def read_metadata(path: str, columns: List[str] = None) -> pa.Table:
+    if path.endswith('.csv'):
+        return pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(include_columns=columns))
+    return pq.read_table(path, columns=columns, read_dictionary=['Repo Name'])
+
+
+
+def read_digests(path: str) -> np.ndarray:
+    """
+    Ids of the rows of a metadata file (aligned line for line with the merged
+    file) as `V16` digests, see `exact_dedup.sample_digest`
+    """
+    digests = []
+    for batch in iter_metadata(path, columns=['ID']):
+        ids = batch['ID']
+        if pa.types.is_fixed_size_binary(ids.type):
+            width = ids.type.byte_width
+            ids = np.frombuffer(ids.buffers()[1], dtype=np.uint8, offset=ids.offset * width, count=len(ids) * width)
+            digests.append(ids.reshape(-1, width)[:, :DIGEST_SIZE].copy().view(f'V{DIGEST_SIZE}').ravel())
+        else:
+            digests.append(np.array([bytes.fromhex(str(idx)[:2 * DIGEST_SIZE]) for idx in ids.to_pylist()],
+                                    dtype=f'V{DIGEST_SIZE}'))
+    if not digests:
+        return np.zeros(0, dtype=f'V{DIGEST_SIZE}')
+    return np.concatenate(digests)
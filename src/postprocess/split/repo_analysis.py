@@ -1,13 +1,12 @@
 import os
 import glob
-from tqdm import tqdm
 from multiprocessing import Pool
 from argparse import ArgumentParser
 
-import hashlib
-import json
 import csv
-import pandas as pd
+
+from src.postprocess.split.aggregate import REPO_FIELDS, STATS_FIELDS, aggregate_metadata
+from src.sidecar.sample_stats import read_stats
 
 
 def parse_args():
@@ -31,23 +30,32 @@ def parse_args():
 
 
 def repo_merge(args):
+    """
+    Write the per-repo statistics (`REPO_FIELDS`) of a metadata file to `{language}_repos.csv`,
+    and the `STATS_FIELDS` totals when `{language}_merged.jsonl` has a stats sidecar
+    """
     data_path, save_path = args
     filename = os.path.basename(os.path.normpath(data_path))
-    csv_output_filename = os.path.join(save_path, f'{filename}_repos.csv')
-    
-    # file_list = glob.glob(os.path.join(data_path, '*.csv'))
+    language = filename.replace('_meta.parquet', '').replace('_meta.csv', '').replace('.csv', '')
+    csv_output_filename = os.path.join(save_path, f'{language}_repos.csv')
+    sample_stats = read_stats(os.path.join(os.path.dirname(data_path), f'{language}_merged.jsonl'))
+    fields = REPO_FIELDS + (list(STATS_FIELDS) if sample_stats is not None else [])
 
-    df = pd.read_csv(data_path)
-    grouped = df.groupby("Repo Name").mean()
-    grouped.reset_index()
-    grouped.to_csv(csv_output_filename, index=False)
+    n_repos = 0
+    with open(csv_output_filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(fields)
+        for stats in aggregate_metadata(data_path, spill_dir=save_path, stats=sample_stats):
+            writer.writerows(zip(*(stats[field].to_pylist() for field in fields)))
+            n_repos += stats.num_rows
+    print(f"{filename}: {n_repos} repos saved to {csv_output_filename}")
 
 
 if __name__ == '__main__':
     opt = parse_args()
     data_path = opt.data_path
     save_path = opt.save_path or opt.data_path
-    file_list = glob.glob(os.path.join(data_path, '*.csv'))
+    file_list = glob.glob(os.path.join(data_path, '*_meta.parquet')) or glob.glob(os.path.join(data_path, '*_meta.csv'))
     
     if opt.multiprocess:
         with Pool(processes=len(file_list)) as pool:
@@ -55,4 +63,4 @@ if __name__ == '__main__':
             pool.map(repo_merge, args)
     else:
         for file in file_list:
-            repo_merge(file)
+            repo_merge((file, save_path))
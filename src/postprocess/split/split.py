@@ -1,87 +1,179 @@
 import os
-import pandas as pd
+import csv
 import glob
-import functools
+import hashlib
+import warnings
+import numpy as np
 from tqdm import tqdm
 from multiprocessing import Pool
 from argparse import ArgumentParser
-from sklearn.model_selection import train_test_split
+
+from src.postprocess.split.aggregate import MAX_ROWS, aggregate_metadata
 
 
 TEST_SIZE = 20000
 SMALL_RATIO = 0.05
 MEDIUM_RATIO = 0.25
 LARGE_RATIO = 0.7
+# At most this share of the functions goes to test and eval together
+MAX_HELDOUT_RATIO = 0.2
+
+SEED = 42
+SPLIT_FIELDS = ['Repo Name', 'Set Name', 'Count']
+TRAIN_SUBSETS = ['small_train', 'medium_train', 'large_train']
+
+
+def repo_hash(repo: str, seed: int = SEED, salt: str = '') -> int:
+    """
+    Stable 64-bit hash of a repo name
+    """
+    return int.from_bytes(hashlib.blake2b(f'{seed}:{salt}:{repo}'.encode(), digest_size=8).digest(), 'little')
+
+
+def aggregate_repos(dataframe_path: str, max_rows: int = MAX_ROWS) -> dict:
+    """
+    Per-repo aggregates of a metadata file, see `aggregate_metadata`
+
+    Return:
+        {repo: [number of functions, total code length, total docs length]}
+    """
+    repos = {}
+    for stats in aggregate_metadata(dataframe_path, max_rows):
+        for repo, count, code_tokens, docs_tokens in zip(*(stats[column].to_pylist() for column in (
+                'Repo Name', 'Count', 'Code Tokens', 'Docs Tokens'))):
+            repos[repo] = [count, code_tokens, docs_tokens]
+    return repos
+
+
+def heldout_size(n_functions: int) -> float:
+    """
+    Number of functions of each of test and eval: `TEST_SIZE`, capped so
+    that train keeps at least `1 - MAX_HELDOUT_RATIO` of the functions
+    """
+    size = min(TEST_SIZE, MAX_HELDOUT_RATIO / 2 * n_functions)
+    if size < TEST_SIZE:
+        warnings.warn(f"Only {n_functions} functions: test and eval get {int(size)} functions each "
+                      f"instead of {TEST_SIZE}")
+    return size
+
+
+def assign_repos(repos: dict, set_names: list, ratios: list, seed: int = SEED) -> dict:
+    """
+    Seeded and hash-stable assignment of repos to sets.
+
+    Each repo is drawn alone from the seeded hash of its name, `h / 2^64`,
+    against fixed thresholds: below `ratios[0]` it goes to `set_names[0]`,
+    below `ratios[0] + ratios[1]` to `set_names[1]` and so on, the rest to
+    the last set. The set of a repo never depends on the other repos, so
+    adding repos leaves every existing assignment in place. The draw is
+    independent of the repo size and code length, so each set holds about
+    its ratio of the functions of every length range. The hash is salted by
+    `set_names` so that the train subsets are not drawn from the same
+    values as train/eval/test.
+
+    Return:
+        {repo: set name}
+    """
+    salt = '/'.join(set_names)
+    thresholds = np.cumsum(ratios) * 2.0 ** 64
+    return {repo: set_names[int(np.searchsorted(thresholds, repo_hash(repo, seed, salt), side='right'))]
+            for repo in repos}
+
+
+def read_repo_split(path: str) -> list:
+    with open(path, 'r', newline='') as csv_file:
+        return [[repo, set_name, int(count)] for repo, set_name, count in list(csv.reader(csv_file))[1:]]
+
+
+def update_repo_split(repos: dict, existing_rows: list, seed: int = SEED) -> list:
+    """
+    Add the repos of new records to an existing repo -> split table.
 
-def train_test_stratified_sampling(dataframe_path, split_train=False):
-    dataframe = pd.read_csv(dataframe_path)
-    
-    bf = len(dataframe)
-    dataframe = dataframe.drop_duplicates(subset='ID', keep="first")
-    af = len(dataframe)
-    data = dataframe.copy(deep=True)
-    if not split_train:
-        print(f"{dataframe_path}: Before {bf} | After {af}")
-    
-    data = data.groupby(['Repo Name'])[['Code Length', 'Docs Length']].mean().reset_index()
-    data['CL_bin'] = pd.qcut(data['Code Length'], 10, labels=False)
-    
-    if split_train:
-        test_ratio = SMALL_RATIO
-        train_val_set, test_set, y_train_val, y_test = train_test_split(data, data[['CL_bin']], test_size=test_ratio, random_state=42, stratify=data[['CL_bin']])
-        eval_ratio = MEDIUM_RATIO * len(data) / len(train_val_set)
-        train_set, eval_set = train_test_split(train_val_set, test_size=eval_ratio, random_state=42, stratify=y_train_val)
-        set_name = ['large_train', 'medium_train', 'small_train']
-    
+    Known repos keep their set (their count grows), only unseen repos are
+    assigned, to the sets still short of their target: `heldout_size`
+    functions for eval and test and, if the train repos are already split,
+    `SMALL_RATIO`/`MEDIUM_RATIO` of the train functions for small/medium.
+
+    Return:
+        Rows of the updated table
+    """
+    rows = [[repo, set_name, count + (repos[repo][0] if repo in repos else 0)]
+            for repo, set_name, count in existing_rows]
+    known = {repo for repo, _, _ in rows}
+    new_repos = {repo: stats for repo, stats in repos.items() if repo not in known}
+    n_new = sum(stats[0] for stats in new_repos.values())
+    if n_new == 0:
+        return rows
+
+    totals = {}
+    for _, set_name, count in rows:
+        totals[set_name] = totals.get(set_name, 0) + count
+    n_total = sum(totals.values()) + n_new
+    size = heldout_size(n_total)
+    targets = {'test': size, 'eval': size}
+    if any(set_name in totals for set_name in TRAIN_SUBSETS):
+        set_names = ['test', 'eval'] + TRAIN_SUBSETS
+        n_train = n_total - max(size, totals.get('test', 0)) - max(size, totals.get('eval', 0))
+        targets.update(small_train=SMALL_RATIO * n_train, medium_train=MEDIUM_RATIO * n_train)
     else:
-        test_size = TEST_SIZE
-        repo_ratio = len(dataframe) / len(data)
-        test_ratio = test_size / (len(data) * repo_ratio)
-        train_val_set, test_set, y_train_val, y_test = train_test_split(data, data[['CL_bin']], test_size=test_ratio, random_state=42, stratify=data[['CL_bin']])
-        eval_ratio = test_size / (len(train_val_set) * repo_ratio)
-        train_set, eval_set = train_test_split(train_val_set, test_size=eval_ratio, random_state=42, stratify=y_train_val)
-        set_name = ['train', 'eval', 'test']
-    
-
-    train_set['Set Name'] = 'train'
-    eval_set['Set Name'] = 'eval'
-    test_set['Set Name'] = 'test'
-    
-    concat_df = pd.concat([train_set, eval_set, test_set], axis=0)
-    concat_df = concat_df.drop(['CL_bin', 'Code Length', 'Docs Length'], axis=1)
-    
-    result_df = pd.merge(dataframe, concat_df, how='right', on='Repo Name')
-
-    grouped = {}
-    for name, group in result_df.groupby(['Set Name'])[['ID', 'Repo Name', 'Code Length', 'Docs Length']]:
-        grouped[name] = group
-        
-    
-    if split_train:
-        save_name = str(dataframe_path).replace('train.csv', '')
+        set_names = ['test', 'eval', 'train']
+
+    # Share of the new functions each set needs to reach its target
+    ratios = [max(targets[set_name] - totals.get(set_name, 0), 0) / n_new for set_name in set_names[:-1]]
+    if sum(ratios) > 1:
+        ratios = [ratio / sum(ratios) for ratio in ratios]
+    assignment = assign_repos(new_repos, set_names, ratios, seed)
+    return rows + [[repo, assignment[repo], stats[0]] for repo, stats in new_repos.items()]
+
+
+def train_test_stratified_sampling(dataframe_path, split_train=False, seed=SEED, existing_split=None):
+    """
+    Split the repos of `{language}_meta.parquet` into train/eval/test (TEST_SIZE
+    functions each for eval and test, see `heldout_size`) or, with `split_train`, the train repos
+    into small/medium/large train sets, and write `{language}_repo_split.csv`
+
+    With `existing_split` (a previous `{language}_repo_split.csv`), the
+    metadata only holds new records: the existing assignment is kept and only
+    unseen repos are assigned (see `update_repo_split`).
+    """
+    repos = aggregate_repos(dataframe_path)
+    n_functions = sum(stats[0] for stats in repos.values())
+    save_name = str(dataframe_path).replace('meta.parquet', 'repo_split.csv').replace('meta.csv', 'repo_split.csv')
+
+    if existing_split:
+        rows = update_repo_split(repos, read_repo_split(existing_split), seed)
+    elif split_train:
+        rows = read_repo_split(save_name)
+        train_repos = {row[0]: repos[row[0]] for row in rows if row[1] == 'train' and row[0] in repos}
+        assignment = assign_repos(train_repos, ['small_train', 'medium_train', 'large_train'],
+                                  [SMALL_RATIO, MEDIUM_RATIO], seed)
+        rows = [[repo, assignment.get(repo, set_name), count] for repo, set_name, count in rows]
     else:
-        save_name = str(dataframe_path).replace('meta.csv', '')
-        
-    # access the groups by their name
-    grouped['train'].to_csv(f'{save_name}{set_name[0]}.csv', index=False)
-    grouped['eval'].to_csv(f'{save_name}{set_name[1]}.csv', index=False)
-    grouped['test'].to_csv(f'{save_name}{set_name[2]}.csv', index=False)
-    print(f"Split {os.path.basename(os.path.normpath(dataframe_path))} train: {split_train} | {set_name[0]}: {len(grouped['train'])} | {set_name[1]}: {len(grouped['eval'])} | {set_name[2]}: {len(grouped['test'])}")
+        test_ratio = heldout_size(n_functions) / max(n_functions, 1)
+        assignment = assign_repos(repos, ['test', 'eval', 'train'], [test_ratio, test_ratio], seed)
+        rows = [[repo, assignment[repo], stats[0]] for repo, stats in repos.items()]
+
+    with open(save_name, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(SPLIT_FIELDS)
+        writer.writerows(rows)
 
+    summary = {}
+    for _, set_name, count in rows:
+        n_repos, n_samples = summary.get(set_name, (0, 0))
+        summary[set_name] = (n_repos + 1, n_samples + int(count))
+    print(f"Split {os.path.basename(os.path.normpath(dataframe_path))} train: {split_train} | " + " | ".join(
+        f"{set_name}: {n_samples} ({n_repos} repos)" for set_name, (n_repos, n_samples) in sorted(summary.items())))
+    return rows
 
 
 def train_test_split_wrapper(args):
-    dataframe_path, split_train = args
-    train_test_stratified_sampling(dataframe_path, split_train)
+    dataframe_path, split_train, seed, existing_split = args
+    train_test_stratified_sampling(dataframe_path, split_train, seed, existing_split)
 
 
 def parse_args():
     parser = ArgumentParser(description='merge dataset')
-    # parser.add_argument(
-    #     "--metadata_path",
-    #     type=str,
-    #     help="path to metadata of the dataset (.csv)",
-    # )
     parser.add_argument(
         "--data_path",
         type=str,
@@ -95,9 +187,22 @@ def parse_args():
     parser.add_argument(
         "--split_train",
         action='store_true',
-        help="split 3 sets for training",
+        help="split the train repos into 3 sets for training",
     )
-    
+    parser.add_argument(
+        "--existing_split",
+        type=str,
+        default=None,
+        help="root dir of a previous split (<lang>/<lang>_repo_split.csv), "
+             "only the repos of the new records are assigned",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=SEED,
+        help="seed of the repo hashes",
+    )
+
     return parser.parse_args()
 
 
@@ -106,27 +211,24 @@ if __name__ == '__main__':
     data_path = opt.data_path
     languages = os.listdir(data_path)
     file_list = []
-    
-    look_pattern = "*meta.csv"
-    if opt.split_train:
-        look_pattern = "*train.csv"
-        
+
     for _lang in languages:
-        file_list.extend(glob.glob(os.path.join(data_path, _lang, look_pattern)))
-    
+        meta_files = glob.glob(os.path.join(data_path, _lang, "*meta.parquet"))
+        # Metadata written by older versions of merge.py
+        file_list.extend(meta_files or glob.glob(os.path.join(data_path, _lang, "*meta.csv")))
+
+    args = []
+    for file in file_list:
+        existing_split = None
+        if opt.existing_split:
+            language = os.path.basename(os.path.dirname(file))
+            existing_split = os.path.join(opt.existing_split, language, f'{language}_repo_split.csv')
+            if not os.path.exists(existing_split):
+                existing_split = None
+        args.append((file, opt.split_train, opt.seed, existing_split))
     if opt.multiprocess:
         with Pool(processes=len(file_list)) as pool:
-            args = [(file, opt.split_train) for file in file_list]
             pool.map(train_test_split_wrapper, args)
     else:
-        for file in file_list:
-            train_test_stratified_sampling(file)
-    
-    # data_path = "/datadrive/dungnm31/data-ai4code/hackathon/java_meta.csv"
-    # df = pd.read_csv(data_path)
-    # stratified_sampling(df, ['Code Length', 'Docs Length'])
-    
-    # csv_file = pd.read_csv("/datadrive/dungnm31/data-ai4code/hackathon/java_meta.csv")
-    # save_path = "/datadrive/dungnm31/data-ai4code/"
-
-    # stratified_sampling(csv_file, 1000, save_path)
+        for arg in tqdm(args):
+            train_test_split_wrapper(arg)
@@ -0,0 +1,85 @@
+"""
+Train subsets (small/medium/large) as views of `full_train.jsonl`.
+
+`mapping.py` writes the train samples once, to `full_train.jsonl`, and each
+subset as an index file `{subset}.idx` of (byte offset, byte length) records
+of its lines in `full_train.jsonl`. `SubsetReader` serves a subset by seeking.
+"""
+import os
+import argparse
+from typing import Iterator, Union
+
+import numpy as np
+from tqdm import tqdm
+
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8')])
+FULL_TRAIN = 'full_train.jsonl'
+
+
+def subset_index_path(data_path: str, set_name: str) -> str:
+    return os.path.join(data_path, f'{set_name}.idx')
+
+
+def write_index(file, offsets: list, lengths: list):
+    records = np.empty(len(offsets), dtype=INDEX_DTYPE)
+    records['offset'] = offsets
+    records['length'] = lengths
+    records.tofile(file)
+
+
+class SubsetReader:
+    """
+    Samples (JSONL lines) of a subset read from `full_train.jsonl` through
+    its index, e.g. `SubsetReader.from_dir('python', 'small_train')[-10:]`
+    """
+    def __init__(self, data_path: str, index_path: str):
+        self.data_path = data_path
+        self.index = np.fromfile(index_path, dtype=INDEX_DTYPE)
+        self.file = open(data_path, 'rb')
+
+    @classmethod
+    def from_dir(cls, data_path: str, set_name: str):
+        return cls(os.path.join(data_path, FULL_TRAIN), subset_index_path(data_path, set_name))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read(self, offset: int, length: int) -> str:
+        self.file.seek(offset)
+        return self.file.read(length).decode('utf-8')
+
+    def __getitem__(self, item: Union[int, slice]):
+        if isinstance(item, slice):
+            return [self._read(offset, length) for offset, length in self.index[item].tolist()]
+        offset, length = self.index[item].tolist()
+        return self._read(offset, length)
+
+    def __iter__(self) -> Iterator[str]:
+        # Offsets increase, so reads only move forward in the file
+        for offset, length in self.index.tolist():
+            yield self._read(offset, length)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Write a train subset as a standalone JSONL file')
+    parser.add_argument('--data_path', type=str, help='Language dir containing full_train.jsonl and the indexes')
+    parser.add_argument('--subset', type=str, default='small_train', help='Subset to materialize')
+    parser.add_argument('--save_path', type=str, help='Output JSONL file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+    with SubsetReader.from_dir(opt.data_path, opt.subset) as reader, open(opt.save_path, 'w') as writer:
+        for line in tqdm(reader, total=len(reader)):
+            writer.write(line)
@@ -15,6 +15,8 @@ from tree_sitter import Parser, Language
 from codetext.parser import *
 from codetext.utils import build_language
 from src.utils.logger import create_logger
+from src.sidecar.jsonl_index import JsonlIndex
+from src.sidecar.sample_stats import write_stats
 from src.utils import extract_node, get_line_definitions,\
     get_node_definitions, process_raw_node, write_jsonl
 
@@ -41,8 +43,9 @@ def main(opt):
         if not str(opt.data_path).endswith(('json', 'jsonl')):
             raise ValueError("Not found `json` or `jsonl` file, instead found %s" % opt.data_path)
         
-        with open(opt.data_path, 'r') as json_file:
-            dataset = list(json_file)
+        # Lines are read through the sidecar line index: workers get the
+        # path and map the file instead of receiving a copy of its lines
+        dataset = JsonlIndex(opt.data_path)
             
     elif opt.cons_from_raw:
         logger.info("============ Load dataset from dir %s ... ============" % opt.data_path)
@@ -68,6 +71,9 @@ def main(opt):
     logger.info("Spliting %i samples into %i sub-dataset with chunk size %i" % (dataset_size, opt.n_split, chunk_size))
     
     jobs_list = [index_list[x:x+chunk_size] for x in range(0, dataset_size, chunk_size)]  # n set
+    if opt.load_from_file and not opt.n_sample:
+        # Line ranges of about the same size in bytes
+        jobs_list = [range(start, end) for start, end in dataset.partitions(opt.n_split)]
     args = []
     for idx, job_index in enumerate(jobs_list):
         args.append([dataset, job_index, opt, idx]) # opt.language, opt.save_path, idx, is_file])
@@ -194,7 +200,7 @@ def extracting(dataset, indexs, ast, lang_parser, thread_idx, opt):
             raw_set.extend(raw_fn)
             if opt.raw_only:
                 continue
-            filtered_fn_list = list(get_node_definitions(raw_fn))
+            filtered_fn_list = list(get_node_definitions(raw_fn, opt.check_language))
             if str(language).lower() == 'go':
                 extracted_function_list = filtered_fn_list
             else:
@@ -206,7 +212,7 @@ def extracting(dataset, indexs, ast, lang_parser, thread_idx, opt):
         elif opt.level == 'class':
             if not str(language).lower() in ['go', 'c']:
                 raw_class = list(process_raw_node(tree, raw_code, lang_parser, metadata_data, is_class=True))
-                filtered_class_list = list(get_node_definitions(raw_class, raw_code))
+                filtered_class_list = list(get_node_definitions(raw_class, opt.check_language))
                 extracted_class_list = list(extract_node(filtered_class_list, language))
             
                 raw_set.extend(raw_class)    
@@ -223,9 +229,10 @@ def extracting(dataset, indexs, ast, lang_parser, thread_idx, opt):
     filtered_path = os.path.join(save_path, 'filtered')
     extracted_path = os.path.join(save_path, 'extracted')
     
-    write_jsonl(raw_set, os.path.join(raw_path, f'batch_{thread_idx}_{opt.level}.jsonl'))
-    write_jsonl(filtered_set, os.path.join(filtered_path, f'batch_{thread_idx}_{opt.level}.jsonl'))
-    write_jsonl(extracted_set, os.path.join(extracted_path, f'batch_{thread_idx}_{opt.level}.jsonl'))
+    for samples, path in [(raw_set, raw_path), (filtered_set, filtered_path), (extracted_set, extracted_path)]:
+        write_jsonl(samples, os.path.join(path, f'batch_{thread_idx}_{opt.level}.jsonl'))
+        # Token/char/comment counts, aligned with the lines, for the split stage
+        write_stats(samples, os.path.join(path, f'batch_{thread_idx}_{opt.level}.jsonl'))
     
     res = [len(raw_set), len(filtered_set), len(extracted_set)]
     msg = '====== End of batch {} ====== \n'.format(thread_idx) + \
@@ -298,6 +305,11 @@ if __name__ == '__main__':
         action='store_true',
         help=''
     )
+    parser.add_argument(
+        '--check_language',
+        action='store_true',
+        help='Also drop non-English docstrings (scored in one batch per file)'
+    )
     
     # Processing on multiple CPUs
     parser.add_argument(
@@ -0,0 +1,205 @@
+"""
+Sidecar line index of JSONL files.
+
+`build_index` writes `<file>.idx` next to a JSONL file in one streaming pass:
+the byte offset of every line then the file size, as n + 1 little-endian
+uint64. `JsonlIndex` memory-maps the file and its index, so that its length,
+any line or slice and any line range are read without scanning the file, and
+N workers can each take one partition of the same file.
+
+With `id_field`, `<file>.ids.idx` also maps the id of each sample to its line
+(16-byte digest of the id and line number, sorted by digest).
+"""
+import os
+import mmap
+import json
+import hashlib
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+INDEX_SUFFIX = '.idx'
+ID_INDEX_SUFFIX = '.ids.idx'
+OFFSET_DTYPE = np.dtype('<u8')
+DIGEST_SIZE = 16
+ID_RECORD = np.dtype([('digest', f'V{DIGEST_SIZE}'), ('line', '<u8')])
+# Bytes scanned for newlines at once
+BLOCK_SIZE = 1 << 24
+
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def id_index_path(path: str) -> str:
+    return path + ID_INDEX_SUFFIX
+
+
+def id_digest(sample_id) -> bytes:
+    return hashlib.blake2b(str(sample_id).encode(), digest_size=DIGEST_SIZE).digest()
+
+
+def is_fresh(path: str, sidecar_path: str) -> bool:
+    """
+    Whether a sidecar exists and is not older than its JSONL file
+    """
+    return os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(path)
+
+
+def build_index(path: str, block_size: int = BLOCK_SIZE) -> int:
+    """
+    Write the line offsets of a JSONL file to `<file>.idx`
+
+    Return:
+        Number of lines
+    """
+    size = os.path.getsize(path)
+    n_lines = 0
+    with open(path, 'rb') as file, open(index_path(path) + '.tmp', 'wb') as writer:
+        if size:
+            np.zeros(1, dtype=OFFSET_DTYPE).tofile(writer)
+            n_lines = 1
+        position = 0
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            starts = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + position + 1
+            # No line starts after a trailing newline
+            starts = starts[starts < size].astype(OFFSET_DTYPE)
+            starts.tofile(writer)
+            n_lines += len(starts)
+            position += len(block)
+        np.array([size], dtype=OFFSET_DTYPE).tofile(writer)
+    os.replace(index_path(path) + '.tmp', index_path(path))
+    return n_lines
+
+
+def build_id_index(path: str, id_field: str = 'id') -> int:
+    """
+    Write the (id digest, line) records of a JSONL file, sorted by digest,
+    to `<file>.ids.idx`. Lines that are not JSON or have no `id_field` are
+    left out.
+
+    Return:
+        Number of indexed samples
+    """
+    digests, lines = [], []
+    with open(path, 'rb') as file:
+        for line_number, line in enumerate(file):
+            try:
+                sample_id = json.loads(line).get(id_field)
+            except (ValueError, AttributeError):
+                continue
+            if sample_id is None:
+                continue
+            digests.append(id_digest(sample_id))
+            lines.append(line_number)
+
+    records = np.empty(len(lines), dtype=ID_RECORD)
+    records['digest'] = np.frombuffer(b''.join(digests), dtype=ID_RECORD['digest'])
+    records['line'] = lines
+    records.sort(order='digest', kind='stable')
+    records.tofile(id_index_path(path))
+    return len(records)
+
+
+class JsonlIndex:
+    """
+    Random access to the lines of a JSONL file through its sidecar index,
+    e.g. `JsonlIndex('python.jsonl')[1000:1010]`. The index is built if it is
+    missing or older than the file (or, with `build=False`, an error raised).
+
+    Only the path is pickled: a copy sent to a worker maps the file again.
+    """
+    def __init__(self, path: str, id_field: str = None, build: bool = True):
+        self.path = path
+        self.id_field = id_field
+        for sidecar_path, builder in [(index_path(path), build_index)] + (
+                [(id_index_path(path), lambda path: build_id_index(path, id_field))] if id_field else []):
+            if not is_fresh(path, sidecar_path):
+                if not build:
+                    raise FileNotFoundError(f"No up-to-date index {sidecar_path}")
+                builder(path)
+
+        self.offsets = np.fromfile(index_path(path), dtype=OFFSET_DTYPE)
+        if len(self.offsets) == 0 or int(self.offsets[-1]) != os.path.getsize(path):
+            raise ValueError(f"Index {index_path(path)} does not match {path}")
+        self.ids = np.fromfile(id_index_path(path), dtype=ID_RECORD) if id_field else None
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def size(self) -> int:
+        return int(self.offsets[-1])
+
+    def line(self, item: int) -> bytes:
+        """
+        Raw bytes of a line, newline included
+        """
+        item = range(len(self))[item]
+        return self.data[self.offsets[item]:self.offsets[item + 1]]
+
+    def __getitem__(self, item: Union[int, slice]):
+        if isinstance(item, slice):
+            return [self.line(line).decode('utf-8') for line in range(len(self))[item]]
+        return self.line(item).decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_range(0, len(self))
+
+    def iter_range(self, start: int, end: int) -> Iterator[str]:
+        for line in range(start, end):
+            yield self.line(line).decode('utf-8')
+
+    def loads(self, item: int) -> dict:
+        return json.loads(self.line(item))
+
+    def byte_range(self, start: int, end: int) -> Tuple[int, int]:
+        """
+        (start, end) byte offsets of the lines `start` to `end` (excluded)
+        """
+        return int(self.offsets[start]), int(self.offsets[end])
+
+    def partitions(self, n_parts: int) -> List[Tuple[int, int]]:
+        """
+        Split the lines into at most `n_parts` (start, end) line ranges of
+        about the same number of bytes
+        """
+        targets = np.linspace(0, self.size, n_parts + 1)
+        bounds = np.unique(np.searchsorted(self.offsets[:-1], targets[1:-1], side='left'))
+        bounds = [0] + [int(bound) for bound in bounds if 0 < bound < len(self)] + [len(self)]
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+    def find(self, sample_id) -> Optional[int]:
+        """
+        Line of the sample with this id, or None
+        """
+        if self.ids is None:
+            raise ValueError("JsonlIndex opened without `id_field`")
+        digest = np.array(id_digest(sample_id), dtype=ID_RECORD['digest'])
+        position = np.searchsorted(self.ids['digest'], digest)
+        if position < len(self.ids) and self.ids['digest'][position] == digest:
+            return int(self.ids['line'][position])
+        return None
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return {'path': self.path, 'id_field': self.id_field}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['id_field'], build=False)
@@ -0,0 +1,61 @@
+"""
+Numeric sidecar of per-sample statistics of JSONL files.
+
+`<file>.stats` holds one `STATS_DTYPE` record per line of `<file>`, in the
+same order: token, character and comment counts computed once when samples
+are written (`processing.py`, `merge.py`). Later stages read the lengths from
+it instead of decoding the samples again.
+"""
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+
+from src.sidecar.jsonl_index import is_fresh
+
+
+STATS_SUFFIX = '.stats'
+STATS_DTYPE = np.dtype([
+    ('code_tokens', '<i4'),
+    ('docstring_tokens', '<i4'),
+    ('code_chars', '<i4'),
+    ('docstring_chars', '<i4'),
+    ('comments', '<i4'),
+])
+
+
+def stats_path(path: str) -> str:
+    return path + STATS_SUFFIX
+
+
+def sample_stats(sample: dict) -> tuple:
+    """
+    (code tokens, docstring tokens, code chars, docstring chars, comments) of a sample
+    """
+    return (len(sample.get('code_tokens') or ()), len(sample.get('docstring_tokens') or ()),
+            len(sample.get('code') or ''), len(sample.get('docstring') or ''), len(sample.get('comment') or ()))
+
+
+def stats_array(samples: Iterable[dict]) -> np.ndarray:
+    return np.array([sample_stats(sample) for sample in samples], dtype=STATS_DTYPE)
+
+
+def write_stats(samples: Iterable[dict], path: str):
+    """
+    Append the statistics of samples written (appended) to the JSONL file `path`
+    """
+    with open(stats_path(path), 'ab') as file:
+        stats_array(samples).tofile(file)
+
+
+def read_stats(path: str) -> Optional[np.ndarray]:
+    """
+    Memory-mapped statistics of the JSONL file `path`, None if it has no
+    sidecar or the sidecar is older than the file
+    """
+    sidecar_path = stats_path(path)
+    if not is_fresh(path, sidecar_path):
+        return None
+    if os.path.getsize(sidecar_path) == 0:
+        return np.zeros(0, dtype=STATS_DTYPE)
+    return np.memmap(sidecar_path, dtype=STATS_DTYPE, mode='r')
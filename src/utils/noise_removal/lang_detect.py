@@ -0,0 +1,180 @@
+"""
+Fast, offline English detection for docstrings.
+
+`langdetect` samples n-grams randomly and re-runs its estimation several
+times per text, which is far too slow to call on every docstring. Here the
+n-gram profiles shipped with `langdetect` are compacted once into a small
+log-probability matrix (Latin-script languages, ASCII n-grams only, since
+non-ASCII docstrings are already rejected by `check_docstring_literal`) and
+texts are scored deterministically with a naive Bayes sum.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+import langdetect
+
+
+PROFILE_PATH = os.path.join(os.path.dirname(langdetect.__file__), 'profiles')
+
+# Smoothing for n-grams never seen in a language profile
+ALPHA = 1e-5
+# A profile is kept if at least this ratio of its characters are ASCII letters
+MIN_ASCII_RATIO = 0.5
+# Texts with fewer n-grams are not scored (too short to decide, assume English)
+MIN_NGRAMS = 24
+# Another language must beat English by this log-likelihood per n-gram, short
+# technical phrases ("Get user name") otherwise flip to a random language
+MIN_MARGIN = 0.2
+CACHE_SIZE = 100000
+
+ENGLISH = 'en'
+# Common English function words, a text made of enough of them is obviously English
+ENGLISH_STOPWORDS = frozenset([
+    'the', 'of', 'and', 'to', 'a', 'an', 'in', 'is', 'it', 'for', 'that', 'this',
+    'with', 'be', 'by', 'on', 'as', 'are', 'or', 'if', 'from', 'at', 'not', 'which',
+    'will', 'should', 'can', 'returns', 'return', 'given', 'when', 'otherwise',
+])
+STOPWORD_RATIO = 0.2
+
+
+class LanguageModel:
+    """
+    Character 1-3 gram naive Bayes model over the ASCII part of `langdetect` profiles
+    """
+    def __init__(self, profile_path: str = PROFILE_PATH):
+        languages, profiles = [], []
+        for filename in sorted(os.listdir(profile_path)):
+            with open(os.path.join(profile_path, filename), 'r', encoding='utf-8') as file:
+                profile = json.load(file)
+
+            unigrams = {gram: freq for gram, freq in profile['freq'].items() if len(gram) == 1}
+            total = sum(unigrams.values())
+            ascii_letters = sum(freq for gram, freq in unigrams.items() if gram.isascii() and gram.isalpha())
+            if total == 0 or ascii_letters / total < MIN_ASCII_RATIO:
+                continue
+            languages.append(profile['name'])
+            profiles.append(profile)
+
+        vocab = {}
+        for profile in profiles:
+            for gram in profile['freq']:
+                if gram not in vocab and gram.isascii() and gram.replace(' ', '').isalpha():
+                    vocab[gram] = len(vocab)
+
+        prob = np.zeros((len(vocab), len(languages)), dtype=np.float64)
+        for lang_idx, profile in enumerate(profiles):
+            n_words = profile['n_words']
+            for gram, freq in profile['freq'].items():
+                row = vocab.get(gram)
+                if row is not None:
+                    prob[row, lang_idx] = freq / n_words[len(gram) - 1]
+
+        self.languages = languages
+        self.vocab = vocab
+        self.log_prob = np.log(prob + ALPHA).astype(np.float32)
+
+    def extract_ngrams(self, text: str) -> List[int]:
+        """
+        Return the vocabulary rows of all 1-3 grams of `text` (same windows as
+        `langdetect.utils.ngram.NGram`, words are padded with a space)
+        """
+        rows = []
+        for word in ''.join(ch if ch.isalpha() else ' ' for ch in text).split():
+            # `langdetect` ignores all-caps words (acronyms, constants)
+            if len(word) > 1 and word.isupper():
+                continue
+            padded = f' {word} '
+            for n in (1, 2, 3):
+                for i in range(len(padded) - n + 1):
+                    row = self.vocab.get(padded[i:i + n])
+                    if row is not None:
+                        rows.append(row)
+        return rows
+
+    def predict(self, texts: List[str]) -> List[str]:
+        """
+        Score all texts in one batch, return the most likely language of each
+        text (or English for texts too short or too close to English)
+        """
+        results = [ENGLISH] * len(texts)
+        scored, rows, offsets = [], [], []
+        for idx, text in enumerate(texts):
+            text_rows = self.extract_ngrams(text)
+            if len(text_rows) < MIN_NGRAMS:
+                continue
+            scored.append(idx)
+            offsets.append(len(rows))
+            rows.extend(text_rows)
+
+        if scored:
+            # Sum the log-probabilities of each text's n-grams in one reduction
+            scores = np.add.reduceat(self.log_prob[rows], offsets, axis=0)
+            lengths = np.diff(offsets + [len(rows)])
+            best = scores.argmax(axis=1)
+            english = self.languages.index(ENGLISH)
+            margin = (scores[np.arange(len(scored)), best] - scores[:, english]) / lengths
+            for idx, lang_idx, lang_margin in zip(scored, best, margin):
+                if lang_margin >= MIN_MARGIN:
+                    results[idx] = self.languages[lang_idx]
+        return results
+
+
+@lru_cache(maxsize=1)
+def get_language_model() -> LanguageModel:
+    return LanguageModel()
+
+
+_cache = OrderedDict()
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def is_obviously_english(text: str) -> bool:
+    if not text.isascii():
+        return False
+    words = text.lower().split()
+    if not words:
+        return False
+    n_stopwords = sum(1 for word in words if word in ENGLISH_STOPWORDS)
+    return n_stopwords >= 2 and n_stopwords / len(words) >= STOPWORD_RATIO
+
+
+def detect_languages(texts: List[str]) -> List[str]:
+    """
+    Detect the language of each text. Results are cached by text hash and
+    obviously-English ASCII texts never reach the model.
+    """
+    results = [None] * len(texts)
+    pending, pending_keys = [], []
+    for idx, text in enumerate(texts):
+        if is_obviously_english(text):
+            results[idx] = ENGLISH
+            continue
+        key = _text_key(text)
+        if key in _cache:
+            _cache.move_to_end(key)
+            results[idx] = _cache[key]
+            continue
+        pending.append(idx)
+        pending_keys.append(key)
+
+    if pending:
+        predictions = get_language_model().predict([texts[idx] for idx in pending])
+        for idx, key, lang in zip(pending, pending_keys, predictions):
+            results[idx] = lang
+            _cache[key] = lang
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return results
+
+
+def detect_language(text: str) -> str:
+    return detect_languages([text])[0]
@@ -1,17 +1,20 @@
 import re
 import sys
+import string
 import warnings
 from collections import Counter
+from functools import lru_cache
 from itertools import permutations
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Tuple, Union
 
-from langdetect import detect, detect_langs
 from bs4 import BeautifulSoup
 import Levenshtein as lev
 
 from tree_sitter import Node
 from codetext.parser.language_parser import tokenize_docstring, traverse_type
 from codetext.clean import remove_comment_delimiters
+from .lang_detect import ENGLISH, detect_languages
+from .matcher import LiteralMatcher
 warnings.filterwarnings("ignore", module='BeautifulSoup')
 
 
@@ -30,6 +33,16 @@ else:
     import regex
     SPLIT_REGEX = regex.compile("(?V1)"+REGEX_TEXT)
 
+CAMEL_CASE_REGEX = re.compile(r'.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
+
+# Identifiers are heavily repeated (Zipfian), split results are memoized
+IDENTIFIER_CACHE_SIZE = 2 ** 16
+
+_LOWER = frozenset(string.ascii_lowercase)
+_UPPER = frozenset(string.ascii_uppercase)
+_DIGIT = frozenset(string.digits)
+_QUOTE = frozenset("@$.'\"")
+
 
 def split_sentences(docstring):
     # sentences = re.split("(?<![\.])\.(?![\.\w])", docstring)
@@ -40,15 +53,61 @@ def split_sentences(docstring):
     return sentences
 
 
-def split_identifier_into_parts(identifier: str) -> List[str]:
+def _split_ascii_identifier(identifier: str) -> List[str]:
     """
-    Split a single identifier into parts on snake_case and camelCase
+    Single pass equivalent of `SPLIT_REGEX.split` for ASCII identifiers
     """
-    identifier_parts = list(s.lower() for s in SPLIT_REGEX.split(identifier) if len(s)>0)
+    parts = []
+    start = 0
+    length = len(identifier)
+    prev = ''
+    for i, ch in enumerate(identifier):
+        if ch == '_' or ch.isspace():
+            if start < i:
+                parts.append(identifier[start:i].lower())
+            start = i + 1
+            prev = ch
+            continue
+
+        if i > start:
+            if ch in _UPPER:
+                split = prev in _LOWER or prev in _DIGIT or prev in _QUOTE or \
+                    (prev in _UPPER and i + 1 < length and identifier[i + 1] in _LOWER)
+            elif ch in _LOWER:
+                split = prev in _DIGIT or prev in _QUOTE
+            elif ch in _DIGIT:
+                split = prev in _LOWER or prev in _UPPER or prev in _QUOTE
+            elif ch in _QUOTE:
+                split = prev in _LOWER or prev in _UPPER or prev in _DIGIT
+            else:
+                split = False
+            if split:
+                parts.append(identifier[start:i].lower())
+                start = i
+        prev = ch
+
+    if start < length:
+        parts.append(identifier[start:].lower())
+    return parts
+
+
+@lru_cache(maxsize=IDENTIFIER_CACHE_SIZE)
+def _split_identifier_into_parts(identifier: str) -> Tuple[str, ...]:
+    if identifier.isascii():
+        identifier_parts = _split_ascii_identifier(identifier)
+    else:
+        identifier_parts = [s.lower() for s in SPLIT_REGEX.split(identifier) if len(s)>0]
 
     if len(identifier_parts) == 0:
-        return [identifier]
-    return identifier_parts
+        return (identifier,)
+    return tuple(identifier_parts)
+
+
+def split_identifier_into_parts(identifier: str) -> List[str]:
+    """
+    Split a single identifier into parts on snake_case and camelCase
+    """
+    return list(_split_identifier_into_parts(identifier))
 
 
 def check_node_error(node: Node) -> bool:
@@ -148,6 +207,28 @@ def remove_link_in_brackets(docstring):
 #     return docstring
 
 
+AFTER_PATTERN_MATCHER = LiteralMatcher([
+    "E.g", "e.g", "eg.", "Eg.", # "See", "Sees", ">>>", # "Example",
+    # "<!doctype html>", 
+    "Example usage:", "Created by", "Example:", # "Example output", "For example"
+    # "TODO", "todo", "TO-DO", "to-do", "\\todo",
+
+    # COMMENT THIS OUT WHEN PROCESSING THE PARAMETER DOCSTRINGS
+    # "@param", "@return", 
+
+    # javascript
+    # "@constructor", "@extends", "@method", "@static", "@api", "@author", 
+    # "@since", "@private", "@throws", "@example", "@export", "@see", "@author",
+    # "@lisence", "@source", "@hidden", "@listens", "@deprecated", "@exception",
+
+    # # ??
+    # "@Route",
+
+    # C
+    "Note:", ". Note", "note::", "note:", ". note"
+])
+
+
 def remove_everything_after_a_pattern(docstring):
     """
     Only keep the part appears before the patterns.
@@ -155,49 +236,25 @@ def remove_everything_after_a_pattern(docstring):
                 
     This function is applied at docstring-level
     """
-    patterns = [
-                "E.g", "e.g", "eg.", "Eg.", # "See", "Sees", ">>>", # "Example",
-                # "<!doctype html>", 
-                "Example usage:", "Created by", "Example:", # "Example output", "For example"
-                # "TODO", "todo", "TO-DO", "to-do", "\\todo",
-
-                # COMMENT THIS OUT WHEN PROCESSING THE PARAMETER DOCSTRINGS
-                # "@param", "@return", 
-
-                # javascript
-                # "@constructor", "@extends", "@method", "@static", "@api", "@author", 
-                # "@since", "@private", "@throws", "@example", "@export", "@see", "@author",
-                # "@lisence", "@source", "@hidden", "@listens", "@deprecated", "@exception",
-
-                # # ??
-                # "@Route",
-
-                # C
-                "Note:", ". Note", "note::", "note:", ". note"
-                ]
-
-    for pattern in patterns:
-        docstring = docstring.strip().split(pattern)[0]
+    docstring = docstring.strip()
+    docstring = docstring[:AFTER_PATTERN_MATCHER.cut(docstring)]
 
     docstring = docstring.strip()
     return docstring
 
 
+URL_MATCHER = LiteralMatcher(["https:", "http:"])
+
+
 def remove_everything_after_an_url(docstring):
     """
     This function applies at sentence-level
     TO-DO: Should apply on docstring-level by regular expression
     """
-    patterns = ["https:", "http:"]
     sentences = split_sentences(docstring)
     sentences_ = []
     for sentence in sentences:
-        has_pattern = False
-        for pattern in patterns:
-            if pattern in sentence:
-                has_pattern = True
-                break
-        if has_pattern:
+        if URL_MATCHER.search(sentence):
             break
         sentences_.append(sentence)
     docstring = ". ".join(sentences_)
@@ -251,12 +308,16 @@ def remove_lines_contain_only_a_single_char(docstring):
     return docstring
 
 
+ANY_POSITION_MATCHER = LiteralMatcher(["/**", "/*", "<code>", "</code>", "*-*"])
+
+
 def remove_patterns_at_any_positions(docstring):
     """
     This function applies at docstring-level
     """
-    patterns = ["/**", "/*", "<code>", "</code>", "*-*"]
-    for pattern in patterns:
+    # Removing a pattern may create a new occurrence of a later one (e.g. "<co/*de>"),
+    # so each pattern is checked against the current docstring
+    for pattern in ANY_POSITION_MATCHER.patterns:
         if pattern in docstring:
             docstring = docstring.replace(pattern, "").strip()
 
@@ -368,6 +429,17 @@ def remove_unrelevant(docstring: str) -> str:
 
 # =================== Check code ======================
 
+BLACK_KEYWORDS = ['test_', 'Test_', '_test', 'toString', 'constructor', 'Constructor']
+
+
+@lru_cache(maxsize=None)
+def get_black_keyword_matcher(exclude_list: tuple = ()) -> LiteralMatcher:
+    """
+    Matcher of the black keywords extended by `exclude_list`, built once per list
+    """
+    return LiteralMatcher(BLACK_KEYWORDS + list(exclude_list))
+
+
 def check_black_node(node_name: str, exclude_list: List = None):
     """
     Check if node belongs to black list. E.g:
@@ -375,8 +447,7 @@ def check_black_node(node_name: str, exclude_list: List = None):
         - Test function, test class
         - Constructor
     """
-    black_keywords = ['test_', 'Test_', '_test', 'toString', 'constructor', 'Constructor']
-    black_keywords.extend(exclude_list)
+    black_keywords = get_black_keyword_matcher(tuple(exclude_list or ()))
     
     if not isinstance(node_name, str):
         raise ValueError(f'Expect str, get {type(node_name)}')
@@ -384,7 +455,7 @@ def check_black_node(node_name: str, exclude_list: List = None):
         return True
     if node_name.startswith('set') or node_name.startswith('get'):
         return True
-    if any(keyword in node_name for keyword in black_keywords):
+    if black_keywords.search(node_name):
         return True
     
     return False
@@ -405,17 +476,25 @@ def check_missing_function_metadata(metadata: Dict):
     return False
 
 
-def check_autogenerated_by_code(raw_code: str, identifier: str):
+def check_autogenerated_by_code(comment: str, identifier: str):
+    """
+    Check if the comment only restates the function name (e.g. "Get user name"
+    for `getUserName`), i.e. their edit distance is at most 40% of the longest
+    """
     threshold = 0.4
     fn_name_splited = split_identifier_into_parts(identifier)
     fn_name_splited = ' '.join(fn_name_splited).lower()
     
-    comment = str(re.sub(r'[^a-zA-Z0-9]', ' ', comment)).lower()
+    comment = ' '.join(re.sub(r'[^a-zA-Z0-9]', ' ', comment).split()).lower()
 
-    d0 = lev.distance(fn_name_splited, comment)
-    d1 = max(len(fn_name_splited), len(comment))
+    max_distance = int(max(len(fn_name_splited), len(comment))*threshold)
+    # Edit distance is at least the length difference
+    if abs(len(fn_name_splited) - len(comment)) > max_distance:
+        return False
+    # Stop as soon as the distance exceeds `max_distance`
+    d0 = lev.distance(fn_name_splited, comment, score_cutoff=max_distance)
     
-    if d0 <= d1*threshold:
+    if d0 <= max_distance:
         # print('Auto-code')
         return True
     
@@ -438,28 +517,31 @@ def check_docstring_length(docstring: str):
     return False
 
 
-def check_docstring_literal(docstring: str):
+def check_docstring_literal(docstring: str, check_language: bool = False):
     """
     Check if docstring is EN
-    TODO: "Ce n'est pas en anglais" -> Fr
+    Non-ASCII docstrings are always rejected, ASCII ones are only checked by
+    the language model if `check_language` (e.g. "Ce n'est pas en anglais" -> Fr)
+    """
+    return check_docstring_literals([docstring], check_language)[0]
+
+
+def check_docstring_literals(docstrings: List[str], check_language: bool = False) -> List[bool]:
+    """
+    `check_docstring_literal` over a batch, the language model scores all
+    remaining docstrings in one pass
     """
     p = re.compile('[a-zA-Z0-9]')
-    if not docstring.isascii():
-        return True
-    if not p.search(docstring):
-        return True
-    # TODO: uncomment this
-    # try:
-    #     _docstring = re.sub(r'[^a-zA-Z0-9]', ' ', docstring)
-    #     _docstring = ' '.join(split_all_sepcial_case(_docstring))
-            
-    #     print(_docstring)
-    #     if detect(_docstring) != 'en':
-    #         print(detect_langs(_docstring))
-    #         return True
-    # except:
-    #     pass
-    return False
+    results = [not docstring.isascii() or not p.search(docstring) for docstring in docstrings]
+    if check_language:
+        pending = [idx for idx, result in enumerate(results) if not result]
+        texts = []
+        for idx in pending:
+            _docstring = re.sub(r'[^a-zA-Z0-9]', ' ', docstrings[idx])
+            texts.append(' '.join(split_all_sepcial_case(_docstring)))
+        for idx, language in zip(pending, detect_languages(texts)):
+            results[idx] = language != ENGLISH
+    return results
 
 
 def check_docstring_contain_question(docstring: str):
@@ -515,16 +597,12 @@ def check_docstring_contain_specific_pattern(docstring: str):
 
 # =================== Check characters ======================
 
+MATH_MATCHER = LiteralMatcher(["equation", "\\exp(", "\\log(", "\\sqrt(", "mathbf", "mathrm"])
+
+
 def does_str_containt_math(str):
-    math_indicators = ["equation", "\exp(", "\log(", "\sqrt(", "mathbf", "mathrm"]
     # TODO: page [number]
-    containt_math = False
-    for math_indicator in math_indicators:
-        if math_indicator in str:
-            containt_math = True
-            break
-
-    return containt_math
+    return MATH_MATCHER.search(str)
 
 
 def check_contain_little_alphabet_char(docstring: str):
@@ -539,27 +617,43 @@ def check_contain_little_alphabet_char(docstring: str):
     return len(docstring) > thresholds[0 + 2*int(contain_math)] and num_alphabet_chars / len(docstring) < thresholds[1 + 2*int(contain_math)]
 
 
+# Date/time and color placeholders (e.g. "HH:MM:SS", "R,G,B") are not noise, so
+# they are collapsed into a single word before counting special characters. The
+# replacement table is expanded once, in the same order the patterns are applied.
+SPECIAL_PATTERNS = [
+    (["HH", "MM", "SS"], (":", "-")),
+    (["MM", "DD", "YY"], (":", "-")),
+    (["MM", "DD", "YYYY"], (":", "-")),
+
+    (["hh", "mm", "ss"], (":", "-")),
+    (["mm", "dd", "yy"], (":", "-")),
+    (["mm", "dd", "yyyy"], (":", "-")),
+
+    (["R", "G", "B"], (",", "-")),
+
+    (["r", "g", "b"], (",", "-"))
+]
+SPECIAL_PATTERN_REPLACEMENTS = [
+    (sign.join(pm), "".join(pm).lower())
+    for pattern, signs in SPECIAL_PATTERNS
+    for sign in signs
+    for pm in permutations(pattern)
+]
+_SPECIAL_PATTERN_PARTS = sorted({part for pattern, _ in SPECIAL_PATTERNS for part in pattern}, key=len, reverse=True)
+# Superset of every entry in `SPECIAL_PATTERN_REPLACEMENTS`, matched in a single scan
+SPECIAL_PATTERN_REGEX = re.compile(
+    "(?:{0})[:,-](?:{0})[:,-](?:{0})".format("|".join(_SPECIAL_PATTERN_PARTS))
+)
+
+
 def convert_special_pattern(docstring):
-    patterns = [
-                (["HH", "MM", "SS"], (":", "-")),
-                (["MM", "DD", "YY"], (":", "-")),
-                (["MM", "DD", "YYYY"], (":", "-")),
-
-                (["hh", "mm", "ss"], (":", "-")),
-                (["mm", "dd", "yy"], (":", "-")),
-                (["mm", "dd", "yyyy"], (":", "-")),
-
-                (["R", "G", "B"], (",", "-")),
-
-                (["r", "g", "b"], (",", "-"))
-                ]
-    for pattern, signs in patterns:
-        for sign in signs:
-            pms = permutations(pattern)
-            for pm in pms:
-                string = sign.join(pm)
-                if string in docstring:
-                    docstring = docstring.replace(string, "".join(pm).lower())
+    # Almost no docstring contains any of the patterns, skip the table lookup
+    if not SPECIAL_PATTERN_REGEX.search(docstring):
+        return docstring
+
+    for string, replacement in SPECIAL_PATTERN_REPLACEMENTS:
+        if string in docstring:
+            docstring = docstring.replace(string, replacement)
     return docstring
 
 
@@ -570,7 +664,6 @@ def check_contain_many_special_char(docstring: str):
     docstring = docstring.strip()
     containt_math = does_str_containt_math(docstring)
     docstring = convert_special_pattern(docstring)
-    num_tokens = len(tokenize_docstring(docstring))
     counter = Counter(docstring)
 
     count = 0
@@ -598,8 +691,11 @@ def check_contain_many_special_char(docstring: str):
         if symb not in ["(", "[", "{"]:
             count += counter[symb]
 
-    return count > max(threshold_dict[1][0 + 2*int(containt_math)], threshold_dict[1][1 + 2*int(containt_math)]*num_tokens) \
-            and count > threshold_dict[2][int(containt_math)]
+    # Cheap absolute cap first, only tokenize when the ratio actually decides
+    if count <= threshold_dict[2][int(containt_math)]:
+        return False
+    num_tokens = len(tokenize_docstring(docstring))
+    return count > max(threshold_dict[1][0 + 2*int(containt_math)], threshold_dict[1][1 + 2*int(containt_math)]*num_tokens)
 
 
 def check_contain_little_unique_chars(docstring):
@@ -612,28 +708,22 @@ def check_contain_little_unique_chars(docstring):
 
 # =================== Check words ======================
 
+IGNORED_WORDS = frozenset(["the", "of", "a", "an", "it", "for", "or", "in", "but",])
+
+
 def check_contain_little_unique_words(docstring):
     threshold_dict = [3, 0.3]
-    ignored_words = ["the", "of", "a", "an", "it", "for", "or", "in", "but",]
-                     # ".", ",", "(", ")", "{", "}", "<", ">", "[", "]", "-", "|"]
-    docs = ' '.join(re.findall(r'\b[a-zA-Z0-9]+\b', docstring))
-    docstring_tokens = tokenize_docstring(docs)
-    counter = Counter(docstring_tokens)
-    try:
-        most_repeated_word = counter.most_common()[0][0]
-    except IndexError:
+    # Alphanumeric words are already single tokens for `tokenize_docstring`
+    docstring_tokens = re.findall(r'\b[a-zA-Z0-9]+\b', docstring)
+    if not docstring_tokens:
         return True
-    max_count = counter.most_common()[0][1]
 
-    index = 1
-    while most_repeated_word in ignored_words:
-        try:
-            most_repeated_word = counter.most_common()[index][0]
-            max_count = counter.most_common()[index][1]
-            index += 1
-        except IndexError:
-            return False
-    
+    # Highest count among the words which are not ignored (0 if all are ignored)
+    counter = Counter(docstring_tokens)
+    max_count = max([count for word, count in counter.items() if word not in IGNORED_WORDS], default=0)
+    if max_count == 0:
+        return False
+
     return max_count >= threshold_dict[0] and max_count / len(docstring_tokens) > threshold_dict[1]
 
 
@@ -660,10 +750,13 @@ def check_contain_little_unique_words(docstring):
 #     return len(docstring) > threshold_dict[0] and counter.most_common()[0][1] / len(docstring) > threshold_dict[1]
 
 
+UPPERCASE_PATTERN_MATCHER = LiteralMatcher(["DD", "MM", "YY", "YYYY", "R,G,B", "R-G-B", "SS", "HH", "API"])
+
+
 def check_contain_many_uppercase_word(docstring: str):
     threshold_dict = [10, 0.3]
-    patterns = ["DD", "MM", "YY", "YYYY", "R,G,B", "R-G-B", "SS", "HH", "API"]
-    for pattern in patterns:
+    # Lowercasing never creates an (uppercase) pattern, only the ones found need replacing
+    for pattern in UPPERCASE_PATTERN_MATCHER.findall(docstring):
         docstring = docstring.replace(pattern, pattern.lower())
 
     docstring = docstring.strip()
@@ -711,22 +804,46 @@ def check_contain_too_many_method_call(docstring):
     return len(method_call_identifiers)/len(total_words) > threshold_dict
 
 
+@lru_cache(maxsize=IDENTIFIER_CACHE_SIZE)
+def _camel_case_split(identifier: str) -> Tuple[str, ...]:
+    if not identifier.isascii() or '\n' in identifier:
+        return tuple(m.group(0) for m in CAMEL_CASE_REGEX.finditer(identifier))
+
+    # Single pass equivalent of `CAMEL_CASE_REGEX` for ASCII identifiers
+    parts = []
+    start = 0
+    length = len(identifier)
+    for i in range(1, length):
+        prev, ch = identifier[i - 1], identifier[i]
+        if ch in _UPPER and (prev in _LOWER or \
+                (prev in _UPPER and i + 1 < length and identifier[i + 1] in _LOWER)):
+            parts.append(identifier[start:i])
+            start = i
+    if start < length:
+        parts.append(identifier[start:])
+    return tuple(parts)
+
+
 def camel_case_split(identifier):
-    matches = re.finditer(r'.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)', identifier)
-    return [m.group(0) for m in matches]
+    return list(_camel_case_split(identifier))
 
 
 def snake_case_split(identifier):
     return identifier.strip().split("_")
 
 
+@lru_cache(maxsize=IDENTIFIER_CACHE_SIZE)
+def _split_special_token(token: str) -> Tuple[str, ...]:
+    sub_sub_tokens = []
+    for sub_token in snake_case_split(token):
+        sub_sub_tokens.extend(_camel_case_split(sub_token))
+    return tuple(sub_sub_tokens)
+
+
 def split_all_sepcial_case(docstring: str):
     docstring_tokens = []
     for token in tokenize_docstring(docstring.strip()):
-        sub_tokens = snake_case_split(token)
-        for sub_token in sub_tokens:
-            sub_sub_tokens = camel_case_split(sub_token)
-            docstring_tokens.extend(sub_sub_tokens)
+        docstring_tokens.extend(_split_special_token(token))
     
     return docstring_tokens
 
@@ -749,7 +866,7 @@ def check_contain_url(docstring: str):
 
 # =================== End checking ======================
 
-def check_function(node, node_metadata: Dict[str, Any], exclude_list: List = None, is_class=False):
+def check_function(node, node_metadata: Dict[str, Any], exclude_list: List = None, is_class=False, docstring: str = None):
     """
     Check function if
         - is built-in function (python)
@@ -757,10 +874,12 @@ def check_function(node, node_metadata: Dict[str, Any], exclude_list: List = Non
         - is empty 
         - is error node
         - have length < 3 lines
+        - have docstring auto-generated from its name
     
     Args:
         node (tree_sitter.Node): function node
         exclude_list (List): exclude name of function
+        docstring (str): function docstring (optional)
     Return:
         bool: pass the check or not
     """
@@ -775,6 +894,8 @@ def check_function(node, node_metadata: Dict[str, Any], exclude_list: List = Non
         return False
     if check_missing_function_metadata(node_metadata):
         return False
+    if docstring and check_autogenerated_by_code(docstring, node_identifier):
+        return False
     
     # If pass all the check, return True == passed!
     return True
@@ -859,17 +980,32 @@ def check_docstring(docstring: str, loosen_filter: bool = False):
     return result #, applied_res
 
 
-def clean_docstring(docstring: str, loosen_filter: bool = False):
+def clean_docstring(docstring: str, loosen_filter: bool = False, check_language: bool = False):
     """
     Clean docstring by removing special tag/url, characters, unrelevant information
+    (and non-English docstring if `check_language`)
     """
-    cleaned_docstring = []
-    if docstring == '' or docstring == None:
-        return None
-    _docstring = remove_comment_delimiters(docstring)
-    if check_docstring_literal(_docstring):  # True is not pass
-        return None #, [f"<check_docstring_literal> {docstring}"]
+    return clean_docstrings([docstring], loosen_filter, check_language)[0]
+
 
+def clean_docstrings(docstrings: List[str], loosen_filter: bool = False, check_language: bool = False):
+    """
+    `clean_docstring` over a batch (e.g. all functions of a file), so the
+    language stage scores the docstrings together
+    """
+    results = [None] * len(docstrings)
+    pending = [idx for idx, docstring in enumerate(docstrings) if docstring != '' and docstring != None]
+    _docstrings = [remove_comment_delimiters(docstrings[idx]) for idx in pending]
+    literal_fails = check_docstring_literals(_docstrings, check_language)
+    for idx, _docstring, literal_fail in zip(pending, _docstrings, literal_fails):
+        if literal_fail:  # True is not pass
+            continue
+        results[idx] = _clean_literal_docstring(_docstring, loosen_filter)
+    return results
+
+
+def _clean_literal_docstring(_docstring: str, loosen_filter: bool = False):
+    cleaned_docstring = []
     # _docstring = '\n'.join(remove_comment_delimiters(docstring))
     docstring_paragraph_list = _docstring.strip().split('\n\n')
     
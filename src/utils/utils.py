@@ -12,7 +12,7 @@ from tree_sitter import Language, Parser
 from codetext.utils import module_available
 from codetext.clean import remove_comment_delimiters
 from codetext.parser.language_parser import match_from_span, match_from_spans, tokenize_code, tokenize_docstring
-from utils.noise_removal.noise_removal import check_function, clean_docstring
+from utils.noise_removal.noise_removal import check_function, clean_docstring, clean_docstrings
 
 
 _DOCSTRING_PARSER_AVAILABLE = module_available("docstring_parser")
@@ -171,16 +171,17 @@ def process_raw_node(tree, blob: str, language_parser, metadata, is_class=False)
                 fn_metadata = language_parser.get_class_metadata(function)
             else:
                 fn_metadata = language_parser.get_function_metadata(function)
+            docstring = language_parser.get_docstring(function)
 
-            if check_function(function, fn_metadata, language_parser.BLACKLISTED_FUNCTION_NAMES, is_class=is_class):
-                outputs.append([function, fn_metadata])
+            if check_function(function, fn_metadata, language_parser.BLACKLISTED_FUNCTION_NAMES, is_class=is_class, docstring=docstring):
+                outputs.append([function, fn_metadata, docstring])
             else:
                 continue
 
         except Exception:
             continue
     
-    for function, fn_metadata in outputs:
+    for function, fn_metadata, docstring in outputs:
         try:
             comment_nodes = language_parser.get_comment_node(function)
             docstring_node = language_parser.get_docstring_node(function)
@@ -191,7 +192,6 @@ def process_raw_node(tree, blob: str, language_parser, metadata, is_class=False)
             if comment_nodes:
                 exclude_node.extend(comment_nodes)
             
-            docstring = language_parser.get_docstring(function)
             code = match_from_span(function, blob)
             code_tokens = tokenize_code(function, blob, exclude_node)
             
@@ -235,12 +235,13 @@ def process_raw_node(tree, blob: str, language_parser, metadata, is_class=False)
         yield fn_metadata
         
         
-def get_node_definitions(metadata: List) -> List:
+def get_node_definitions(metadata: List, check_language: bool = False) -> List:
     """
     Filter non-quality node by docstring 
     Args:
         metadata (List): List of function or class metadata
-        blob (str): source code
+        check_language (bool): Also drop non-English docstrings, all docstrings
+            of `metadata` are scored by the language model in one batch
     Returns:
         List[str]: List contains these keys
             - 'identifier'
@@ -252,16 +253,14 @@ def get_node_definitions(metadata: List) -> List:
             - 'docstring_tokens' (modified)
             - 'comment'
     """
-    for node_metadata in metadata:
-        code = node_metadata['code']
-        docstring = node_metadata['original_docstring']
+    metadata = [node_metadata for node_metadata in metadata if node_metadata['original_docstring'] != None]
+    # change clean_comment -> clean_docstring
+    # (the code used to be passed as `loosen_filter`, which always loosened it)
+    docstrings = clean_docstrings([node_metadata['original_docstring'] for node_metadata in metadata],
+                                  loosen_filter=True, check_language=check_language)
+    for node_metadata, docstring in zip(metadata, docstrings):
         docstring_tokens = node_metadata['docstring_tokens']
 
-        if docstring == None:
-            continue
-        
-        # change clean_comment -> clean_docstring
-        docstring = clean_docstring(docstring, code)
         if docstring == None:  # Non-literal, Interrogation, UnderDevlop, auto code or no-docstring
             continue
         
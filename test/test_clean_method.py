@@ -1,8 +1,117 @@
 import unittest
+from unittest import mock
 
 from src.utils.noise_removal import *
+from src.utils.noise_removal.noise_removal import check_autogenerated_by_code, check_black_node, \
+    check_contain_little_unique_words, check_contain_many_special_char, check_docstring_literal, \
+    check_docstring_literals, clean_docstring, clean_docstrings, convert_special_pattern, remove_everything_after_a_pattern, split_all_sepcial_case, \
+    split_identifier_into_parts
+from src.utils.noise_removal.matcher import LiteralMatcher
+from src.utils.noise_removal.lang_detect import detect_languages
 from codetext.clean import remove_comment_delimiters
 
+
+# (docstring, check_contain_many_special_char, check_contain_little_unique_words)
+# Decisions recorded from the original implementations
+GOLDEN_CORPUS = [
+    ('Returns the message Id to use as heading text', False, False),
+    ('Set the time in HH:MM:SS format', False, False),
+    ('Date formatted as MM-DD-YYYY or DD:MM:YY', False, False),
+    ('Color given as R,G,B or r-g-b values', False, False),
+    ('Parse SS:HH:MM:SS timestamps', False, False),
+    ('a a a a b', False, False),
+    ('the the the the value', False, False),
+    ('the of a an it', False, False),
+    ('test test test foo bar baz qux quux corge grault', False, False),
+    ('value value value value and x', False, True),
+    ('foo foo foo bar', False, True),
+    ('@@@@@ $$$ ###', True, True),
+    ('foo(bar[baz{qux(quux(corge(grault(garply(waldo(fred)))))))', True, False),
+    ('x = a + b - c * d / e : f ^ g = h < i > j | k', False, False),
+    ('a + b + c + d ~ e - f - g - h = i = j = k | l | m ~ n ~ o < p > q', True, False),
+    ('equation \\exp(x) = y + z - w * v / u : t ^ s = r < q > p | o + n - m', False, False),
+    ('!!! ??? ~~~ ``` \'\'\' """', True, True),
+    ('HH:MM:SS-HH:MM:SS-HH:MM:SS-HH:MM:SS-HH:MM:SS-HH:MM:SS', True, True),
+    ('HH-MM-XX HH-MM-XX HH-MM-XX HH-MM-XX HH-MM-XX HH-MM-XX', True, True),
+    ('', False, True),
+    ('   ', False, True),
+    ('e.g. some value, more, commas, here, and, there', False, False),
+    ('Convert java.util.regex.Matcher groups to JavaScript groups', False, False),
+]
+
+
 class Test_Cleaning_Method(unittest.TestCase):
     def test_comment_delimiter(self):
-        pass
\ No newline at end of file
+        pass
+
+    def test_convert_special_pattern(self):
+        self.assertEqual(convert_special_pattern('Time in HH:MM:SS format'), 'Time in hhmmss format')
+        self.assertEqual(convert_special_pattern('MM-DD-YYYY'), 'mmddyyYY')
+        self.assertEqual(convert_special_pattern('SS:HH:MM:SS'), 'SS:hhmmss')
+        self.assertEqual(convert_special_pattern('Plain docstring, no pattern'), 'Plain docstring, no pattern')
+
+    def test_golden_corpus(self):
+        for docstring, many_special_char, little_unique_words in GOLDEN_CORPUS:
+            self.assertEqual(check_contain_many_special_char(docstring), many_special_char, docstring)
+            self.assertEqual(check_contain_little_unique_words(docstring), little_unique_words, docstring)
+
+    def test_docstring_language(self):
+        english = 'Compute checksum over payload bytes using CRC polynomial'
+        french = "Ce n'est pas en anglais mais en francais, la fonction retourne une valeur"
+        german = 'Gibt den Wert des Puffers zurueck wenn die Laenge groesser als null ist'
+        self.assertEqual(detect_languages([english, french, german, 'Get user name']), ['en', 'fr', 'de', 'en'])
+
+        self.assertFalse(check_docstring_literal(french))
+        self.assertTrue(check_docstring_literal(french, check_language=True))
+        self.assertFalse(check_docstring_literal(english, check_language=True))
+        self.assertTrue(check_docstring_literal('Trả về giá trị', check_language=True))
+
+    def test_docstring_language_batch(self):
+        english = 'Compute checksum over payload bytes using CRC polynomial'
+        french = "Ce n'est pas en anglais mais en francais, la fonction retourne une valeur"
+        german = 'Gibt den Wert des Puffers zurueck wenn die Laenge groesser als null ist'
+        target = 'src.utils.noise_removal.noise_removal.detect_languages'
+        with mock.patch(target, wraps=detect_languages) as detect:
+            self.assertEqual(check_docstring_literals([english, 'Trả về', french, german], check_language=True),
+                             [False, True, True, True])
+            self.assertEqual(detect.call_count, 1)
+            # The non-ASCII docstring never reaches the model
+            self.assertEqual(len(detect.call_args[0][0]), 3)
+
+            detect.reset_mock()
+            cleaned = clean_docstrings([english, None, french, ''], check_language=True)
+            self.assertEqual(detect.call_count, 1)
+            self.assertEqual(cleaned[1:], [None, None, None])
+            self.assertEqual(cleaned[0], clean_docstring(english))
+
+    def test_literal_matcher(self):
+        matcher = LiteralMatcher(["Note:", ". Note", "Note:"])
+        self.assertEqual(matcher.patterns, ("Note:", ". Note"))
+        self.assertTrue(matcher.search("See Note: here"))
+        self.assertEqual(matcher.findall("a. Note b"), [". Note"])
+        # "Note:" is cut first, ". Note" no longer fits inside the kept prefix
+        self.assertEqual(matcher.cut("Do X. Note: y"), 6)
+        self.assertEqual(remove_everything_after_a_pattern("Do X. Note: y"), "Do X.")
+        self.assertEqual(remove_everything_after_a_pattern("Sum values, e.g. 1 + 2"), "Sum values,")
+
+    def test_black_node(self):
+        self.assertTrue(check_black_node('test_parse'))
+        self.assertTrue(check_black_node('main', ['main']))
+        self.assertFalse(check_black_node('parse', ['main']))
+
+    def test_split_identifier(self):
+        self.assertEqual(split_identifier_into_parts('HTTPServerError2'), ['http', 'server', 'error', '2'])
+        self.assertEqual(split_identifier_into_parts('parse_json  file'), ['parse', 'json', 'file'])
+        self.assertEqual(split_identifier_into_parts('obj.getValue$'), ['obj', '.', 'get', 'value', '$'])
+        self.assertEqual(split_identifier_into_parts('___'), ['___'])
+        self.assertEqual(split_identifier_into_parts('ĐiềuKhiển'), ['điều', 'khiển'])
+        # Cached results must not leak mutations
+        split_identifier_into_parts('getUserName').append('x')
+        self.assertEqual(split_identifier_into_parts('getUserName'), ['get', 'user', 'name'])
+        self.assertEqual(split_all_sepcial_case('use HTTPServer_get_value'), ['use', 'HTTP', 'Server', 'get', 'value'])
+
+    def test_autogenerated_by_code(self):
+        self.assertTrue(check_autogenerated_by_code('/** Get user name. */', 'getUserName'))
+        self.assertTrue(check_autogenerated_by_code('Gets the user name', 'get_user_name'))
+        self.assertFalse(check_autogenerated_by_code('Look up the display name of the logged in user', 'getUserName'))
+        self.assertFalse(check_autogenerated_by_code('Parse', 'parseConfigurationFile'))
@@ -0,0 +1,453 @@
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from datasketch import MinHash
+
+from src.postprocess.deduplication.minhash import MAX_HASH, get_minhasher, jaccard
+from src.postprocess.deduplication.lsh import LSHIndex, optimal_param
+from src.postprocess.deduplication.store import SignatureStore
+from src.postprocess.deduplication.shingling import ngram_hashes, normalize_token, shingle_hashes, token_ids
+from src.postprocess.deduplication.contamination import check_contamination, parse_references
+from src.postprocess.deduplication.exact_dedup import DigestSet, build_digest_set, exact_deduplicate, extract_id
+from src.postprocess.deduplication.near_dedup import UnionFind, band_pairs, bucket_candidates, near_deduplicate, \
+    open_near_dedup_store, select_duplicates, stars_count
+from src.postprocess.deduplication.deduplication import jaccard_similarity, minhash_signature
+from src.postprocess.deduplication.minhash_deduplication import calculate_minhash_iter, deduplicate
+from src.postprocess.deduplication.flatten import flatten_sample, get_codes, infer_language
+
+
+def minhash(shingles, num_perm=128):
+    # 32-bit SHA-1 prefix of each string shingle, as `datasketch` hashes them
+    hashes = np.array([struct.unpack('<I', hashlib.sha1(shingle.encode('utf-8')).digest()[:4])[0]
+                       for shingle in set(shingles)], dtype=np.uint64)
+    return get_minhasher(num_perm).signature(hashes)
+
+
+def read_jsonl_file(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def legacy_minhash(shingles, num_perm=128):
+    kwargs = {'scheme': 'legacy'} if hasattr(MinHash(num_perm=1), 'scheme') else {}
+    signature = MinHash(num_perm=num_perm, **kwargs)
+    for shingle in set(shingles):
+        signature.update(shingle.encode('utf-8'))
+    return signature.hashvalues
+
+
+class Test_MinHash(unittest.TestCase):
+    def test_match_datasketch(self):
+        shingles = ['def foo (', 'foo ( x', '( x )', 'x ) :', ') : return', ': return x']
+        signature = minhash(shingles)
+        self.assertEqual(signature.dtype, np.uint32)
+        self.assertTrue(np.array_equal(signature, legacy_minhash(shingles)))
+
+    def test_jaccard(self):
+        set1 = [f'token {i}' for i in range(100)]
+        set2 = [f'token {i}' for i in range(20, 120)]
+        self.assertEqual(jaccard(minhash(set1), minhash(set1)), 1.0)
+        # True Jaccard similarity is 80 / 120
+        self.assertAlmostEqual(jaccard(minhash(set1, 256), minhash(set2, 256)), 80 / 120, delta=0.1)
+        self.assertTrue(np.all(minhash([]) == MAX_HASH))
+
+    def test_minhash_signature(self):
+        tokens = 'def add ( a , b ) : return a + b'.split()
+        signature = minhash_signature(tokens)
+        self.assertEqual(len(signature), 100)
+        self.assertEqual(jaccard_similarity(signature, minhash_signature(list(tokens))), 1.0)
+        self.assertIsNone(minhash_signature([]))
+
+
+    def test_calculate_minhash_iter(self):
+        tokens = [f'tok{i}' for i in range(20)]
+        lines = [
+            json.dumps({'id': 'a', 'code_tokens': tokens}),
+            json.dumps({'task_id': 'b', 'code_tokens': tokens[:3]}),  # no 3-gram with min size 5
+            'not json',
+            json.dumps({'problem_id': 'c', 'code_tokens': tokens[::-1]}),
+        ]
+        chunks = list(calculate_minhash_iter(lines, ngram=3, num_perm=16, chunk_size=2))
+        self.assertEqual([ids for ids, _ in chunks], [['a'], ['c']])
+        self.assertEqual(chunks[0][1].shape, (1, 16))
+        signature = get_minhasher(16).signature(shingle_hashes(tokens, 3))
+        self.assertTrue(np.array_equal(chunks[0][1][0], signature))
+
+
+class Test_Shingling(unittest.TestCase):
+    def test_ngram_hashes(self):
+        tokens = 'a = b + c ; a = b + c'.split()
+        hashes = ngram_hashes(token_ids(tokens), 3)
+        # 8 windows, "a = b", "= b +", "b + c" occur twice
+        self.assertEqual(len(hashes), 6)
+        self.assertTrue(np.all(hashes < 1 << 32))
+        self.assertEqual(len(ngram_hashes(token_ids(tokens[:2]), 3)), 0)
+        # Order matters inside a window
+        self.assertNotEqual(ngram_hashes(token_ids(['a', 'b']), 2)[0], ngram_hashes(token_ids(['b', 'a']), 2)[0])
+
+    def test_normalize(self):
+        self.assertEqual([normalize_token(token) for token in ['return', 'userName', '"abc"', '0x1F', '1.5e3', '+=']],
+                         ['return', 'ID', 'STR', 'NUM', 'NUM', '+='])
+        original = 'def add ( a , b ) : return a + b + 1'.split()
+        renamed = 'def plus ( x , y ) : return x + y + 2'.split()
+        self.assertFalse(np.array_equal(shingle_hashes(original, 3), shingle_hashes(renamed, 3)))
+        self.assertTrue(np.array_equal(shingle_hashes(original, 3, normalize=True),
+                                       shingle_hashes(renamed, 3, normalize=True)))
+        self.assertEqual(len(shingle_hashes(original[:4], 3)), 0)
+
+    def test_deduplicate(self):
+        tokens = [f'tok{i}' for i in range(50)]
+        set1 = [json.dumps({'id': 'src_near', 'code_tokens': tokens}),
+                json.dumps({'id': 'src_far', 'code_tokens': [f'other{i}' for i in range(50)]})]
+        set2 = [json.dumps({'id': 'tgt_near', 'code_tokens': tokens[:-1] + ['changed']}),
+                json.dumps({'id': 'tgt_far', 'code_tokens': [f'unrelated{i}' for i in range(50)]})]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as root:
+            os.chdir(root)
+            try:
+                store_path = os.path.join(root, 'store')
+                # The store is built from set1, then reused without reading set1
+                for source in (set1, []):
+                    deduplicate(iter(source), iter(set2), threshold=0.8, save_name='out.jsonl',
+                                source_store=store_path, chunk_size=1)
+                    self.assertEqual(read_jsonl_file('out.jsonl'), [{'tgt': 'tgt_near', 'src': ['src_near']}])
+                self.assertEqual(len(SignatureStore(store_path)), 2)
+            finally:
+                os.chdir(cwd)
+
+
+class Test_LSH(unittest.TestCase):
+    def test_optimal_param(self):
+        # Same parameters as `datasketch.MinHashLSH`
+        self.assertEqual(optimal_param(0.85, 100), (6, 16))
+        self.assertEqual(optimal_param(0.7, 128), (14, 9))
+
+    def test_query(self):
+        index = LSHIndex(threshold=0.8, num_perm=128)
+        base = [f'token {i}' for i in range(200)]
+        index.insert('same', minhash(base))
+        index.insert('near', minhash(base[:-5] + ['other 1', 'other 2']))
+        index.insert('far', minhash([f'other {i}' for i in range(200)]))
+
+        self.assertEqual(len(index), 3)
+        keys = [key for key, _ in index.query(minhash(base))]
+        self.assertEqual(keys, ['same', 'near'])
+        self.assertEqual(index.query(minhash(['unrelated a', 'unrelated b'])), [])
+        with self.assertRaises(ValueError):
+            index.insert('short', minhash(base, num_perm=64))
+
+
+class Test_SignatureStore(unittest.TestCase):
+    def test_append_and_reopen(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = SignatureStore(path, num_perm=4, shingling='test')
+            store.append(['a', 1], np.array([[1, 2, 3, 4], [5, 6, 7, 8]]))
+            store.append(['c'], [np.array([9, 10, 11, 12])])
+
+            store = SignatureStore(path, num_perm=4, shingling='test')
+            self.assertEqual(len(store), 3)
+            self.assertEqual(store.ids(), ['a', 1, 'c'])
+            self.assertEqual(store.signatures().dtype, np.uint32)
+            self.assertEqual(store.signatures()[2].tolist(), [9, 10, 11, 12])
+
+            with self.assertRaises(ValueError):
+                SignatureStore(path, num_perm=8, shingling='test')
+
+    def test_numeric_ids(self):
+        dtype = np.dtype([('line', '<i8'), ('stars', '<i8')])
+        with tempfile.TemporaryDirectory() as path:
+            store = SignatureStore(path, num_perm=2, id_dtype=dtype)
+            store.append([(0, 3), (4, 1)], np.array([[1, 2], [3, 4]]))
+            store.append(np.array([(7, 0)], dtype=dtype), np.array([[5, 6]]))
+
+            # Reopened with the parameters of a worker (`store.params`)
+            store = SignatureStore(path, **store.params)
+            self.assertEqual(store.ids().dtype, dtype)
+            self.assertEqual(store.ids()['line'].tolist(), [0, 4, 7])
+            self.assertEqual([(tuple(idx), row.tolist()) for idx, row in store][2], ((7, 0), [5, 6]))
+            self.assertFalse(os.path.exists(os.path.join(path, 'ids.txt')))
+            with self.assertRaises(ValueError):
+                SignatureStore(path, num_perm=2)
+
+    def test_recover_interrupted_append(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = SignatureStore(path, num_perm=2)
+            store.append(['a'], np.array([[1, 2]]))
+            # Rows written without the meta update of a completed append
+            with open(os.path.join(path, 'signatures.bin'), 'ab') as file:
+                file.write(b'\x00' * 5)
+            with open(os.path.join(path, 'ids.txt'), 'a') as file:
+                file.write('"partial')
+
+            store = SignatureStore(path, num_perm=2)
+            store.append(['b'], np.array([[3, 4]]))
+            self.assertEqual(list(store.ids()), ['a', 'b'])
+            self.assertEqual(store.signatures().tolist(), [[1, 2], [3, 4]])
+
+    def test_complete(self):
+        with tempfile.TemporaryDirectory() as path:
+            source = os.path.join(path, 'data.jsonl')
+            with open(source, 'w') as file:
+                file.write('{}\n')
+            store = SignatureStore(os.path.join(path, 'store'), num_perm=2)
+            store.append(['a'], np.array([[1, 2]]))
+            # A build killed before it finished is not complete
+            self.assertFalse(SignatureStore(store.path, num_perm=2).is_complete(source))
+            store.mark_complete(source)
+            self.assertTrue(SignatureStore(store.path, num_perm=2).is_complete(source))
+
+            # Nor is a store of a source file changed since
+            with open(source, 'a') as file:
+                file.write('{}\n')
+            self.assertFalse(store.is_complete(source))
+            self.assertFalse(store.is_complete(os.path.join(path, 'other.jsonl')))
+            store.clear()
+            self.assertEqual(len(SignatureStore(store.path, num_perm=2)), 0)
+            self.assertFalse(store.is_complete())
+
+
+class Test_NearDedup(unittest.TestCase):
+    def test_stars_count(self):
+        self.assertEqual([stars_count(value) for value in [3, 2.7, '12', '1,024', None, 'n/a', float('inf')]],
+                         [3, 2, 12, 1024, 0, 0, 0])
+
+    def test_union_find(self):
+        union_find = UnionFind(6)
+        union_find.union(4, 5)
+        union_find.union(1, 4)
+        union_find.union(2, 3)
+        self.assertEqual(union_find.roots().tolist(), [0, 1, 2, 2, 1, 1])
+
+    def test_select_duplicates(self):
+        roots = np.array([0, 1, 0, 0, 1, 5])
+        stars = np.array([3, 0, 10, 10, 0, 1])
+        # Keep the most starred sample, the first one on ties
+        self.assertEqual(select_duplicates(roots, stars).tolist(), [0, 3, 4])
+
+    def test_band_pairs(self):
+        base = [f'token {i}' for i in range(200)]
+        signatures = [
+            minhash(base),
+            minhash([f'other {i}' for i in range(200)]),
+            minhash(base[:-2] + ['x', 'y']),
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            store = SignatureStore(path, num_perm=128)
+            store.append([0, 1, 2], np.array(signatures))
+            pairs = np.concatenate([band_pairs(store, band, 9, 0.7) for band in range(14)])
+            self.assertEqual(np.unique(np.sort(pairs, axis=1), axis=0).tolist(), [[0, 2]])
+
+    def test_bucket_candidates(self):
+        order = np.arange(6)
+        left, right = bucket_candidates(order, np.array([1, 1, 1, 2, 3, 3], dtype=np.uint64))
+        self.assertEqual(sorted(zip(left.tolist(), right.tolist())), [(0, 1), (0, 2), (1, 2), (4, 5)])
+        # Large buckets: every member with the first one and with its neighbour
+        left, right = bucket_candidates(order[:4], np.ones(4, dtype=np.uint64), max_all_pairs=2)
+        self.assertEqual(sorted(zip(left.tolist(), right.tolist())), [(0, 1), (0, 2), (0, 3), (1, 2), (2, 3)])
+
+    def test_band_pairs_dissimilar_member(self):
+        rng = np.random.default_rng(0)
+        signature = rng.integers(0, 1 << 32, 128, dtype=np.uint32)
+        # Same first band for all three, the middle one differs everywhere else
+        dissimilar = np.concatenate([signature[:8], rng.integers(0, 1 << 32, 120, dtype=np.uint32)])
+        near = signature.copy()
+        near[-4:] += 1
+        with tempfile.TemporaryDirectory() as path:
+            store = SignatureStore(path, num_perm=128)
+            store.append([0, 1, 2], np.array([signature, dissimilar, near]))
+            self.assertEqual(band_pairs(store, 0, 8, 0.9).tolist(), [[0, 2]])
+
+    def test_near_deduplicate_interrupted_store(self):
+        tokens = [f'tok{i}' for i in range(50)]
+        # Stars counts as a float and as a string
+        samples = [{'code_tokens': tokens, 'stars_count': 1.0},
+                   {'code_tokens': [f'other{i}' for i in range(50)]},
+                   {'code_tokens': tokens[:-1] + ['changed'], 'stars_count': '5'}]
+        with tempfile.TemporaryDirectory() as path:
+            data_path, save_path = os.path.join(path, 'data.jsonl'), os.path.join(path, 'dedup.jsonl')
+            store_path = os.path.join(path, 'store')
+            with open(data_path, 'w') as file:
+                file.write(''.join(json.dumps(sample) + '\n' for sample in samples))
+            # A run killed after hashing the first sample only
+            store = open_near_dedup_store(store_path)
+            store.append([[0, 1]], np.zeros((1, 128), dtype=np.uint32))
+
+            near_deduplicate(data_path, save_path, store_path, chunk_size=1)
+            self.assertEqual(read_jsonl_file(save_path), samples[1:])
+            store = open_near_dedup_store(store_path)
+            self.assertEqual(len(store), 3)
+            self.assertIsInstance(store.ids(), np.memmap)
+            self.assertEqual(store.ids().tolist(), [(0, 1), (1, 0), (2, 5)])
+
+            # The store of another file is rebuilt, not applied to its line numbers
+            with open(data_path, 'w') as file:
+                file.write(''.join(json.dumps(sample) + '\n' for sample in samples[1:]))
+            near_deduplicate(data_path, save_path, store_path, chunk_size=1)
+            self.assertEqual(read_jsonl_file(save_path), samples[1:])
+            self.assertEqual(len(open_near_dedup_store(store_path)), 2)
+
+
+class Test_ExactDedup(unittest.TestCase):
+    def test_extract_id(self):
+        sample_id = 'a' * 64
+        line = json.dumps({'code': 'x = "id": "b"', 'meta': {'id': 'nested'}, 'id': sample_id})
+        self.assertEqual(extract_id(line), sample_id)
+        self.assertEqual(extract_id(json.dumps({'id': 'short'})), 'short')
+        self.assertIsNone(extract_id('not json'))
+
+    def test_exact_deduplicate(self):
+        def sha256(code):
+            return hashlib.sha256(code.encode()).hexdigest()
+
+        samples = [{'code': code, 'id': sha256(code)} for code in ['a', 'b', 'a', 'c', 'b', 'a']]
+        samples.append({'code': 'no id'})
+        samples.append({'code': 'no id'})
+        with tempfile.TemporaryDirectory() as path:
+            data_path = os.path.join(path, 'data.jsonl')
+            with open(data_path, 'w') as file:
+                for sample in samples:
+                    file.write(json.dumps(sample) + '\n')
+
+            save_path = os.path.join(path, 'dedup.jsonl')
+            report_path = os.path.join(path, 'report.csv')
+            index_dir = os.path.join(path, 'index')
+            self.assertEqual(exact_deduplicate(data_path, save_path, index_dir, report_path, num_shards=3), (4, 4))
+
+            with open(save_path, 'r') as file:
+                kept = [json.loads(line)['code'] for line in file]
+            self.assertEqual(kept, ['a', 'b', 'c', 'no id'])
+            with open(report_path, 'r') as file:
+                self.assertEqual(sorted(file.read().splitlines()[1:]),
+                                 sorted([f'{sha256(code)[:32]},{count}' for code, count in
+                                         [('a', 3), ('b', 2), ('no id', 2)]]))
+
+            digests = DigestSet(index_dir)
+            self.assertEqual(len(digests), 4)
+            self.assertIn(sha256('c'), digests)
+            self.assertNotIn(sha256('d'), digests)
+            queries = np.array([bytes.fromhex(sha256(code)[:32]) for code in 'dcab'], dtype='V16')
+            self.assertEqual(digests.contains(queries).tolist(), [False, True, True, True])
+
+    def test_exact_deduplicate_carriage_return(self):
+        # A raw carriage return inside a record must not shift the line numbers
+        lines = [b'{"code": "x\ry", "id": "%s"}\n' % (code * 64).encode() for code in 'abbc']
+        with tempfile.TemporaryDirectory() as path:
+            data_path = os.path.join(path, 'data.jsonl')
+            with open(data_path, 'wb') as file:
+                file.writelines(lines)
+            save_path = os.path.join(path, 'dedup.jsonl')
+            self.assertEqual(exact_deduplicate(data_path, save_path, os.path.join(path, 'index'), num_shards=3),
+                             (3, 1))
+            with open(save_path, 'rb') as file:
+                self.assertEqual(file.read(), lines[0] + lines[1] + lines[3])
+
+    def test_build_digest_set(self):
+        with tempfile.TemporaryDirectory() as path:
+            paths = []
+            for name, codes in [('a.jsonl', 'abc'), ('b.jsonl', 'cd')]:
+                paths.append(os.path.join(path, name))
+                with open(paths[-1], 'w') as file:
+                    for code in codes:
+                        file.write(json.dumps({'code': code}) + '\n')
+            digests = build_digest_set(paths, os.path.join(path, 'index'), num_shards=3)
+            self.assertEqual(len(digests), 4)
+            self.assertIn(hashlib.sha256(b'd').hexdigest(), digests)
+            self.assertEqual(len(build_digest_set([], os.path.join(path, 'empty'), num_shards=3)), 0)
+
+
+class Test_Contamination(unittest.TestCase):
+    def test_parse_references(self):
+        self.assertEqual(parse_references(['humaneval=a/b.jsonl', 'c/apps_test.jsonl']),
+                         {'humaneval': 'a/b.jsonl', 'apps_test': 'c/apps_test.jsonl'})
+        with self.assertRaises(ValueError):
+            parse_references(['a=x.jsonl', 'a=y.jsonl'])
+
+    def test_check_contamination(self):
+        def tokens(prefix):
+            return [f'{prefix}{i}' for i in range(30)]
+
+        with tempfile.TemporaryDirectory() as path:
+            def write(name, samples):
+                with open(os.path.join(path, name), 'w') as file:
+                    for sample in samples:
+                        file.write(json.dumps(sample) + '\n')
+                return os.path.join(path, name)
+
+            corpus = write('corpus.jsonl', [{'id': name, 'code_tokens': tokens(name)} for name in 'abcd'])
+            references = {
+                'humaneval': write('humaneval.jsonl', [{'task_id': 'HumanEval/0', 'code_tokens': tokens('b')}]),
+                'apps': write('apps.jsonl', [{'problem_id': 1, 'code_tokens': tokens('b')},
+                                             {'problem_id': 2, 'code_tokens': tokens('d')}]),
+            }
+            save_path = os.path.join(path, 'hits.jsonl')
+            filtered_path = os.path.join(path, 'filtered.jsonl')
+            report = check_contamination(corpus, references, save_path, filtered_path)
+
+            self.assertEqual(report, [['humaneval', 1, 1, 1], ['apps', 2, 2, 2]])
+            with open(save_path, 'r') as file:
+                self.assertEqual([json.loads(line)['id'] for line in file], ['b', 'd'])
+            with open(filtered_path, 'r') as file:
+                self.assertEqual([json.loads(line)['id'] for line in file], ['a', 'c'])
+
+    def test_reference_without_id(self):
+        with tempfile.TemporaryDirectory() as path:
+            corpus = os.path.join(path, 'corpus.jsonl')
+            reference = os.path.join(path, 'reference.jsonl')
+            with open(corpus, 'w') as file:
+                file.write(json.dumps({'id': 'a', 'code_tokens': [f'a{i}' for i in range(30)]}) + '\n')
+            with open(reference, 'w') as file:
+                for name in 'ba':
+                    file.write(json.dumps({'code_tokens': [f'{name}{i}' for i in range(30)]}) + '\n')
+            save_path = os.path.join(path, 'hits.jsonl')
+            report = check_contamination(corpus, {'ref': reference}, save_path)
+
+            self.assertEqual(report, [['ref', 2, 1, 1]])
+            with open(save_path, 'r') as file:
+                self.assertEqual([match['id'] for match in json.loads(file.readline())['matches']], [1])
+
+
+class Test_Flatten(unittest.TestCase):
+    def test_infer_language(self):
+        self.assertEqual(infer_language('humaneval-x/data/js/data/humaneval.jsonl.gz'), 'javascript')
+        self.assertEqual(infer_language('benchmarks/humaneval_cpp.jsonl'), 'cpp')
+        self.assertEqual(infer_language('benchmarks/python/apps.jsonl'), 'python')
+        self.assertIsNone(infer_language('benchmarks/humaneval.jsonl'))
+
+    def test_get_codes(self):
+        self.assertEqual(get_codes({'declaration': 'int f() {', 'canonical_solution': ' return 1; }'}),
+                         [(None, 'int f() { return 1; }')])
+        self.assertEqual(get_codes({'code': 'def f(): pass'}), [(None, 'def f(): pass')])
+        # APPS keeps a JSON encoded list of solutions
+        self.assertEqual(get_codes({'problem_id': 1, 'solutions': json.dumps(['print(1)', '', 'print(3)'])}),
+                         [(0, 'print(1)'), (2, 'print(3)')])
+        self.assertEqual(get_codes({'solutions': ['x = 1']}), [(0, 'x = 1')])
+        self.assertEqual(get_codes({'problem_id': 2, 'solutions': ''}), [])
+        self.assertEqual(get_codes({'task_id': 3}), [])
+
+    def test_flatten_sample_solutions(self):
+        def flatten_code(language, code, item, tree_sitter_path):
+            if code == 'broken':
+                return None
+            return {'docstring': item['question'], 'code': code, 'code_tokens': code.split()}
+
+        item = {'problem_id': 7, 'question': 'Print it.',
+                'solutions': json.dumps(['print(1)', 'broken', 'x = 2\nprint(x)'])}
+        with patch('src.postprocess.deduplication.flatten.flatten_code', side_effect=flatten_code):
+            samples = flatten_sample(('python', item, ''))
+        # One reference row per solution which parses
+        self.assertEqual([sample['id'] for sample in samples], ['7/0', '7/2'])
+        self.assertEqual([sample['code'] for sample in samples], ['print(1)', 'x = 2\nprint(x)'])
+        self.assertEqual(samples[1], {'id': '7/2', 'docstring': 'Print it.', 'code': 'x = 2\nprint(x)',
+                                      'code_tokens': ['x', '=', '2', 'print(x)']})
+
+    def test_flatten_sample_errors(self):
+        self.assertEqual(flatten_sample(('python', {'task_id': 1}, '')), [])
+        # A parsing failure skips the sample instead of raising in the worker
+        with patch('src.postprocess.deduplication.flatten.get_parser', side_effect=RuntimeError('no grammar')):
+            self.assertEqual(flatten_sample(('python', {'code': 'def f(): pass'}, '')), [])
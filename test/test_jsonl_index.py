@@ -0,0 +1,76 @@
+import os
+import json
+import pickle
+import tempfile
+import unittest
+
+from src.sidecar.jsonl_index import JsonlIndex, build_index, index_path
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as file:
+        file.write(''.join(lines))
+
+
+class Test_JsonlIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        self.samples = [{'id': f'id{i}', 'code': 'x = "é"\n' * i} for i in range(50)]
+        write_lines(self.path, [json.dumps(sample, ensure_ascii=False) + '\n' for sample in self.samples])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_build_index(self):
+        for lines in [[], ['a\n'], ['a\n', 'bc'], ['a\n', '\n', 'bc\n']]:
+            write_lines(self.path, lines)
+            self.assertEqual(build_index(self.path, block_size=2), len(lines))
+            with JsonlIndex(self.path) as index:
+                self.assertEqual(index[:], lines)
+
+    def test_random_access(self):
+        with open(self.path) as file:
+            lines = list(file)
+        with JsonlIndex(self.path) as index:
+            self.assertTrue(os.path.exists(index_path(self.path)))
+            self.assertEqual(len(index), 50)
+            self.assertEqual(index[7], lines[7])
+            self.assertEqual(index[-1], lines[-1])
+            self.assertEqual(index[10:20:3], lines[10:20:3])
+            self.assertEqual(list(index), lines)
+            self.assertEqual(index.loads(3), self.samples[3])
+            with self.assertRaises(IndexError):
+                index[50]
+
+    def test_partitions(self):
+        with JsonlIndex(self.path) as index:
+            for n_parts in [1, 3, 7, 100]:
+                partitions = index.partitions(n_parts)
+                self.assertLessEqual(len(partitions), n_parts)
+                self.assertEqual([line for start, end in partitions for line in index.iter_range(start, end)],
+                                 list(index))
+
+    def test_find(self):
+        with JsonlIndex(self.path, id_field='id') as index:
+            self.assertEqual(index.find('id42'), 42)
+            self.assertIsNone(index.find('missing'))
+
+    def test_stale_index(self):
+        JsonlIndex(self.path).close()
+        write_lines(self.path, ['{"id": "new"}\n'])
+        os.utime(index_path(self.path), (0, 0))
+        with self.assertRaises(FileNotFoundError):
+            JsonlIndex(self.path, build=False)
+        with JsonlIndex(self.path) as index:
+            self.assertEqual(index[:], ['{"id": "new"}\n'])
+
+    def test_pickle(self):
+        with JsonlIndex(self.path) as index:
+            copy = pickle.loads(pickle.dumps(index))
+            self.assertEqual(copy[5:8], index[5:8])
+            copy.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
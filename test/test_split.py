@@ -0,0 +1,465 @@
+import os
+import csv
+import json
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from src.postprocess.split.aggregate import REPO_FIELDS, STATS_FIELDS, aggregate_metadata
+from src.postprocess.split.merge import merge_files
+from src.postprocess.split.repo_analysis import repo_merge
+from src.postprocess.split.metadata import META_FIELDS, META_SCHEMA, MetadataWriter, read_metadata
+from src.postprocess.split.mapping import SplitTable, extract_repo, line_ranges, mapping, processing
+from src.postprocess.split.split import TRAIN_SUBSETS, aggregate_repos, assign_repos, \
+    train_test_stratified_sampling, update_repo_split
+from src.postprocess.split.subset import SubsetReader
+from src.sidecar.jsonl_index import JsonlIndex
+from src.sidecar.sample_stats import STATS_DTYPE, read_stats, sample_stats, stats_path, write_stats
+
+
+def make_sample(code, repo, n_code_tokens=3, n_docstring_tokens=2):
+    return {
+        'code': code,
+        'repo': repo,
+        'code_tokens': ['tok'] * n_code_tokens,
+        'docstring': 'Do something.',
+        'docstring_tokens': ['Do', 'something'][:n_docstring_tokens],
+        'short_docstring': 'Do something.',
+        'short_docstring_tokens': ['Do', 'something'],
+    }
+
+
+def write_jsonl(path, samples):
+    with open(path, 'w') as file:
+        for sample in samples:
+            json.dump(sample, file)
+            file.write('\n')
+
+
+def read_jsonl(path):
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file]
+
+
+class Test_Merge(unittest.TestCase):
+    def make_raw_dataset(self, root):
+        for language in ('go', 'rust'):
+            os.makedirs(os.path.join(root, language))
+            for file_idx in range(3):
+                samples = [make_sample(f'{language} {file_idx} {i}', f'{language}/repo{i % 2}', i + 1)
+                           for i in range(4)]
+                write_jsonl(os.path.join(root, language, f'{file_idx}.jsonl'), samples)
+
+    def test_merge_files(self):
+        for multiprocess in (False, True):
+            with tempfile.TemporaryDirectory() as root:
+                data_path, save_path = os.path.join(root, 'raw'), os.path.join(root, 'merged')
+                os.makedirs(save_path)
+                self.make_raw_dataset(data_path)
+                subdirs = [os.path.join(data_path, language) for language in ('go', 'rust')]
+
+                n_samples = merge_files(subdirs, save_path, processes=2, multiprocess=multiprocess)
+                self.assertEqual(n_samples, {'go': 12, 'rust': 12})
+                self.assertEqual(sorted(os.listdir(save_path)),
+                                 ['go_merged.jsonl', 'go_merged.jsonl.idx', 'go_merged.jsonl.stats', 'go_meta.parquet',
+                                  'rust_merged.jsonl', 'rust_merged.jsonl.idx', 'rust_merged.jsonl.stats',
+                                  'rust_meta.parquet'])
+
+                merged = read_jsonl(os.path.join(save_path, 'go_merged.jsonl'))
+                self.assertEqual([sample['code'] for sample in merged],
+                                 [f'go {file_idx} {i}' for file_idx in range(3) for i in range(4)])
+                self.assertEqual(merged[0]['id'], hashlib.sha256(b'go 0 0').hexdigest())
+
+                metadata = read_metadata(os.path.join(save_path, 'go_meta.parquet'))
+                self.assertEqual(metadata.schema, META_SCHEMA)
+                self.assertEqual([[idx.hex(), repo, code_length, docs_length] for idx, repo, code_length, docs_length
+                                  in zip(*(metadata[field].to_pylist() for field in META_FIELDS))],
+                                 [[sample['id'], sample['repo'], len(sample['code_tokens']), 2] for sample in merged])
+                self.assertEqual(read_metadata(os.path.join(save_path, 'go_meta.parquet'), ['Code Length']).num_columns, 1)
+
+                stats = read_stats(os.path.join(save_path, 'go_merged.jsonl'))
+                self.assertEqual(stats.tolist(), [sample_stats(sample) for sample in merged])
+                with open(os.path.join(save_path, 'go_merged.jsonl')) as file, \
+                        JsonlIndex(os.path.join(save_path, 'go_merged.jsonl'), build=False) as index:
+                    self.assertEqual(index[:], list(file))
+
+    def test_merge_stats_sidecar(self):
+        with tempfile.TemporaryDirectory() as root:
+            data_path, save_path = os.path.join(root, 'raw'), os.path.join(root, 'merged')
+            os.makedirs(save_path)
+            self.make_raw_dataset(data_path)
+            raw_path = os.path.join(data_path, 'go', '0.jsonl')
+            write_stats([make_sample('', '', n_code_tokens=100 + i) for i in range(4)], raw_path)
+
+            merge_files([os.path.join(data_path, 'go')], save_path, multiprocess=False)
+            metadata = read_metadata(os.path.join(save_path, 'go_meta.parquet'))
+            self.assertEqual(metadata['Code Length'].to_pylist(), [100, 101, 102, 103] + [1, 2, 3, 4] * 2)
+            self.assertEqual(read_stats(os.path.join(save_path, 'go_merged.jsonl'))['code_tokens'][:4].tolist(),
+                             [100, 101, 102, 103])
+
+            # A sidecar which is not aligned with its file
+            write_stats([make_sample('', '')], raw_path)
+            with self.assertRaises(ValueError):
+                merge_files([os.path.join(data_path, 'go')], save_path, multiprocess=False)
+
+
+def write_merged(data_path, language, samples):
+    """
+    Merged file of a language dir and its metadata, as written by `merge.py`
+    """
+    write_jsonl(os.path.join(data_path, f'{language}_merged.jsonl'), samples)
+    with MetadataWriter(os.path.join(data_path, f'{language}_meta.parquet')) as writer:
+        for sample in samples:
+            writer.write([sample.get('id') or hashlib.sha256(sample['code'].encode()).hexdigest(),
+                          sample['repo'], 1, 1])
+
+
+def write_repo_split(path, repo_split):
+    with open(path, 'w', newline='') as file:
+        csv.writer(file).writerows([['Repo Name', 'Set Name', 'Count']] +
+                                   [[repo, set_name, 1] for repo, set_name in repo_split.items()])
+
+
+class Test_Aggregate(unittest.TestCase):
+    def write_metadata(self, path, n_rows=1000, n_repos=37):
+        rows = [[hashlib.sha256(str(i).encode()).hexdigest(), f'repo{i % n_repos}', (i * 7) % 101, i % 5]
+                for i in range(n_rows)]
+        with MetadataWriter(path, row_group_size=128) as writer:
+            for row in rows:
+                writer.write(row)
+        return rows
+
+    def expected_stats(self, rows):
+        lengths = {}
+        for _, repo, code_length, docs_length in rows:
+            lengths.setdefault(repo, []).append((code_length, docs_length))
+        return {repo: [len(values), np.mean([v[0] for v in values]), np.median([v[0] for v in values]),
+                       np.mean([v[1] for v in values]), np.median([v[1] for v in values]),
+                       sum(v[0] for v in values), sum(v[1] for v in values)] for repo, values in lengths.items()}
+
+    def test_aggregate_metadata(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'go_meta.parquet')
+            expected = self.expected_stats(self.write_metadata(path))
+            # In memory, then spilled to hash partitions
+            for max_rows in (10 ** 6, 100):
+                stats = {}
+                for table in aggregate_metadata(path, max_rows=max_rows, spill_dir=root):
+                    for row in zip(*(table[field].to_pylist() for field in REPO_FIELDS)):
+                        self.assertNotIn(row[0], stats)
+                        stats[row[0]] = list(row[1:])
+                self.assertEqual(stats.keys(), expected.keys())
+                for repo, values in expected.items():
+                    np.testing.assert_allclose(stats[repo], values)
+            self.assertEqual(sorted(os.listdir(root)), ['go_meta.parquet'])
+
+    def write_stats(self, path, n_rows):
+        stats = np.zeros(n_rows, dtype=STATS_DTYPE)
+        stats['code_chars'] = np.arange(n_rows)
+        stats['docstring_chars'] = 2 * np.arange(n_rows)
+        stats['comments'] = np.arange(n_rows) % 3
+        open(path, 'w').close()
+        stats.tofile(stats_path(path))
+        return stats
+
+    def expected_totals(self, rows, stats):
+        totals = {}
+        for (_, repo, _, _), record in zip(rows, stats.tolist()):
+            repo_totals = totals.setdefault(repo, [0, 0, 0])
+            for i, value in enumerate(record[2:]):
+                repo_totals[i] += value
+        return totals
+
+    def test_aggregate_stats(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'go_meta.parquet')
+            rows = self.write_metadata(path)
+            stats = self.write_stats(os.path.join(root, 'go_merged.jsonl'), len(rows))
+            expected = self.expected_totals(rows, stats)
+            for max_rows in (10 ** 6, 100):
+                totals = {}
+                for table in aggregate_metadata(path, max_rows=max_rows, spill_dir=root, stats=stats):
+                    self.assertEqual(table.column_names, REPO_FIELDS + list(STATS_FIELDS))
+                    for row in zip(*(table[field].to_pylist() for field in ['Repo Name'] + list(STATS_FIELDS))):
+                        totals[row[0]] = list(row[1:])
+                self.assertEqual(totals, expected)
+            with self.assertRaises(ValueError):
+                list(aggregate_metadata(path, stats=stats[:-1]))
+
+    def test_aggregate_duplicates(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'go_meta.parquet')
+            rows = self.write_metadata(path, 100, 7)
+            # Every id written twice, the copy in another repo
+            with MetadataWriter(path, row_group_size=64) as writer:
+                for row in rows:
+                    writer.write(row)
+                for row in rows:
+                    writer.write([row[0], 'other', 1000, 1000])
+            # Ids and repos are both spilled to hash partitions
+            stats = {}
+            for table in aggregate_metadata(path, max_rows=50, spill_dir=root):
+                for row in zip(*(table[field].to_pylist() for field in REPO_FIELDS)):
+                    self.assertNotIn(row[0], stats)
+                    stats[row[0]] = list(row[1:])
+            self.assertEqual(os.listdir(root), ['go_meta.parquet'])
+        expected = self.expected_stats(rows)
+        self.assertEqual(stats.keys(), expected.keys())
+        for repo, values in expected.items():
+            np.testing.assert_allclose(stats[repo], values)
+
+    def test_repo_merge(self):
+        with tempfile.TemporaryDirectory() as root:
+            expected = self.expected_stats(self.write_metadata(os.path.join(root, 'go_meta.parquet'), 50, 5))
+            repo_merge((os.path.join(root, 'go_meta.parquet'), root))
+            with open(os.path.join(root, 'go_repos.csv'), newline='') as file:
+                rows = list(csv.reader(file))
+        self.assertEqual(rows[0], REPO_FIELDS)
+        self.assertEqual({row[0]: [float(value) for value in row[1:]] for row in rows[1:]},
+                         {repo: [float(value) for value in values] for repo, values in expected.items()})
+
+    def test_repo_merge_stats(self):
+        with tempfile.TemporaryDirectory() as root:
+            meta_rows = self.write_metadata(os.path.join(root, 'go_meta.parquet'), 50, 5)
+            stats = self.write_stats(os.path.join(root, 'go_merged.jsonl'), 50)
+            repo_merge((os.path.join(root, 'go_meta.parquet'), root))
+            with open(os.path.join(root, 'go_repos.csv'), newline='') as file:
+                rows = list(csv.reader(file))
+        self.assertEqual(rows[0], REPO_FIELDS + list(STATS_FIELDS))
+        self.assertEqual({row[0]: [int(value) for value in row[len(REPO_FIELDS):]] for row in rows[1:]},
+                         self.expected_totals(meta_rows, stats))
+
+
+class Test_Split(unittest.TestCase):
+    def test_assign_repos(self):
+        repos = {f'repo{i}': [1 + i % 7, (1 + i % 7) * (i % 50), 0] for i in range(2000)}
+        assignment = assign_repos(repos, ['test', 'eval', 'train'], [0.1, 0.1])
+        self.assertEqual(assign_repos(repos, ['test', 'eval', 'train'], [0.1, 0.1]), assignment)
+        for set_name in ('test', 'eval'):
+            n_functions = sum(repos[repo][0] for repo, name in assignment.items() if name == set_name)
+            total = sum(stats[0] for stats in repos.values())
+            self.assertAlmostEqual(n_functions / total, 0.1, delta=0.02)
+        self.assertNotEqual(assign_repos(repos, ['a', 'b', 'c'], [0.1, 0.1], seed=1),
+                            {repo: {'test': 'a', 'eval': 'b', 'train': 'c'}[name] for repo, name in assignment.items()})
+
+    def test_assign_repos_stable(self):
+        # Zipf-sized repos, then 5% more repos of any size: no existing repo moves
+        sizes = np.random.default_rng(0).zipf(1.5, 20000)
+        repos = {f'repo{i}': [int(size), int(size) * 20, 0] for i, size in enumerate(sizes)}
+        assignment = assign_repos(repos, ['test', 'eval', 'train'], [0.02, 0.02])
+        more_repos = dict(repos, **{f'new{i}': [int(size), 10, 0] for i, size in enumerate(sizes[:1000] * 50)})
+        new_assignment = assign_repos(more_repos, ['test', 'eval', 'train'], [0.02, 0.02])
+        self.assertEqual({repo: new_assignment[repo] for repo in repos}, assignment)
+        self.assertEqual(set(new_assignment.values()), {'test', 'eval', 'train'})
+
+    def test_aggregate_repos(self):
+        rows = [[hashlib.sha256(str(i).encode()).hexdigest(), f'repo{i % 3}', i, 1] for i in range(10)]
+        with tempfile.TemporaryDirectory() as root:
+            with MetadataWriter(os.path.join(root, 'go_meta.parquet'), row_group_size=4) as writer:
+                for row in rows:
+                    writer.write(row)
+            with open(os.path.join(root, 'go_meta.csv'), 'w', newline='') as file:
+                csv.writer(file).writerows([META_FIELDS] + rows)
+
+            expected = {'repo0': [4, 18, 4], 'repo1': [3, 12, 3], 'repo2': [3, 15, 3]}
+            self.assertEqual(aggregate_repos(os.path.join(root, 'go_meta.parquet')), expected)
+            self.assertEqual(aggregate_repos(os.path.join(root, 'go_meta.csv')), expected)
+
+    def test_train_test_stratified_sampling(self):
+        with tempfile.TemporaryDirectory() as root:
+            meta_path = os.path.join(root, 'go_meta.parquet')
+            with MetadataWriter(meta_path) as writer:
+                for i in range(3000):
+                    writer.write([hashlib.sha256(str(i).encode()).hexdigest(), f'repo{i % 300}', i % 97, 3])
+
+            with patch('src.postprocess.split.split.TEST_SIZE', 300):
+                rows = train_test_stratified_sampling(meta_path)
+            self.assertEqual(len(rows), 300)
+            self.assertEqual(sum(int(count) for _, _, count in rows), 3000)
+            self.assertEqual({set_name for _, set_name, _ in rows}, {'train', 'eval', 'test'})
+
+            rows = train_test_stratified_sampling(meta_path, split_train=True)
+            with open(os.path.join(root, 'go_repo_split.csv'), newline='') as file:
+                self.assertEqual(list(csv.reader(file))[1:], [[str(value) for value in row] for row in rows])
+            self.assertEqual({set_name for _, set_name, _ in rows},
+                             {'small_train', 'medium_train', 'large_train', 'eval', 'test'})
+
+    def test_small_language(self):
+        with tempfile.TemporaryDirectory() as root:
+            meta_path = os.path.join(root, 'go_meta.parquet')
+            with MetadataWriter(meta_path) as writer:
+                for i in range(3000):
+                    writer.write([hashlib.sha256(str(i).encode()).hexdigest(), f'repo{i}', i % 97, 3])
+            # Fewer than 2 * TEST_SIZE functions: test and eval are capped, train keeps the rest
+            # (one function per repo, repos are drawn one by one)
+            with self.assertWarns(UserWarning):
+                rows = train_test_stratified_sampling(meta_path)
+        counts = {}
+        for _, set_name, count in rows:
+            counts[set_name] = counts.get(set_name, 0) + count
+        self.assertAlmostEqual(counts['test'], 300, delta=30)
+        self.assertAlmostEqual(counts['eval'], 300, delta=30)
+        self.assertGreaterEqual(counts['train'], 2400 - 60)
+
+    @patch('src.postprocess.split.split.TEST_SIZE', 100)
+    @patch('src.postprocess.split.split.MAX_HELDOUT_RATIO', 0.5)
+    def test_update_repo_split(self):
+        existing = [['a', 'test', 60], ['b', 'eval', 100], ['c', 'train', 500]]
+        repos = {'a': [5, 50, 5], 'c': [10, 100, 10]}
+        repos.update({f'new{i}': [2, 20 * (i % 10), 2] for i in range(100)})
+        rows = update_repo_split(repos, existing)
+
+        # Known repos keep their set, only test is short of its target
+        self.assertEqual(rows[:3], [['a', 'test', 65], ['b', 'eval', 100], ['c', 'train', 510]])
+        new_sets = [set_name for _, set_name, _ in rows[3:]]
+        self.assertEqual(len(new_sets), 100)
+        self.assertNotIn('eval', new_sets)
+        self.assertAlmostEqual(2 * new_sets.count('test'), 35, delta=10)
+        self.assertEqual(update_repo_split({'a': [1, 1, 1]}, existing)[0], ['a', 'test', 61])
+
+        # Train subsets are filled up to their share of the train functions
+        existing = [['a', 'test', 100], ['b', 'eval', 100], ['c', 'small_train', 50],
+                    ['d', 'medium_train', 200], ['e', 'large_train', 750]]
+        rows = update_repo_split(repos, existing)
+        new_sets = [set_name for _, set_name, _ in rows[5:]]
+        self.assertTrue({'medium_train', 'large_train'} <= set(new_sets) <= set(TRAIN_SUBSETS))
+        # 25% of the 1210 train functions, 200 of them already in medium_train
+        self.assertAlmostEqual(2 * new_sets.count('medium_train'), 0.25 * 1210 - 200, delta=20)
+
+
+class Test_Mapping(unittest.TestCase):
+    def test_extract_repo(self):
+        self.assertEqual(extract_repo(json.dumps({'code': '"repo": "x', 'repo': 'a/b'})), 'a/b')
+        self.assertEqual(extract_repo(json.dumps({'code': 'x', 'repo': 'a/b'})), 'a/b')
+        self.assertEqual(extract_repo(json.dumps({'repo': 'a\\b'})), 'a\\b')
+        self.assertIsNone(extract_repo('not json'))
+
+    def test_split_table(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'go_repo_split.csv')
+            write_repo_split(path, {'a': 'test', 'b': 'eval', 'c': 'small_train', 'd': 'train'})
+            table = SplitTable.from_csv(path)
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.split_names(['a', 'b', 'c', 'd', 'e', None]),
+                         ['test', 'eval', 'small_train', 'train', 'train', 'train'])
+
+    def make_language_dir(self, root, language, samples, split_of):
+        data_path = os.path.join(root, language)
+        os.makedirs(data_path)
+        write_merged(data_path, language, samples)
+        write_repo_split(os.path.join(data_path, f'{language}_repo_split.csv'),
+                         {samples[i]['repo']: set_name for set_name, indices in split_of.items() for i in indices})
+        return data_path
+
+    def check_language_dir(self, data_path, samples, split_of):
+        for set_name, indices in split_of.items():
+            expected = [sample for sample in samples if sample['repo'] in {samples[i]['repo'] for i in indices}]
+            if set_name in ('test', 'eval'):
+                self.assertEqual(read_jsonl(os.path.join(data_path, f'{set_name}.jsonl')), expected)
+                continue
+            # Train subsets are indexes into full_train.jsonl
+            self.assertFalse(os.path.exists(os.path.join(data_path, f'{set_name}.jsonl')))
+            with SubsetReader.from_dir(data_path, set_name) as reader:
+                self.assertEqual(len(reader), len(expected))
+                self.assertEqual([json.loads(line) for line in reader], expected)
+                self.assertEqual(json.loads(reader[-1]), expected[-1])
+                self.assertEqual([json.loads(line) for line in reader[1:]], expected[1:])
+        self.assertEqual(read_jsonl(os.path.join(data_path, 'full_train.jsonl')),
+                         [sample for sample in samples if sample['repo'] not in
+                          {samples[i]['repo'] for i in split_of['test'] + split_of['eval']}])
+        self.assertFalse(os.path.exists(os.path.join(data_path, '.mapping_parts')))
+
+    def test_processing(self):
+        samples = [make_sample(f'code {i}', f'repo{i % 8}') for i in range(20)]
+        split_of = {'small_train': [0], 'medium_train': [1], 'large_train': [2, 3], 'test': [4, 5], 'eval': [6]}
+        with tempfile.TemporaryDirectory() as root:
+            data_path = self.make_language_dir(root, 'go', samples, split_of)
+            processing(data_path, 0)
+            self.check_language_dir(data_path, samples, split_of)
+
+    def test_line_ranges(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'data.jsonl')
+            with open(path, 'w') as file:
+                file.write(''.join(f'{"x" * i}\n' for i in range(20)))
+            ranges = line_ranges(path, 30)
+            with open(path, 'rb') as file:
+                content = file.read()
+        self.assertGreater(len(ranges), 3)
+        self.assertEqual(b''.join(content[start:end] for _, _, start, end in ranges), content)
+        self.assertEqual([first for first, _, _, _ in ranges], [0] + [last for _, last, _, _ in ranges[:-1]])
+        self.assertEqual(ranges[-1][1], 20)
+        self.assertTrue(all(content[start:end].count(b'\n') == last - first for first, last, start, end in ranges))
+
+    def test_mapping(self):
+        # Small byte ranges spread each language over several tasks
+        split_of = {'small_train': [0], 'medium_train': [1], 'large_train': [2, 3], 'test': [4, 5], 'eval': [6]}
+        with tempfile.TemporaryDirectory() as root:
+            data_paths, language_samples = [], []
+            for language in ('go', 'rust'):
+                samples = [make_sample(f'{language} {i}', f'{language}/repo{i % 8}') for i in range(20)]
+                data_paths.append(self.make_language_dir(root, language, samples, split_of))
+                language_samples.append(samples)
+
+            mapping(data_paths, processes=2, chunk_bytes=500)
+            for data_path, samples in zip(data_paths, language_samples):
+                self.check_language_dir(data_path, samples, split_of)
+
+            # New records are appended to the existing split files
+            data_path, samples = data_paths[0], language_samples[0]
+            new_samples = [make_sample(f'new {i}', f'go/repo{i % 8}') for i in range(20)]
+            write_merged(data_path, 'go', new_samples)
+            mapping([data_path], multiprocess=False, existing_split=root)
+            self.check_language_dir(data_path, samples + new_samples, split_of)
+
+    def test_mapping_existing_split(self):
+        samples = [make_sample(f'code {i}', f'repo{i % 8}') for i in range(20)]
+        split_of = {'small_train': [0], 'medium_train': [1], 'large_train': [2, 3], 'test': [4, 5], 'eval': [6]}
+        with tempfile.TemporaryDirectory() as root:
+            old_root, new_root = os.path.join(root, 'old'), os.path.join(root, 'new')
+            old_path = self.make_language_dir(old_root, 'go', samples, split_of)
+            mapping([old_path], multiprocess=False, chunk_bytes=300)
+
+            # New records in known and new repos, and a test sample again in a train repo
+            new_samples = [make_sample(f'new {i}', f'repo{i % 8}') for i in range(10)] + \
+                [make_sample(f'other {i}', 'repo8') for i in range(3)]
+            split_of['test'] = split_of['test'] + [len(samples) + 10]
+            new_path = self.make_language_dir(new_root, 'go', new_samples + [dict(samples[4], repo='repo1')],
+                                              {set_name: [i - len(samples) for i in indices if i >= len(samples)]
+                                               for set_name, indices in split_of.items()})
+            with open(os.path.join(new_path, 'go_repo_split.csv'), 'a', newline='') as file:
+                csv.writer(file).writerows([[samples[i]['repo'], set_name, 1] for set_name, indices in
+                                            split_of.items() for i in indices if i < len(samples)])
+            mapping([new_path], multiprocess=False, chunk_bytes=300, existing_split=old_root)
+
+            self.check_language_dir(old_path, samples + new_samples, split_of)
+            self.assertFalse({'test.jsonl', 'eval.jsonl', 'full_train.jsonl'} & set(os.listdir(new_path)))
+            self.assertEqual(len(SplitTable.from_csv(os.path.join(old_path, 'go_repo_split.csv'))), 8)
+
+    def test_mapping_duplicates(self):
+        samples = [make_sample(f'code {i}', f'repo{i % 8}') for i in range(20)]
+        for sample in samples:
+            sample['id'] = hashlib.sha256(sample['code'].encode()).hexdigest()
+        # Sample 4 (test) again in a train repo, sample 9 (train) again in a test repo
+        duplicates = [dict(samples[4], repo='repo1'), dict(samples[9], repo='repo5')]
+        split_of = {'small_train': [0], 'medium_train': [1], 'large_train': [2, 3], 'test': [4, 5], 'eval': [6]}
+        with tempfile.TemporaryDirectory() as root:
+            data_path = self.make_language_dir(root, 'go', samples, split_of)
+            write_merged(data_path, 'go', samples[:10] + duplicates + samples[10:])
+            mapping([data_path], multiprocess=False, chunk_bytes=300)
+            self.check_language_dir(data_path, samples, split_of)
+
+            # Metadata which does not match the merged file
+            write_merged(data_path, 'go', samples)
+            write_jsonl(os.path.join(data_path, 'go_merged.jsonl'), samples[:-1])
+            with self.assertRaises(ValueError):
+                mapping([data_path], multiprocess=False)
+            write_jsonl(os.path.join(data_path, 'go_merged.jsonl'), samples)
+            mapping([data_path], multiprocess=False, chunk_bytes=300)
+            self.check_language_dir(data_path, samples, split_of)
+
+if __name__ == '__main__':
+    unittest.main()